@@ -0,0 +1,77 @@
+# archive.py
+import argparse
+import json
+import os
+import threading
+import time
+
+# Request statuses after which nothing more happens to the request. A request in one of them is
+# moved from the hot state into the archive once it has kept that status for the retention TTL.
+# "Found" is not one of them: the buyer still has to BUY (then "Completed" or "Failed") or CANCEL.
+FINISHED_STATUSES = {"Completed", "Failed", "No Offers", "Not Found", "Cancelled"}
+
+
+# Append-only archive of finished requests, one JSON line per request:
+#   {"rq_number": ..., "archived_at": <unix time>, <request details>...}
+# The file is only ever appended to, so it can be read (or copied) at any time while the server runs.
+class RequestArchive:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+        self.archived = 0
+
+    def append(self, rq_number, details):
+        line = json.dumps({"rq_number": rq_number, "archived_at": time.time(), **details})
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, "a")
+            self.file.write(line + "\n")
+            self.file.flush()
+            self.archived += 1
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+# Iterate over the archived requests in the order they were archived.
+def read_archive(path):
+    if not os.path.exists(path):
+        return
+    with open(path, "r") as file:
+        for line in file:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                break  # Torn write at the tail of the file
+
+
+# Archived requests matching every filter that is given.
+def find_requests(path, rq_number=None, name=None, status=None, item_name=None):
+    for record in read_archive(path):
+        if rq_number is not None and record['rq_number'] != rq_number:
+            continue
+        if name is not None and record.get('name') != name:
+            continue
+        if status is not None and record.get('status') != status:
+            continue
+        if item_name is not None and record.get('item_name', '').lower() != item_name.lower():
+            continue
+        yield record
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the archive of finished server requests")
+    parser.add_argument("path", nargs="?", default="server.archive.jsonl", help="Archive file to read")
+    parser.add_argument("--rq", help="Only the request with this RQ#")
+    parser.add_argument("--name", help="Only requests made by this peer")
+    parser.add_argument("--status", help="Only requests that finished with this status")
+    parser.add_argument("--item", help="Only requests for this item")
+    args = parser.parse_args()
+
+    for record in find_requests(args.path, rq_number=args.rq, name=args.name, status=args.status,
+                                item_name=args.item):
+        print(json.dumps(record))
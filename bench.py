@@ -0,0 +1,293 @@
+# bench.py
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+from cluster import start_workers
+from metrics import LatencyRecorder
+from peer_host import PeerHost
+from policy import PeerPolicy
+from server import SERVER_MODES, STATE_BACKENDS, Server, run_worker
+
+OPERATIONS = ("register", "search", "negotiate", "buy")
+DEFAULT_MIX = "register=1,search=6,negotiate=2,buy=1"
+SELLER_PRICE = 40.0
+SEARCH_MAX_PRICE = 50.0  # Above the sellers' price: answered by an OFFER
+NEGOTIATE_MAX_PRICE = 30.0  # Below it: the server negotiates with the cheapest seller
+OP_TIMEOUT = 30
+PROFILE = {"card_number": "4111-1111-1111-1111", "card_expiry": "12/30"}
+
+
+# Parse "register=1,search=6,..." into {operation: weight}.
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        operation, _, weight = part.partition("=")
+        operation = operation.strip()
+        if operation not in OPERATIONS:
+            raise ValueError(f"Unknown operation '{operation}', expected one of {OPERATIONS}")
+        mix[operation] = float(weight or 1)
+    return mix
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm", "r") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+# Drives the full REGISTER -> LOOKING_FOR -> OFFER/NEGOTIATE -> FOUND -> BUY flow against a Server
+# and a PeerHost of synthetic peers on loopback, and measures every operation from the buyer's side:
+#   register   DE-REGISTER and REGISTER of a buyer, until REGISTERED
+#   search     LOOKING_FOR above the sellers' price, until FOUND (the buyer then cancels)
+#   negotiate  LOOKING_FOR below the sellers' price, through NEGOTIATE/ACCEPT until FOUND (then cancelled)
+#   buy        LOOKING_FOR, FOUND, BUY and the TCP transaction, until the seller has the Shipping_Info
+# Each buyer runs one operation at a time; the buyers run concurrently.
+class Benchmark:
+    def __init__(self, buyers=4, sellers=8, items=16, sellers_per_item=2, stock=50, mix=None,
+                 base_port=47000, mode="threaded", workers=8, seed=1, state_backend="journal", server_workers=1,
+                 price_tolerance=None):
+        self.mix = mix or parse_mix(DEFAULT_MIX)
+        self.random = random.Random(seed)
+        self.items = [f"item{k}" for k in range(items)]
+        server_options = dict(server_file="bench_server.json", address=("127.0.0.1", base_port), mode=mode,
+                              fsync_policy="never", state_backend=state_backend, price_tolerance=price_tolerance)
+        # Several server workers run in their own processes, sharing the port (see cluster.py)
+        self.server, self.server_pool = None, None
+        if server_workers > 1:
+            # The workers print every event too; they inherit stdout at the descriptor level
+            stdout = os.dup(1)
+            with open(os.devnull, "w") as devnull:
+                os.dup2(devnull.fileno(), 1)
+            try:
+                self.server_pool = start_workers(run_worker, server_workers, **server_options)
+            finally:
+                os.dup2(stdout, 1)
+                os.close(stdout)
+        else:
+            self.server = Server(**server_options)
+            self.server.start()
+
+        self.buyer_names = [f"Buyer{i}" for i in range(buyers)]
+        self.seller_names = [f"Seller{i}" for i in range(sellers)]
+        names = self.buyer_names + self.seller_names
+        roster = [(name, base_port + 1 + i, base_port + 1 + len(names) + i) for i, name in enumerate(names)]
+
+        # Buyers buy the "buy" items only; sellers accept every negotiation
+        buy_rules = {f"buy-{item}": {"max_price": SEARCH_MAX_PRICE} for item in self.items}
+        buy_rules["*"] = {"max_price": -1}
+        self.policies = {name: PeerPolicy(buy=buy_rules, profile={**PROFILE, "shipping_address": name})
+                         for name in self.buyer_names}
+        for name in self.seller_names:
+            self.policies[name] = PeerPolicy(sell={"*": {"min_price": 0}}, profile={**PROFILE, "shipping_address": name})
+        try:
+            self.host = PeerHost(roster, ("127.0.0.1", base_port), workers=workers, policy=self.answer)
+        except BaseException:
+            self.stop()  # Server workers are separate processes
+            raise
+        self.peers = {peer.name: peer for peer in self.host.peers}
+
+        # Every item is stocked, under its search and its buy name, by `sellers_per_item` sellers
+        for k, item in enumerate(self.items):
+            for j in range(sellers_per_item):
+                seller = self.peers[self.seller_names[(k + j) % sellers]]
+                for _ in range(stock):
+                    for name in (item, f"buy-{item}"):
+                        seller.inventory.add({"item_name": name, "item_description": "bench",
+                                              "price": SELLER_PRICE, "reserved": False})
+        self.shipped = {name: threading.Event() for name in self.buyer_names}
+        for name in self.seller_names:
+            self.watch_shipping(self.peers[name])
+
+        self.latency = {operation: LatencyRecorder(window=1 << 16) for operation in OPERATIONS}
+        self.replies = {operation: {} for operation in OPERATIONS}
+        self.errors = {operation: 0 for operation in OPERATIONS}
+        self.lock = threading.Lock()
+
+    def answer(self, peer, question, details):
+        return self.policies[peer.name](peer, question, details)
+
+    # Signal the buyer's event once a seller receives the Shipping_Info of its purchase.
+    def watch_shipping(self, seller):
+        process_shipping_info = seller.process_shipping_info
+
+        def on_shipping_info(conn, addr, parts):
+            process_shipping_info(conn, addr, parts)
+            event = self.shipped.get(parts[2])
+            if event is not None:
+                event.set()
+        seller.process_shipping_info = on_shipping_info
+
+    def start(self):
+        self.host.start()
+        registered = self.host.register_all()
+        if registered < len(self.host.peers):
+            raise RuntimeError(f"Only {registered} of {len(self.host.peers)} peers registered")
+        time.sleep(0.5)  # Let the catalogs reach the server
+
+    def stop(self):
+        if self.server_pool is not None:
+            self.server_pool.stop()
+
+    def run(self, operations):
+        per_buyer = [operations // len(self.buyer_names) + (1 if i < operations % len(self.buyer_names) else 0)
+                     for i in range(len(self.buyer_names))]
+        choices, weights = zip(*self.mix.items())
+        plans = [[self.random.choices(choices, weights)[0] for _ in range(count)] for count in per_buyer]
+        threads = [threading.Thread(target=self.run_buyer, args=(self.peers[name], plan), daemon=True)
+                   for name, plan in zip(self.buyer_names, plans)]
+
+        cpu_before, started = cpu_seconds(), time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.perf_counter() - started
+        cpu = cpu_seconds() - cpu_before
+        return self.report(duration, cpu)
+
+    def run_buyer(self, buyer, plan):
+        for operation in plan:
+            started = time.perf_counter()
+            try:
+                reply = getattr(self, f"op_{operation}")(buyer)
+            except Exception as e:
+                logging.error(f"Benchmark {operation} by {buyer.name} failed: {e}")
+                reply = None
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                if reply is None:
+                    self.errors[operation] += 1
+                else:
+                    counts = self.replies[operation]
+                    counts[reply] = counts.get(reply, 0) + 1
+            if reply is not None:
+                self.latency[operation].observe(elapsed)
+
+    def op_register(self, buyer):
+        buyer.deregister_async().result(OP_TIMEOUT)
+        return buyer.register_async().result(OP_TIMEOUT).split()[0]
+
+    def op_search(self, buyer):
+        item = self.random.choice(self.items)
+        return buyer.looking_for_async(item, "bench", SEARCH_MAX_PRICE).result(OP_TIMEOUT).split()[0]
+
+    def op_negotiate(self, buyer):
+        item = self.random.choice(self.items)
+        return buyer.looking_for_async(item, "bench", NEGOTIATE_MAX_PRICE).result(OP_TIMEOUT).split()[0]
+
+    def op_buy(self, buyer):
+        item = f"buy-{self.random.choice(self.items)}"
+        shipped = self.shipped[buyer.name]
+        shipped.clear()
+        reply = buyer.looking_for_async(item, "bench", SEARCH_MAX_PRICE).result(OP_TIMEOUT).split()[0]
+        if reply == "FOUND" and not shipped.wait(OP_TIMEOUT):
+            return None
+        return reply
+
+    def report(self, duration, cpu):
+        operations = {}
+        for operation in OPERATIONS:
+            summary = self.latency[operation].summary()
+            count = summary.pop("count")
+            if not count and not self.errors[operation]:
+                continue
+            operations[operation] = {
+                "count": count,
+                "errors": self.errors[operation],
+                "ops_per_sec": count / duration if duration else None,
+                "latency": summary,
+                "replies": self.replies[operation],
+            }
+        total = sum(result["count"] for result in operations.values())
+        return {
+            "duration": duration,
+            "ops_per_sec": total / duration if duration else None,
+            "operations": operations,
+            # Server and peers share the process, so CPU and memory cover both (the peers only with --server-workers)
+            "cpu_seconds": cpu,
+            "cpu_percent": 100 * cpu / duration if duration else None,
+            "rss_bytes": rss_bytes(),
+            "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            "server": self.server.latency_stats() if self.server is not None else None,
+            # Datagrams the server received and sent, by message type (OFFER, NEGOTIATE, ...)
+            "server_messages": self.server_messages() if self.server is not None else None,
+        }
+
+    def server_messages(self):
+        counters = self.server.metrics.snapshot()["counters"]
+        return {"received": counters.get("messages_total", {}), "sent": counters.get("replies_total", {})}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the server with synthetic peers on loopback")
+    parser.add_argument("--ops", type=int, default=1000, help="Operations to run in total")
+    parser.add_argument("--buyers", type=int, default=4, help="Buyers, each running one operation at a time")
+    parser.add_argument("--sellers", type=int, default=8, help="Sellers")
+    parser.add_argument("--items", type=int, default=16, help="Distinct items on sale")
+    parser.add_argument("--sellers-per-item", type=int, default=2, help="Sellers stocking each item")
+    parser.add_argument("--stock", type=int, default=50, help="Units of each item per seller")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"Weights of the operations (default: {DEFAULT_MIX})")
+    parser.add_argument("--mode", choices=SERVER_MODES, default="threaded", help="Server mode")
+    parser.add_argument("--workers", type=int, default=8, help="Threads running the peers' message handlers")
+    parser.add_argument("--state-backend", choices=STATE_BACKENDS, default="journal", help="Server state backend")
+    parser.add_argument("--server-workers", type=int, default=1,
+                        help="Server worker processes; above 1 the CPU figures cover the peers only")
+    parser.add_argument("--price-tolerance", type=float,
+                        help="Send sellers the buyer's bid with each SEARCH, see server.py --price-tolerance")
+    parser.add_argument("--base-port", type=int, default=47000, help="Server UDP port; peers use the ports above")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the operation mix")
+    parser.add_argument("--workdir", help="Directory for state, inventories and logs (default: a new temporary one)")
+    parser.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    workdir = args.workdir or tempfile.mkdtemp(prefix="p2p-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    logging.basicConfig(filename="bench.log", level=logging.WARNING,
+                        format="%(asctime)s - %(levelname)s - %(message)s")
+    sys.stdout = open(os.devnull, "w")  # The server and peers print every event
+    try:
+        benchmark = Benchmark(buyers=args.buyers, sellers=args.sellers, items=args.items,
+                              sellers_per_item=args.sellers_per_item, stock=args.stock, mix=parse_mix(args.mix),
+                              base_port=args.base_port, mode=args.mode, workers=args.workers, seed=args.seed,
+                              state_backend=args.state_backend, server_workers=args.server_workers,
+                              price_tolerance=args.price_tolerance)
+        try:
+            benchmark.start()
+            results = benchmark.run(args.ops)
+        finally:
+            benchmark.stop()
+    except BaseException:
+        # E.g. a port already in use: report it instead of hanging on the server's listener thread
+        sys.stdout = sys.__stdout__
+        traceback.print_exc()
+        os._exit(1)
+    results["config"] = {key: value for key, value in vars(args).items() if key not in ("output", "workdir")}
+    results["workdir"] = os.getcwd()
+    sys.stdout = sys.__stdout__
+
+    text = json.dumps(results, indent=2)
+    if output:
+        with open(output, "w") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+    sys.stdout.flush()
+    os._exit(0)  # The server has no shutdown; its listener thread would keep the process alive
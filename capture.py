@@ -0,0 +1,84 @@
+# capture.py
+import argparse
+import socket
+import struct
+import threading
+import time
+
+import wire
+
+# Compact binary trace of the datagrams a server received, for replaying them later (see replay.py).
+# The file starts with TRACE_MAGIC, followed by one record per datagram:
+#   receive time (d, unix seconds) | source IPv4 address (4s) | source port (H) | length (H) | datagram
+TRACE_MAGIC = b"P2PTRACE1\n"
+RECORD_HEADER = struct.Struct("!d4sHH")
+FLUSH_INTERVAL = 0.5  # Seconds a recorded datagram may sit in the write buffer
+
+
+class TraceWriter:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(TRACE_MAGIC)
+        self.last_flush = time.monotonic()
+        self.recorded = 0
+
+    def record(self, data, addr):
+        header = RECORD_HEADER.pack(time.time(), socket.inet_aton(addr[0]), addr[1], len(data))
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(header + data)
+            self.recorded += 1
+            now = time.monotonic()
+            if now - self.last_flush >= FLUSH_INTERVAL:
+                self.file.flush()
+                self.last_flush = now
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+# Iterate over the (timestamp, (ip, port), datagram) records of a trace, in the order they were received.
+def read_trace(path):
+    with open(path, "rb") as file:
+        if file.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            raise ValueError(f"{path} is not a server trace")
+        while True:
+            header = file.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            timestamp, ip, port, length = RECORD_HEADER.unpack(header)
+            data = file.read(length)
+            if len(data) < length:
+                return  # Torn write at the tail of the file
+            yield timestamp, (socket.inet_ntoa(ip), port), data
+
+
+# Number of datagrams per message type and the time span of a trace.
+def summarize(path):
+    counts = {}
+    first = last = None
+    for timestamp, _, data in read_trace(path):
+        msg_type = wire.message_type(data) or "?"
+        counts[msg_type] = counts.get(msg_type, 0) + 1
+        first = timestamp if first is None else first
+        last = timestamp
+    return {"datagrams": sum(counts.values()), "seconds": (last - first) if first is not None else 0,
+            "types": counts}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize a server trace")
+    parser.add_argument("path", help="Trace file recorded with server.py --trace")
+    args = parser.parse_args()
+
+    summary = summarize(args.path)
+    print(f"{summary['datagrams']} datagrams over {summary['seconds']:.1f}s")
+    for msg_type, count in sorted(summary["types"].items(), key=lambda entry: -entry[1]):
+        print(f"  {msg_type}: {count}")
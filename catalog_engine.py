@@ -0,0 +1,297 @@
+# catalog_engine.py
+import argparse
+import array
+import bisect
+import json
+import math
+import mmap
+import os
+import random
+import re
+import struct
+import sys
+import tempfile
+import time
+
+from catalog_index import normalize_item
+
+try:
+    import numpy as np  # Vectorized scoring when available
+except ImportError:
+    np = None
+
+# Peer-side search index of a large catalog, stored in one file that is memory-mapped and used in
+# place, so opening it reads nothing but the header. Every distinct item name is one entry (an SKU);
+# its text is the name plus the descriptions of its units. Sections are 8-byte aligned little-endian
+# arrays (the byte order of the machines we run on, so they can be viewed without conversion):
+#   header        magic, SKU count, token count, offsets of the sections below
+#   name offsets  uint32[skus + 1] into the name blob; SKUs are sorted by name, so an SKU id is its rank
+#   name blob     UTF-8 item names
+#   token offsets uint32[tokens + 1] into the token blob; tokens are sorted
+#   token blob    UTF-8 tokens
+#   postings      uint32[tokens + 1], where each token's postings start
+#   posting ids   uint32[postings], SKU ids in ascending order within each token
+#   weights       float32[postings], NAME_WEIGHT if the token is in the name, plus 1 if in a description
+#   idf           float32[tokens]
+MAGIC = b"P2PCAT1\n"
+HEADER = struct.Struct("<8sII8Q")
+NAME_WEIGHT = 2.0
+EXACT_BONUS = 1.0  # Added to the SKU named exactly as the request, so it wins a tie
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def _align(file):
+    file.write(b"\0" * (-file.tell() % 8))
+    return file.tell()
+
+
+def _write_strings(file, strings):
+    encoded = [string.encode() for string in strings]
+    offsets = array.array("I", [0])
+    for raw in encoded:
+        offsets.append(offsets[-1] + len(raw))
+    offsets_at = _align(file)
+    file.write(offsets.tobytes())
+    blob_at = _align(file)
+    file.write(b"".join(encoded))
+    return offsets_at, blob_at
+
+
+# Write the index of `items` (inventory units with item_name and item_description) to path.
+def build_catalog(path, items):
+    texts = {}
+    for item in items:
+        name = normalize_item(item['item_name'])
+        description_tokens = texts.setdefault(name, set())
+        description_tokens.update(tokenize(item.get('item_description', '')))
+    names = sorted(texts)
+    postings = {}
+    for sku, name in enumerate(names):
+        name_tokens = set(tokenize(name))
+        for token in name_tokens | texts[name]:
+            weight = (NAME_WEIGHT if token in name_tokens else 0.0) + (1.0 if token in texts[name] else 0.0)
+            postings.setdefault(token, []).append((sku, weight))
+    tokens = sorted(postings, key=lambda token: token.encode())
+
+    starts, ids, weights, idf = array.array("I", [0]), array.array("I"), array.array("f"), array.array("f")
+    for token in tokens:
+        for sku, weight in postings[token]:
+            ids.append(sku)
+            weights.append(weight)
+        starts.append(len(ids))
+        idf.append(math.log(1 + len(names) / len(postings[token])))
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(b"\0" * HEADER.size)
+        name_offsets_at, name_blob_at = _write_strings(file, names)
+        token_offsets_at, token_blob_at = _write_strings(file, tokens)
+        sections = [name_offsets_at, name_blob_at, token_offsets_at, token_blob_at]
+        for values in (starts, ids, weights, idf):
+            sections.append(_align(file))
+            file.write(values.tobytes())
+        file.seek(0)
+        file.write(HEADER.pack(MAGIC, len(names), len(tokens), *sections))
+    os.replace(tmp_path, path)
+    return len(names), len(tokens)
+
+
+# A catalog file opened for searching. Thread-safe: nothing is written after opening.
+class CatalogEngine:
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as file:
+            self.mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.sku_count, self.token_count, *sections = HEADER.unpack_from(self.mm)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a catalog file")
+        names_at, self.name_blob_at, tokens_at, self.token_blob_at, starts_at, ids_at, weights_at, idf_at = sections
+        self.view = memoryview(self.mm)
+        self.name_offsets = self.view[names_at:names_at + 4 * (self.sku_count + 1)].cast("I")
+        self.token_offsets = self.view[tokens_at:tokens_at + 4 * (self.token_count + 1)].cast("I")
+        self.starts = self.view[starts_at:starts_at + 4 * (self.token_count + 1)].cast("I")
+        total = self.starts[self.token_count]
+        self.ids = self.view[ids_at:ids_at + 4 * total].cast("I")
+        self.weights = self.view[weights_at:weights_at + 4 * total].cast("f")
+        self.idf = self.view[idf_at:idf_at + 4 * self.token_count].cast("f")
+        if np is not None:
+            self.np_ids = np.frombuffer(self.mm, dtype="<u4", count=total, offset=ids_at)
+            self.np_weights = np.frombuffer(self.mm, dtype="<f4", count=total, offset=weights_at)
+
+    def name(self, sku):
+        start, end = self.name_offsets[sku], self.name_offsets[sku + 1]
+        return bytes(self.view[self.name_blob_at + start:self.name_blob_at + end]).decode()
+
+    def _token(self, index):
+        start, end = self.token_offsets[index], self.token_offsets[index + 1]
+        return bytes(self.view[self.token_blob_at + start:self.token_blob_at + end])
+
+    # Binary search of a sorted string section; index of `key` or None.
+    def _find(self, key, count, read):
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if read(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low if low < count and read(low) == key else None
+
+    # (start, end, idf) of a token's postings, or None if no SKU has it.
+    def postings(self, token):
+        index = self._find(token.encode(), self.token_count, self._token)
+        if index is None:
+            return None
+        return self.starts[index], self.starts[index + 1], self.idf[index]
+
+    # Name of the most relevant SKU for which available(name) is true, or None. Only SKUs whose name
+    # or description has every token of item_name are candidates; they are ranked by the idf-weighted
+    # tokens of the name and the description they share with the request.
+    def best_match(self, item_name, item_description="", available=None):
+        name_tokens = list(dict.fromkeys(tokenize(item_name)))
+        if not name_tokens:
+            return None
+        required = [self.postings(token) for token in name_tokens]
+        if any(posting is None for posting in required):
+            return None
+        optional = [self.postings(token) for token in dict.fromkeys(tokenize(item_description))
+                    if token not in name_tokens]
+        scoring = required + [posting for posting in optional if posting is not None]
+        exact = self._find(normalize_item(item_name).encode(), self.sku_count, lambda sku: self.name(sku).encode())
+        if np is not None:
+            ranked = self._rank_numpy(required, scoring, exact)
+        else:
+            ranked = self._rank_python(required, scoring, exact)
+        for sku in ranked:
+            name = self.name(sku)
+            if available is None or available(name):
+                return name
+        return None
+
+    # Candidates by descending score; the first ones are found without sorting them all.
+    def _rank_numpy(self, required, scoring, exact):
+        start, end, _ = min(required, key=lambda posting: posting[1] - posting[0])
+        candidates = self.np_ids[start:end]
+        for start, end, _ in required:
+            candidates = np.intersect1d(candidates, self.np_ids[start:end], assume_unique=True)
+        scores = np.zeros(len(candidates), dtype=np.float32)
+        for start, end, idf in scoring:
+            ids = self.np_ids[start:end]
+            positions = np.minimum(np.searchsorted(ids, candidates), len(ids) - 1)
+            scores += np.where(ids[positions] == candidates, self.np_weights[start:end][positions], 0) * idf
+        if exact is not None:
+            scores[candidates == exact] += EXACT_BONUS
+        while len(candidates):
+            best = int(np.argmax(scores))
+            if scores[best] == -np.inf:
+                return
+            yield int(candidates[best])
+            scores[best] = -np.inf
+
+    def _rank_python(self, required, scoring, exact):
+        start, end, _ = min(required, key=lambda posting: posting[1] - posting[0])
+        candidates = set(self.ids[start:end])
+        for start, end, _ in required:
+            if len(candidates) < 64:  # Probe a few candidates instead of building the posting set
+                candidates = {sku for sku in candidates if self._position(sku, start, end) is not None}
+            else:
+                candidates &= set(self.ids[start:end])
+        scores = {}
+        for sku in candidates:
+            score = EXACT_BONUS if sku == exact else 0.0
+            for start, end, idf in scoring:
+                position = self._position(sku, start, end)
+                if position is not None:
+                    score += self.weights[position] * idf
+            scores[sku] = score
+        yield from sorted(scores, key=lambda sku: (-scores[sku], sku))
+
+    def _position(self, sku, start, end):
+        position = bisect.bisect_left(self.ids, sku, start, end)
+        return position if position < end and self.ids[position] == sku else None
+
+    def close(self):
+        for name in ("name_offsets", "token_offsets", "starts", "ids", "weights", "idf", "view"):
+            getattr(self, name).release()
+        self.np_ids = self.np_weights = None
+        self.mm.close()
+
+
+# Synthetic catalog of `skus` item names with descriptions, for benchmarking.
+def synthetic_items(skus, seed=1):
+    rng = random.Random(seed)
+    words = [f"w{k}" for k in range(5000)]
+    kinds = [f"kind{k}" for k in range(max(1, skus // 50))]
+    items = []
+    for sku in range(skus):
+        kind = rng.choice(kinds)
+        items.append({"item_name": f"{kind}-{sku}", "item_description": " ".join(rng.sample(words, 12)),
+                      "price": round(rng.uniform(1, 100), 2), "reserved": False})
+    return items
+
+
+def benchmark(skus, queries, seed=1):
+    path = os.path.join(tempfile.mkdtemp(prefix="p2p-catalog-"), "catalog.bin")
+    items = synthetic_items(skus, seed)
+    started = time.perf_counter()
+    build_catalog(path, items)
+    build_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    engine = CatalogEngine(path)
+    load_seconds = time.perf_counter() - started
+
+    rng = random.Random(seed + 1)
+    timings, found = [], 0
+    for _ in range(queries):
+        item = rng.choice(items)
+        kind = item['item_name'].split("-")[0]
+        description = " ".join(rng.sample(item['item_description'].split(), 3))
+        started = time.perf_counter()
+        match = engine.best_match(kind, description)
+        timings.append(time.perf_counter() - started)
+        found += match == item['item_name']
+    timings.sort()
+    engine.close()
+    return {
+        "skus": skus, "queries": queries, "numpy": np is not None,
+        "file_bytes": os.path.getsize(path), "build_seconds": build_seconds, "load_seconds": load_seconds,
+        "query_us": {"p50": 1e6 * timings[len(timings) // 2], "p99": 1e6 * timings[int(len(timings) * 0.99)],
+                     "max": 1e6 * timings[-1]},
+        "best_match_is_source": found / queries,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build, query and benchmark peer catalog index files")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="Index an inventory file (e.g. Peer1_inventory.json)")
+    build.add_argument("inventory", help="Inventory JSON file")
+    build.add_argument("--output", help="Catalog file (default: <peer>_catalog.bin next to the inventory)")
+    search = commands.add_parser("search", help="Best match of a request in a catalog file")
+    search.add_argument("catalog", help="Catalog file")
+    search.add_argument("item_name")
+    search.add_argument("item_description", nargs="?", default="")
+    bench = commands.add_parser("bench", help="Time build, load and queries on a synthetic catalog")
+    bench.add_argument("--skus", type=int, default=200000, help="Distinct item names")
+    bench.add_argument("--queries", type=int, default=1000, help="Queries timed")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        with open(args.inventory, "r") as file:
+            items = json.load(file)
+        output = args.output or args.inventory.replace("_inventory.json", "_catalog.bin")
+        if output == args.inventory:
+            sys.exit("Give the catalog file with --output")
+        skus, tokens = build_catalog(output, items)
+        print(f"Indexed {skus} item(s) and {tokens} token(s) into {output}")
+    elif args.command == "search":
+        engine = CatalogEngine(args.catalog)
+        started = time.perf_counter()
+        match = engine.best_match(args.item_name, args.item_description)
+        print(f"{match} ({1e6 * (time.perf_counter() - started):.0f} us)")
+    else:
+        print(json.dumps(benchmark(args.skus, args.queries), indent=2))
@@ -0,0 +1,94 @@
+# catalog_index.py
+import threading
+
+
+def normalize_item(item_name):
+    return item_name.strip().lower()
+
+
+# Server-side inverted index from normalized item name to the sellers that have it in stock,
+# with each seller's price floor (cheapest unreserved unit). Peers push their catalog with
+# CATALOG messages when they register and send deltas whenever their stock changes.
+# Every CATALOG message carries a per-peer sequence number so that datagrams arriving out of
+# order (e.g. after a retransmission) never overwrite newer information.
+class CatalogIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sellers_by_item = {}  # item -> {seller name: price floor}
+        self.items_by_seller = {}  # seller name -> set of items, present once the seller pushed a catalog
+        self.full_seq = {}  # seller name -> sequence number of the latest full push
+        self.item_seq = {}  # (seller name, item) -> sequence number of the latest update of that item
+
+    # Replace everything known about a seller (first chunk of a full catalog push).
+    def replace(self, seller, entries, seq=0):
+        with self.lock:
+            if seq < self.full_seq.get(seller, -1):
+                return
+            self.full_seq[seller] = seq
+            items = self.items_by_seller.setdefault(seller, set())
+            # Items missing from the push are gone, unless a newer delta mentioned them
+            for item in list(items):
+                if self.item_seq.get((seller, item), -1) < seq:
+                    self._set(seller, item, None, seq)
+            for item_name, floor in entries:
+                self._set(seller, normalize_item(item_name), floor, seq)
+
+    # Apply catalog deltas; a floor of None removes the item from the seller's catalog.
+    def update(self, seller, entries, seq=0):
+        with self.lock:
+            if seq < self.full_seq.get(seller, -1):
+                return
+            self.items_by_seller.setdefault(seller, set())
+            for item_name, floor in entries:
+                self._set(seller, normalize_item(item_name), floor, seq)
+
+    def remove_seller(self, seller):
+        with self.lock:
+            self._drop_seller(seller)
+            self.full_seq.pop(seller, None)
+
+    # {seller name: price floor} for every seller that has the item in stock.
+    def sellers_for(self, item_name):
+        with self.lock:
+            return dict(self.sellers_by_item.get(normalize_item(item_name), {}))
+
+    # {item: price floor} of everything the seller has in stock.
+    def floors_of(self, seller):
+        with self.lock:
+            return {item: self.sellers_by_item[item][seller] for item in self.items_by_seller.get(seller, ())}
+
+    def has_catalog(self, seller):
+        return seller in self.items_by_seller
+
+    def _set(self, seller, item, floor, seq):
+        if seq < self.item_seq.get((seller, item), -1):
+            return
+        self.item_seq[(seller, item)] = seq
+        if floor is None:
+            sellers = self.sellers_by_item.get(item)
+            if sellers is not None:
+                sellers.pop(seller, None)
+                if not sellers:
+                    del self.sellers_by_item[item]
+            self.items_by_seller[seller].discard(item)
+        else:
+            self.sellers_by_item.setdefault(item, {})[seller] = floor
+            self.items_by_seller[seller].add(item)
+
+    def _drop_seller(self, seller):
+        for item in self.items_by_seller.pop(seller, ()):
+            self.item_seq.pop((seller, item), None)
+            sellers = self.sellers_by_item.get(item)
+            if sellers is not None:
+                sellers.pop(seller, None)
+                if not sellers:
+                    del self.sellers_by_item[item]
+
+
+# Parse the "<item> <floor> ..." pairs of a CATALOG message; "-" as floor means out of stock.
+def parse_catalog_entries(fields):
+    entries = []
+    for i in range(0, len(fields) - 1, 2):
+        floor = None if fields[i + 1] == "-" else float(fields[i + 1])
+        entries.append((fields[i], floor))
+    return entries
@@ -0,0 +1,217 @@
+# cluster.py
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+import wire
+from catalog_index import normalize_item
+
+# Workers of a multi-worker server exchange packets over Unix datagram sockets (reliable and
+# ordered on one host): a kind, the IPv4 address the datagram came from, then the payload.
+PACKET_HEADER = struct.Struct("!c4sH")
+FORWARD = b"F"  # A datagram that reached a worker other than its owner
+REPLICATE = b"R"  # A change of the replicated peer registry, as JSON [kind, args]
+PACKET_BYTES = 65536 + PACKET_HEADER.size
+# Messages that change the registry are owned by the worker of the peer's name, so a name is only
+# ever claimed by one worker and the others receive its changes in order.
+NAME_KEYED = {"REGISTER", "DE-REGISTER", "CATALOG"}
+# A LOOKING_FOR and every later message of the request are owned by the worker of the item, so all
+# bids on an item and every match or reservation of its asks happen in one worker's order book, and a
+# seller's unit is never reserved by two workers. The position of the item among the message's fields:
+ITEM_FIELD = {"LOOKING_FOR": 1, "OFFER": 1, "NO_OFFER": 1, "ACCEPT": 0, "REFUSE": 0, "BUY": 0, "CANCEL": 0}
+LOCAL_MESSAGES = {"STATS"}  # Answered by whichever worker receives it, about itself
+STARTUP_TIMEOUT = 10  # Seconds for every worker to open its IPC socket
+SEND_QUEUE_LIMIT = 10000  # IPC packets waiting for the sender thread; more are dropped
+STOP_TIMEOUT = 10  # Seconds for every worker to flush its state store and exit before it is killed
+
+
+def socket_path(socket_dir, index):
+    return os.path.join(socket_dir, f"worker{index}.sock")
+
+
+# Per-worker variant of a file name: server.json -> server.w2.json
+def worker_file(path, index):
+    base, ext = os.path.splitext(path)
+    return f"{base}.w{index}{ext}"
+
+
+# Worker owning a datagram, None for a datagram every worker handles (ACKs, which name neither a
+# peer nor an item: each worker checks them against its own retransmissions).
+# Datagrams that cannot be parsed are owned by the worker that received them, which logs them.
+def owner_of(data, workers, receiver):
+    try:
+        if wire.is_binary(data):
+            msg_type, rq_id, fields = wire.decode(data)
+        else:
+            tokens = data.decode().split()
+            msg_type, rq_number, fields = tokens[0], tokens[1], tokens[2:]
+            rq_id = None
+    except (wire.WireError, UnicodeDecodeError, IndexError):
+        return receiver
+    if msg_type in LOCAL_MESSAGES:
+        return receiver
+    if msg_type == "ACK":
+        return None
+    if msg_type in NAME_KEYED and fields:
+        return zlib.crc32(fields[0].encode()) % workers
+    if msg_type in ITEM_FIELD and len(fields) > ITEM_FIELD[msg_type]:
+        return zlib.crc32(normalize_item(fields[ITEM_FIELD[msg_type]]).encode()) % workers
+    if rq_id is None:
+        rq_id = wire.rq_id_from_number(rq_number)
+    return rq_id % workers
+
+
+# One worker's end of the cluster: decides which worker owns each received datagram, forwards the
+# ones it does not own to their owner, and sends and applies the peer registry changes every worker
+# needs (REGISTER, DE-REGISTER and CATALOG), so that any worker can route a SEARCH.
+class WorkerRouter:
+    def __init__(self, index, workers, socket_dir):
+        self.index = index
+        self.workers = workers
+        self.socket_dir = socket_dir
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(socket_path(socket_dir, index))
+        self.server = None
+        self.listener = None
+        # Packets are sent from a thread of their own, so a sibling with a full socket buffer never
+        # stalls the threads that receive datagrams
+        self.outbox = queue.Queue(maxsize=SEND_QUEUE_LIMIT)
+        self.sender = threading.Thread(target=self.send_loop, name=f"worker{index}-ipc-send", daemon=True)
+        self.sender.start()
+
+    # Start taking forwarded datagrams and registry changes for `server`.
+    def attach(self, server):
+        self.server = server
+        self.listener = threading.Thread(target=self.listen, name=f"worker{self.index}-ipc", daemon=True)
+        self.listener.start()
+
+    # Called for every datagram the worker receives. Returns True if this worker handles it.
+    def route(self, data, addr):
+        owner = owner_of(data, self.workers, self.index)
+        if owner == self.index:
+            return True
+        msg_type = wire.message_type(data) or "?"
+        targets = [owner] if owner is not None else [i for i in range(self.workers) if i != self.index]
+        for target in targets:
+            self.send(target, FORWARD, addr, data)
+        self.server.metrics.inc("forwarded_total", type=msg_type)
+        return owner is None
+
+    # Send a registry change to every other worker; they apply it with Server.apply_replicated.
+    def replicate(self, kind, *args):
+        payload = json.dumps([kind, args]).encode()
+        for target in range(self.workers):
+            if target != self.index:
+                self.send(target, REPLICATE, ("0.0.0.0", 0), payload)
+
+    # Queue a packet for another worker. Never blocks: if the sender thread is that far behind, the
+    # packet is dropped and counted (forwarded datagrams are retransmitted by reliable peers).
+    def send(self, target, kind, addr, payload):
+        packet = PACKET_HEADER.pack(kind, socket.inet_aton(addr[0]), addr[1]) + payload
+        try:
+            self.outbox.put_nowait((target, packet))
+        except queue.Full:
+            if self.server is not None:
+                self.server.metrics.inc("ipc_dropped_total", kind=kind.decode())
+            logging.warning(f"Worker {self.index} dropped a packet for worker {target}: send queue full")
+
+    def send_loop(self):
+        while True:
+            item = self.outbox.get()
+            if item is None:
+                return
+            target, packet = item
+            try:
+                self.socket.sendto(packet, socket_path(self.socket_dir, target))
+            except OSError as e:
+                logging.warning(f"Worker {self.index} could not reach worker {target}: {e}")
+
+    # Forwarded datagrams are handled like received ones. Registry changes are applied on this
+    # thread, one at a time, so they take effect in the order the owner made them.
+    def listen(self):
+        while True:
+            try:
+                packet = self.socket.recv(PACKET_BYTES)
+            except OSError:
+                return  # Socket closed
+            kind, ip, port = PACKET_HEADER.unpack_from(packet)
+            payload = packet[PACKET_HEADER.size:]
+            try:
+                if kind == FORWARD:
+                    self.server.dispatch(payload, (socket.inet_ntoa(ip), port))
+                elif kind == REPLICATE:
+                    change, args = json.loads(payload)
+                    self.server.apply_replicated(change, args)
+            except Exception as e:
+                logging.error(f"Worker {self.index} failed to handle an IPC packet: {e}")
+
+    def close(self):
+        try:
+            self.outbox.put_nowait(None)
+        except queue.Full:
+            pass
+        self.sender.join(timeout=1)
+        self.socket.close()
+        try:
+            os.remove(socket_path(self.socket_dir, self.index))
+        except OSError:
+            pass
+
+
+# Worker processes of one server, started by start_workers.
+class WorkerPool:
+    def __init__(self, processes, socket_dir):
+        self.processes = processes
+        self.socket_dir = socket_dir
+
+    # Block until every worker has exited; Ctrl+C stops them.
+    def wait(self):
+        try:
+            for process in self.processes:
+                process.join()
+        except KeyboardInterrupt:
+            pass
+        self.stop()
+
+    def stop(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()  # Workers flush their state store on SIGTERM
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for process in self.processes:
+            process.join(max(0, deadline - time.monotonic()))
+        for process in self.processes:
+            if process.is_alive():
+                logging.warning(f"{process.name} did not stop within {STOP_TIMEOUT} seconds, killing it")
+                process.kill()
+                process.join()
+        shutil.rmtree(self.socket_dir, ignore_errors=True)
+
+
+# Start `workers` processes running target(index, workers, socket_dir, **options), each binding the
+# server's UDP port with SO_REUSEPORT, and wait until all of them can take IPC packets.
+def start_workers(target, workers, **options):
+    socket_dir = tempfile.mkdtemp(prefix="p2p-workers-")
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=target, args=(index, workers, socket_dir), kwargs=options,
+                                 name=f"server-worker-{index}", daemon=True)
+                 for index in range(workers)]
+    for process in processes:
+        process.start()
+    pool = WorkerPool(processes, socket_dir)
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while not all(os.path.exists(socket_path(socket_dir, index)) for index in range(workers)):
+        if time.monotonic() > deadline or not all(process.is_alive() for process in processes):
+            pool.stop()
+            raise RuntimeError(f"Server workers did not start within {STARTUP_TIMEOUT} seconds")
+        time.sleep(0.05)
+    return pool
@@ -0,0 +1,271 @@
+# federation.py
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+from tcp_pool import ChannelClosed
+
+# Messages between sibling servers. They are plain text, start with the rq_number they concern, and
+# are neither acknowledged nor deduplicated like peer messages.
+#   FED_SEARCH <rq_number> <origin> <item_name> <max_price> <item_description>   search the sibling's sellers too
+#   FED_RELAY <rq_number> <seller_name> <ip>:<port> <message>                    message to or from a seller of the sibling
+#   FED_DONE <rq_number> <server_name>                                           every seller of the sibling answered
+#   FED_TCP <rq_number> <seller_name> REQ|SEND <message>                         transaction leg with a seller of the sibling
+#   FED_TCP_RES <rq_number> OK|FAIL <message>                                    its INFORM_Res, or why it failed
+FEDERATION_MESSAGES = {"FED_SEARCH", "FED_RELAY", "FED_DONE", "FED_TCP", "FED_TCP_RES"}
+SELLER_MESSAGES = {"OFFER", "NO_OFFER", "ACCEPT", "REFUSE"}  # Relayed from a sibling's seller to the buyer's server
+SERVER_MESSAGES = {"SEARCH", "NEGOTIATE", "RESERVE", "CANCEL"}  # Relayed from the buyer's server to a sibling's seller
+FEDERATION_TTL = 600  # Seconds a sibling's search is remembered, for its offers, negotiation and purchase
+REPLY_TIMEOUT = 300  # Seconds to wait for the INFORM_Res of a seller on a sibling, as for a local seller
+
+
+# Parse "east=127.0.0.1:3001,west=127.0.0.1:3002" into {name: (ip, port)}.
+def parse_siblings(text):
+    siblings = {}
+    for part in (text or "").split(","):
+        if not part.strip():
+            continue
+        name, _, address = part.partition("=")
+        ip, _, port = address.rpartition(":")
+        siblings[name.strip()] = (ip, int(port))
+    return siblings
+
+
+def format_address(address):
+    return f"{address[0]}:{address[1]}"
+
+
+def parse_address(text):
+    ip, _, port = text.rpartition(":")
+    return ip, int(port)
+
+
+# Stands in for the TCP channel to a seller registered on a sibling server: the sibling runs the
+# seller's leg of the transaction over its own channel and sends the INFORM_Res back.
+class RemoteChannel:
+    def __init__(self, federation, sibling, seller_name):
+        self.federation = federation
+        self.sibling = sibling
+        self.seller_name = seller_name
+
+    def request(self, message, rq_number):
+        future = self.federation.expect_reply(rq_number)
+        self.federation.send(f"FED_TCP {rq_number} {self.seller_name} REQ {message}", self.sibling)
+        return future
+
+    def forget(self, rq_number):
+        self.federation.forget_reply(rq_number)
+
+    def send(self, message):
+        rq_number = message.split()[1]
+        self.federation.send(f"FED_TCP {rq_number} {self.seller_name} SEND {message}", self.sibling)
+
+
+# One server's link to its siblings. Every server owns the peers registered with it; a LOOKING_FOR
+# is also searched for on every sibling, whose sellers' offers join the local offer window, and
+# NEGOTIATE, RESERVE, CANCEL and the BUY transaction reach a remote seller through its own server.
+# Remote sellers are known by their real address, so the request handlers work unchanged: the server
+# hands every message for such an address to relay().
+class Federation:
+    def __init__(self, name, siblings):
+        self.name = name
+        self.siblings = dict(siblings)  # name -> (ip, port)
+        self.sibling_names = {tuple(address): sibling for sibling, address in self.siblings.items()}
+        self.server = None
+        self.lock = threading.Lock()
+        # Address of a seller on a sibling -> (sibling address, seller name, expiry time); an entry is
+        # dropped FEDERATION_TTL seconds after the last message the seller's server relayed for it
+        self.remote_peers = {}
+        # Searches of siblings run on this server: rq_number -> {'origin': address, 'sellers': {address: name},
+        # 'answered': set of names, 'done': bool}
+        self.remote_searches = {}
+        self.replies = {}  # rq_number -> Future of an INFORM_Res relayed by a sibling
+
+    def attach(self, server):
+        self.server = server
+
+    # Names the buyer's server waits for in a request's targets, one per sibling.
+    def search_names(self):
+        return [f"@{sibling}" for sibling in self.siblings]
+
+    def send(self, message, address):
+        self.server.send_raw(message.encode(), tuple(address))
+        logging.info(f"Federation message to {self.sibling_names.get(tuple(address), address)}: {message}")
+
+    def forward_search(self, rq_number, item_name, item_description, max_price):
+        for address in self.siblings.values():
+            self.send(f"FED_SEARCH {rq_number} {self.name} {item_name} {max_price} {item_description}", address)
+
+    # Send a message meant for a seller of a sibling through that sibling. Returns False if the
+    # address is not a remote seller.
+    def relay(self, message, address):
+        with self.lock:
+            remote = self.remote_peers.get(tuple(address))
+        if remote is None:
+            return False
+        sibling, seller_name, _ = remote
+        rq_number = message.split()[1]
+        self.send(f"FED_RELAY {rq_number} {seller_name} {format_address(address)} {message}", sibling)
+        return True
+
+    # Channel for the transaction leg with a seller of a sibling, None if the address is not one.
+    def channel(self, address):
+        with self.lock:
+            remote = self.remote_peers.get(tuple(address))
+        return RemoteChannel(self, remote[0], remote[1]) if remote is not None else None
+
+    def expect_reply(self, rq_number):
+        future = Future()
+        with self.lock:
+            self.replies[rq_number] = future
+
+        def expire():
+            with self.lock:
+                expired = self.replies.pop(rq_number, None)
+            if expired is not None and not expired.done():
+                expired.set_exception(TimeoutError(f"No INFORM_Res relayed for RQ# {rq_number}"))
+        self.server.timers.schedule(REPLY_TIMEOUT, expire, key=(rq_number, "federated-reply"))
+        return future
+
+    def forget_reply(self, rq_number):
+        with self.lock:
+            self.replies.pop(rq_number, None)
+        self.server.timers.cancel((rq_number, "federated-reply"))
+
+    # A message from a seller registered here, for a search a sibling forwarded: relay it to the
+    # buyer's server. Returns False if the message is not about such a search.
+    def relay_from_seller(self, message_parts, addr):
+        if message_parts[0] not in SELLER_MESSAGES:
+            return False
+        rq_number = message_parts[1]
+        with self.lock:
+            search = self.remote_searches.get(rq_number)
+            if search is None:
+                return False
+            seller_name = search['sellers'].get(tuple(addr))
+            if seller_name is None:
+                return False
+            if message_parts[0] in ("OFFER", "NO_OFFER"):
+                search['answered'].add(seller_name)
+            finished = not search['done'] and search['answered'] >= set(search['sellers'].values())
+            search['done'] = search['done'] or finished
+        message = " ".join(message_parts)
+        self.send(f"FED_RELAY {rq_number} {seller_name} {format_address(addr)} {message}", search['origin'])
+        if finished:
+            self.send(f"FED_DONE {rq_number} {self.name}", search['origin'])
+        return True
+
+    def handle(self, message_parts, addr):
+        if tuple(addr) not in self.sibling_names:
+            logging.warning(f"Ignored {message_parts[0]} from {addr}, which is not a sibling server")
+            return
+        msg_type = message_parts[0]
+        if msg_type == "FED_SEARCH":
+            self.handle_search(message_parts, addr)
+        elif msg_type == "FED_RELAY":
+            self.handle_relay(message_parts, addr)
+        elif msg_type == "FED_DONE":
+            self.server.handle_no_offer(["NO_OFFER", message_parts[1], f"@{message_parts[2]}"], addr)
+        elif msg_type == "FED_TCP":
+            self.handle_tcp(message_parts, addr)
+        elif msg_type == "FED_TCP_RES":
+            with self.lock:
+                future = self.replies.pop(message_parts[1], None)
+            self.server.timers.cancel((message_parts[1], "federated-reply"))
+            if future is None:
+                logging.warning(f"Unexpected FED_TCP_RES for RQ# {message_parts[1]}")
+            elif message_parts[2] == "OK":
+                future.set_result(" ".join(message_parts[3:]))
+            else:
+                future.set_exception(ChannelClosed(" ".join(message_parts[3:])))
+
+    # Search this server's sellers for a sibling's buyer. Buyers are not registered here, so no
+    # seller is left out.
+    def handle_search(self, message_parts, addr):
+        rq_number, item_name, max_price = message_parts[1], message_parts[3], message_parts[4]
+        item_description = " ".join(message_parts[5:])
+        targets = self.server.search_targets(None, item_name)
+        with self.lock:
+            self.remote_searches[rq_number] = {
+                'origin': tuple(addr),
+                'sellers': {tuple(peer_info['address']): peer_name for peer_name, peer_info in targets},
+                'answered': set(),
+                'done': not targets,
+            }
+        self.server.timers.schedule(FEDERATION_TTL, lambda: self.forget(rq_number), key=(rq_number, "federated"))
+        if not targets:
+            self.send(f"FED_DONE {rq_number} {self.name}", addr)
+        for peer_name, peer_info in targets:
+            search_msg = self.server.search_message(rq_number, item_name, item_description, max_price, peer_info)
+            self.server.send_udp_response(search_msg, tuple(peer_info['address']))
+        logging.info(f"FED_SEARCH from {self.sibling_names[tuple(addr)]} for '{item_name}' sent to {len(targets)} seller(s)")
+
+    def forget(self, rq_number):
+        with self.lock:
+            self.remote_searches.pop(rq_number, None)
+
+    # Remember through which sibling a remote seller is reached, until FEDERATION_TTL seconds after
+    # its last relayed message.
+    def remember_peer(self, seller_address, sibling, seller_name):
+        with self.lock:
+            self.remote_peers[seller_address] = (sibling, seller_name, time.monotonic() + FEDERATION_TTL)
+        self.server.timers.schedule(FEDERATION_TTL, lambda: self.forget_peer(seller_address),
+                                    key=(seller_address, "remote-peer"))
+
+    def forget_peer(self, seller_address):
+        with self.lock:
+            remote = self.remote_peers.get(seller_address)
+            if remote is not None and remote[2] <= time.monotonic():  # Not refreshed meanwhile
+                del self.remote_peers[seller_address]
+
+    # From the buyer's server: a message for one of our sellers. From a seller's server: a message of
+    # one of its sellers, handled as if the seller had sent it here.
+    def handle_relay(self, message_parts, addr):
+        seller_name, seller_address = message_parts[2], parse_address(message_parts[3])
+        inner = message_parts[4:]
+        if inner[0] in SERVER_MESSAGES:
+            peer_info = self.server.registered_peers.get(seller_name)
+            if peer_info is None:
+                logging.warning(f"Relayed {inner[0]} for unknown seller {seller_name}")
+                return
+            self.server.send_udp_response(" ".join(inner), tuple(peer_info['address']))
+        elif inner[0] in SELLER_MESSAGES:
+            self.remember_peer(seller_address, tuple(addr), seller_name)
+            if inner[0] == "OFFER":
+                self.server.handle_offer(inner, seller_address)
+            elif inner[0] == "NO_OFFER":
+                self.server.handle_no_offer(inner, seller_address)
+            else:
+                self.server.handle_seller_response(inner, seller_address)
+        else:
+            logging.warning(f"Unexpected relayed message {inner[0]} from {addr}")
+
+    # Run the transaction leg of one of our sellers for a sibling's BUY.
+    def handle_tcp(self, message_parts, addr):
+        rq_number, seller_name, action = message_parts[1], message_parts[2], message_parts[3]
+        message = " ".join(message_parts[4:])
+        peer_info = self.server.registered_peers.get(seller_name)
+        try:
+            if peer_info is None:
+                raise ChannelClosed(f"Seller {seller_name} is not registered")
+            channel = self.server.tcp_pool.get((peer_info['address'][0], int(peer_info['tcp_socket'])))
+            if action == "SEND":
+                channel.send(message)
+                return
+            reply = channel.request(message, rq_number)
+        except (OSError, ChannelClosed) as e:
+            if action == "REQ":
+                self.send(f"FED_TCP_RES {rq_number} FAIL {e}", addr)
+            logging.error(f"Relayed transaction leg with {seller_name} failed: {e}")
+            return
+        # The sibling gives up on the reply after REPLY_TIMEOUT, and so does the channel
+        self.server.timers.schedule(REPLY_TIMEOUT, lambda: channel.forget(rq_number), key=(rq_number, "relayed-leg"))
+
+        def answer(future):
+            self.server.timers.cancel((rq_number, "relayed-leg"))
+            try:
+                self.send(f"FED_TCP_RES {rq_number} OK {future.result()}", addr)
+            except Exception as e:
+                self.send(f"FED_TCP_RES {rq_number} FAIL {e}", addr)
+        reply.add_done_callback(answer)
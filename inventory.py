@@ -0,0 +1,172 @@
+# inventory.py
+import bisect
+import json
+import os
+import threading
+
+from catalog_index import normalize_item
+
+
+# In-memory inventory of a peer, indexed by normalized item name and split into available and
+# reserved units, so lookups never touch the disk. Available units are kept sorted by price (units
+# of the same price in insertion order), so the cheapest one is offered and reserved first. Changes
+# only mark the store dirty; a background thread writes the whole inventory file at most once every
+# `flush_interval` seconds. Without `background`, the owner calls flush_if_dirty() itself (a
+# PeerHost does for all its peers).
+class InventoryStore:
+    def __init__(self, path, flush_interval=0.5, background=True):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.lock = threading.RLock()
+        self.file_lock = threading.Lock()
+        self.items = []  # Every unit in insertion order, as stored in the file
+        self.index = {}  # item -> {"available": [units by price], "prices": [their prices], "reserved": [units]}
+        self.holders = {}  # rq_number -> unit reserved for that request, also stored in the unit as reserved_for
+        self.dirty = False
+        self.flush_condition = threading.Condition()
+        self.running = True
+        self.stopped = threading.Event()
+        self.created = not os.path.exists(path)
+        self.load()
+        self.flusher = None
+        if background:
+            self.flusher = threading.Thread(target=self.flush_loop, daemon=True)
+            self.flusher.start()
+
+    def load(self):
+        if self.created:
+            items = []
+        else:
+            with open(self.path, "r") as file:
+                items = json.load(file)
+        with self.lock:
+            self.items = []
+            self.index = {}
+            self.holders = {}
+            for item in items:
+                self._insert({**item, "reserved": item.get("reserved", False)})
+        self.flush()  # Create the file, or store the default reserved flags
+
+    def _insert(self, item):
+        self.items.append(item)
+        partitions = self.index.setdefault(normalize_item(item['item_name']),
+                                           {"available": [], "prices": [], "reserved": []})
+        if item['reserved']:
+            partitions["reserved"].append(item)
+            if item.get('reserved_for') is not None:
+                self.holders[item['reserved_for']] = item
+        else:
+            self._make_available(partitions, item)
+
+    def _make_available(self, partitions, item):
+        price = float(item['price'])
+        position = bisect.bisect_right(partitions["prices"], price)
+        partitions["prices"].insert(position, price)
+        partitions["available"].insert(position, item)
+
+    def add(self, item):
+        with self.lock:
+            self._insert({**item, "reserved": item.get("reserved", False)})
+            self.mark_dirty()
+
+    # Cheapest unreserved unit of the item, or None. With max_price, None as well if even the
+    # cheapest unit costs more.
+    def find_available(self, item_name, max_price=None):
+        with self.lock:
+            partitions = self.index.get(normalize_item(item_name))
+            if self._in_stock(partitions, max_price):
+                return dict(partitions["available"][0])
+            return None
+
+    def has_available(self, item_name, max_price=None):
+        with self.lock:
+            return self._in_stock(self.index.get(normalize_item(item_name)), max_price)
+
+    def _in_stock(self, partitions, max_price):
+        if not partitions or not partitions["prices"]:
+            return False
+        return max_price is None or partitions["prices"][0] <= max_price
+
+    # Reserve one available unit for a request, or release the unit reserved for it. A request holds
+    # at most one unit, and releasing never touches the units of other requests. Returns False if the
+    # item is unknown.
+    def set_reserved(self, item_name, reserved, rq_number):
+        with self.lock:
+            partitions = self.index.get(normalize_item(item_name))
+            if partitions is None:
+                return False
+            if reserved and partitions["available"] and rq_number not in self.holders:
+                partitions["prices"].pop(0)
+                item = partitions["available"].pop(0)
+                item['reserved'] = True
+                item['reserved_for'] = rq_number
+                partitions["reserved"].append(item)
+                self.holders[rq_number] = item
+                self.mark_dirty()
+            elif not reserved and rq_number in self.holders:
+                item = self.holders.pop(rq_number)
+                owner = self.index[normalize_item(item['item_name'])]
+                owner["reserved"].remove(item)
+                item['reserved'] = False
+                del item['reserved_for']
+                self._make_available(owner, item)
+                self.mark_dirty()
+            return True
+
+    # Cheapest available price of every item in stock, keyed by normalized item name.
+    def floors(self):
+        with self.lock:
+            return {name: partitions["prices"][0] for name, partitions in self.index.items() if partitions["prices"]}
+
+    def floor(self, item_name):
+        with self.lock:
+            partitions = self.index.get(normalize_item(item_name))
+            if not partitions or not partitions["prices"]:
+                return None
+            return partitions["prices"][0]
+
+    # Copy of every unit, in file order.
+    def snapshot(self):
+        with self.lock:
+            return [dict(item) for item in self.items]
+
+    def mark_dirty(self):
+        with self.flush_condition:
+            self.dirty = True
+            self.flush_condition.notify()
+
+    def flush_loop(self):
+        while self.running:
+            with self.flush_condition:
+                while not self.dirty and self.running:
+                    self.flush_condition.wait()
+            if not self.running:
+                break
+            self.flush()
+            # Coalesce the changes of the next interval into a single write
+            self.stopped.wait(self.flush_interval)
+
+    # Write the whole inventory file now.
+    def flush(self):
+        with self.file_lock:  # Keeps concurrent flushes from writing an older copy last
+            with self.lock:
+                with self.flush_condition:
+                    self.dirty = False
+                data = json.dumps(self.items, indent=4)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as file:
+                file.write(data)
+            os.replace(tmp_path, self.path)
+
+    def flush_if_dirty(self):
+        if self.dirty:
+            self.flush()
+
+    def close(self):
+        with self.flush_condition:
+            self.running = False
+            self.flush_condition.notify()
+        self.stopped.set()
+        if self.flusher is not None:
+            self.flusher.join(timeout=2)
+        self.flush()
@@ -0,0 +1,202 @@
+# journal.py
+import json
+import os
+import shutil
+import threading
+import time
+
+FSYNC_POLICIES = ("always", "interval", "never")
+
+# Record opcodes. Upper case stores a full value for the key, lower case deletes the key.
+PUT_PEER = "P"
+DEL_PEER = "p"
+PUT_REQUEST = "R"
+DEL_REQUEST = "r"
+
+
+# Apply a single journal record to the in-memory state dicts.
+def apply_record(record, registered_peers, active_requests):
+    op, key = record[0], record[1]
+    if op == PUT_PEER:
+        registered_peers[key] = record[2]
+    elif op == DEL_PEER:
+        registered_peers.pop(key, None)
+    elif op == PUT_REQUEST:
+        active_requests[key] = record[2]
+    elif op == DEL_REQUEST:
+        active_requests.pop(key, None)
+
+
+# Append-only write-ahead journal for the server state.
+# Every state change is one compact JSON line. Records are buffered by the callers and written by a
+# single writer thread (group commit), which fsyncs according to the configured policy:
+#   always   - fsync after every batch that is written
+#   interval - fsync at most once every `fsync_interval` seconds
+#   never    - leave flushing to the operating system
+# Once `compact_every` records have been written since the last snapshot, `on_compact` is called on a
+# background thread so the owner can write a new snapshot and truncate the journal.
+class Journal:
+    def __init__(self, path, fsync_policy="interval", fsync_interval=0.05, compact_every=5000, on_compact=None):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy '{fsync_policy}', expected one of {FSYNC_POLICIES}")
+        self.path = path
+        self.old_path = f"{path}.old"  # Segment being folded into a snapshot by an in-progress compaction
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self.compact_every = compact_every
+        self.on_compact = on_compact
+
+        self.pending = []  # Serialized records not yet handed to the writer
+        self.pending_lock = threading.Condition()
+        self.io_lock = threading.Lock()  # Held by whoever writes to or swaps the journal file
+        self.file = None
+        self.writer_thread = None
+        self.running = False
+        self.dirty = False  # Data written but not yet fsynced
+        self.last_sync = time.monotonic()
+        self.records_since_snapshot = 0
+        self.compacting = False
+        self.valid_lengths = {}  # Segment -> bytes of whole records found by replay, see open()
+
+    # Replay the journal segments into the given state dicts and return the number of records applied.
+    # A segment left behind by an interrupted compaction is replayed first; records carry full values,
+    # so replaying them over a newer snapshot is harmless.
+    def replay(self, registered_peers, active_requests):
+        applied = 0
+        for segment in (self.old_path, self.path):
+            if not os.path.exists(segment):
+                continue
+            valid_length = 0
+            with open(segment, "rb") as file:
+                for line in file:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("Record without its newline")
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # Torn write at the tail of the segment, nothing valid follows it
+                    apply_record(record, registered_peers, active_requests)
+                    applied += 1
+                    valid_length += len(line)
+            self.valid_lengths[segment] = valid_length
+        self.records_since_snapshot = applied
+        return applied
+
+    # Open the journal for appending and start the writer thread. A torn tail found by replay is cut
+    # off first: records appended after it would never be replayed.
+    def open(self):
+        for segment, valid_length in self.valid_lengths.items():
+            if os.path.exists(segment) and os.path.getsize(segment) > valid_length:
+                os.truncate(segment, valid_length)
+        self.file = open(self.path, "a")
+        self.running = True
+        self.writer_thread = threading.Thread(target=self.writer_loop, daemon=True)
+        self.writer_thread.start()
+
+    # Queue one record. Never touches the disk, so it is safe to call while holding state locks.
+    def append(self, op, key, value=None):
+        record = [op, key] if value is None else [op, key, value]
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self.pending_lock:
+            self.pending.append(line)
+            self.records_since_snapshot += 1
+            self.pending_lock.notify()
+
+    def writer_loop(self):
+        while True:
+            with self.pending_lock:
+                if not self.pending and self.running:
+                    self.pending_lock.wait(self.fsync_interval)
+                running = self.running
+            with self.io_lock:
+                with self.pending_lock:
+                    batch = self.pending
+                    self.pending = []
+                if batch:
+                    self.write_batch(batch)
+                self.sync_if_due()
+            if not running and not batch:
+                break
+            self.maybe_compact()
+
+    # Must be called with io_lock held.
+    def write_batch(self, batch):
+        self.file.write("".join(batch))
+        self.file.flush()
+        self.dirty = True
+        if self.fsync_policy == "always":
+            os.fsync(self.file.fileno())
+            self.dirty = False
+            self.last_sync = time.monotonic()
+
+    # Must be called with io_lock held.
+    def sync_if_due(self):
+        if not self.dirty or self.fsync_policy != "interval":
+            return
+        now = time.monotonic()
+        if now - self.last_sync >= self.fsync_interval:
+            os.fsync(self.file.fileno())
+            self.dirty = False
+            self.last_sync = now
+
+    def maybe_compact(self):
+        if self.on_compact is None or self.compacting or self.records_since_snapshot < self.compact_every:
+            return
+        self.compacting = True
+        threading.Thread(target=self.run_compaction, daemon=True).start()
+
+    def run_compaction(self):
+        try:
+            self.on_compact()
+        finally:
+            self.compacting = False
+
+    # Seal the current segment and start a new one. The caller must hold the lock protecting the state
+    # it is about to snapshot, so that every record in the sealed segment is reflected in that snapshot.
+    def rotate(self):
+        with self.io_lock:
+            with self.pending_lock:
+                batch = self.pending
+                self.pending = []
+                self.records_since_snapshot = 0
+            if batch:
+                self.file.write("".join(batch))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            if os.path.exists(self.old_path):
+                # An earlier compaction did not get to write its snapshot: the sealed segment still
+                # holds records no snapshot has, so add to it instead of replacing it
+                with open(self.path, "rb") as current, open(self.old_path, "ab") as old:
+                    shutil.copyfileobj(current, old)
+                    old.flush()
+                    os.fsync(old.fileno())
+                os.remove(self.path)
+            else:
+                os.replace(self.path, self.old_path)
+            self.file = open(self.path, "a")
+            self.dirty = False
+
+    # Atomically replace the snapshot file and drop the segment it supersedes.
+    def write_snapshot(self, snapshot_path, data):
+        tmp_path = f"{snapshot_path}.tmp"
+        with open(tmp_path, "w") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, snapshot_path)
+        if os.path.exists(self.old_path):
+            os.remove(self.old_path)
+
+    # Flush everything still queued and stop the writer thread.
+    def close(self):
+        if not self.running:
+            return
+        with self.pending_lock:
+            self.running = False
+            self.pending_lock.notify()
+        self.writer_thread.join()
+        with self.io_lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
@@ -0,0 +1,72 @@
+# locks.py
+import threading
+import time
+import zlib
+
+from metrics import Histogram
+
+
+# Reentrant lock that counts how often it was acquired and how often a caller had to wait for it.
+# A timed lock also keeps histograms of how long callers waited for it and how long it was held.
+class ContendedLock:
+    def __init__(self, timed=False):
+        self.lock = threading.RLock()
+        self.acquisitions = 0
+        self.contentions = 0
+        self.timed = timed
+        self.wait_times = Histogram() if timed else None
+        self.hold_times = Histogram() if timed else None
+        self.depth = 0  # Nesting of the owner's acquisitions, only touched while holding the lock
+        self.acquired_at = 0.0
+
+    def acquire(self):
+        if not self.lock.acquire(blocking=False):
+            self.contentions += 1
+            if self.timed:
+                started = time.perf_counter()
+                self.lock.acquire()
+                self.wait_times.observe(time.perf_counter() - started)
+            else:
+                self.lock.acquire()
+        self.acquisitions += 1
+        if self.timed:
+            self.depth += 1
+            if self.depth == 1:
+                self.acquired_at = time.perf_counter()
+        return True
+
+    def release(self):
+        if self.timed:
+            self.depth -= 1
+            if self.depth == 0:
+                self.hold_times.observe(time.perf_counter() - self.acquired_at)
+        self.lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def stats(self):
+        stats = {"acquisitions": self.acquisitions, "contentions": self.contentions}
+        if self.timed:
+            stats["wait_seconds"] = self.wait_times.summary()
+            stats["hold_seconds"] = self.hold_times.summary()
+        return stats
+
+
+# Fixed set of locks that shards keyed state (e.g. requests by rq_number) so unrelated keys
+# rarely wait on each other. Never hold two stripes at once: two keys can share a stripe.
+class LockStripes:
+    def __init__(self, count=64):
+        self.stripes = [ContendedLock() for _ in range(count)]
+
+    def for_key(self, key):
+        return self.stripes[zlib.crc32(key.encode()) % len(self.stripes)]
+
+    def stats(self):
+        return {
+            "acquisitions": sum(stripe.acquisitions for stripe in self.stripes),
+            "contentions": sum(stripe.contentions for stripe in self.stripes),
+        }
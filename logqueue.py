@@ -0,0 +1,105 @@
+# logqueue.py
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+# High-volume log lines go to these category loggers ("p2p.<category>") so they can be sampled
+# and rate limited separately: every datagram sent (udp), SEARCH fan-out and OFFERs (search),
+# CATALOG pushes (catalog) and policy decisions (policy).
+CATEGORIES = ("udp", "search", "catalog", "policy")
+DEFAULT_LIMIT = 200  # Lines per second written for each category, 0 for no limit
+
+
+# Hands records to the writer thread as they are: unlike QueueHandler, the message is not
+# formatted in the calling thread, so callers that pass %-style arguments pay for a queue put only.
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record
+
+
+# Keeps one in every `sample_every` records of a category and at most `max_per_second` per second.
+# Warnings and errors always pass. The next record that passes says how many were dropped.
+class SamplingFilter(logging.Filter):
+    def __init__(self, sample_every=1, max_per_second=DEFAULT_LIMIT):
+        super().__init__()
+        self.sample_every = max(1, sample_every)
+        self.max_per_second = max_per_second
+        self.lock = threading.Lock()
+        self.seen = 0
+        self.window_start = time.monotonic()
+        self.window_count = 0
+        self.suppressed = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        with self.lock:
+            self.seen += 1
+            if (self.seen - 1) % self.sample_every:
+                self.suppressed += 1
+                return False
+            now = time.monotonic()
+            if now - self.window_start >= 1:
+                self.window_start, self.window_count = now, 0
+            if self.max_per_second and self.window_count >= self.max_per_second:
+                self.suppressed += 1
+                return False
+            self.window_count += 1
+            suppressed, self.suppressed = self.suppressed, 0
+        if suppressed:
+            record.msg = f"{record.msg} [{suppressed} other {record.name} line(s) suppressed]"
+        return True
+
+
+def category(name):
+    return logging.getLogger(f"p2p.{name}")
+
+
+# Route the root logger through a queue to a background thread writing `filename`, like
+# logging.basicConfig (nothing changes if the root logger already has a handler). Returns the
+# QueueListener, or None if logging was already configured.
+def setup_logging(filename, level=logging.INFO, sample=None, limit=None):
+    root = logging.getLogger()
+    if root.handlers:
+        return None
+    file_handler = logging.FileHandler(filename)
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, file_handler)
+    listener.start()
+    atexit.register(listener.stop)  # Write out what is still queued
+    root.addHandler(LazyQueueHandler(records))
+    root.setLevel(level)
+    configure_sampling(sample, limit)
+    return listener
+
+
+# Set the sampling of the categories: sample is {category: keep one in N}, limit is
+# {category: lines per second}; categories not mentioned keep every line up to DEFAULT_LIMIT.
+def configure_sampling(sample=None, limit=None):
+    sample = sample or {}
+    limit = limit or {}
+    for name in CATEGORIES:
+        logger = category(name)
+        for old in list(logger.filters):
+            if isinstance(old, SamplingFilter):
+                logger.removeFilter(old)
+        logger.addFilter(SamplingFilter(sample.get(name, 1), limit.get(name, DEFAULT_LIMIT)))
+
+
+# Parse "udp=10,search=2" into {category: int}.
+def parse_category_values(text):
+    values = {}
+    for part in (text or "").split(","):
+        if not part.strip():
+            continue
+        name, _, value = part.partition("=")
+        name = name.strip()
+        if name not in CATEGORIES:
+            raise ValueError(f"Unknown log category '{name}', expected one of {CATEGORIES}")
+        values[name] = int(value)
+    return values
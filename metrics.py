@@ -0,0 +1,238 @@
+# metrics.py
+import argparse
+import json
+import math
+import os
+import socket
+import threading
+import uuid
+from collections import deque
+
+STATS_REPLY_BYTES = 65507  # A STATS reply is a single datagram
+
+
+# Value at quantile q (0..1) of an already sorted list, nearest-rank method.
+def percentile(sorted_samples, q):
+    if not sorted_samples:
+        return None
+    rank = max(0, min(len(sorted_samples) - 1, math.ceil(q * len(sorted_samples)) - 1))
+    return sorted_samples[rank]
+
+
+# Latency distribution over the most recent `window` observations, in seconds.
+class LatencyRecorder:
+    def __init__(self, window=4096):
+        self.lock = threading.Lock()
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+            self.count += 1
+            self.total += seconds
+
+    def summary(self):
+        with self.lock:
+            samples = sorted(self.samples)
+            count, total = self.count, self.total
+        return {
+            "count": count,
+            "mean": total / count if count else None,
+            "p50": percentile(samples, 0.50),
+            "p95": percentile(samples, 0.95),
+            "p99": percentile(samples, 0.99),
+        }
+
+
+# Latency histogram in the style of HdrHistogram: values are counted in log-linear buckets (every
+# power of two of microseconds split into SUB_BUCKETS), so any value from a microsecond to hours is
+# kept with a relative error below 1/SUB_BUCKETS, in constant memory and without keeping samples.
+class Histogram:
+    SUB_BUCKET_BITS = 4
+    SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}  # bucket index -> count
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    @classmethod
+    def index(cls, micros):
+        if micros < cls.SUB_BUCKETS:
+            return micros
+        shift = micros.bit_length() - cls.SUB_BUCKET_BITS - 1
+        return (shift + 1) * cls.SUB_BUCKETS + (micros >> shift) - cls.SUB_BUCKETS
+
+    # Highest value (in seconds) counted in a bucket.
+    @classmethod
+    def upper_bound(cls, index):
+        if index < cls.SUB_BUCKETS:
+            return index / 1e6
+        shift = index // cls.SUB_BUCKETS - 1
+        sub_bucket = index % cls.SUB_BUCKETS + cls.SUB_BUCKETS
+        return (((sub_bucket + 1) << shift) - 1) / 1e6
+
+    def observe(self, seconds):
+        index = self.index(max(0, int(seconds * 1e6)))
+        with self.lock:
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    # Values at the given quantiles, each as the upper bound of the bucket it falls in.
+    def quantiles(self, qs):
+        with self.lock:
+            buckets = sorted(self.buckets.items())
+            count = self.count
+        values = []
+        for q in qs:
+            if not count:
+                values.append(None)
+                continue
+            rank = max(1, math.ceil(q * count))
+            seen = 0
+            for index, bucket_count in buckets:
+                seen += bucket_count
+                if seen >= rank:
+                    values.append(self.upper_bound(index))
+                    break
+        return values
+
+    def summary(self):
+        p50, p90, p99 = self.quantiles((0.50, 0.90, 0.99))
+        with self.lock:
+            count, total, maximum = self.count, self.total, self.max
+        return {"count": count, "mean": total / count if count else None, "p50": p50, "p90": p90, "p99": p99,
+                "max": maximum if count else None}
+
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in labels)
+    return "{" + pairs + "}"
+
+
+# In-process metrics of a server: counters and histograms keyed by name and labels, and gauges that
+# are read from the live state whenever the metrics are collected. Exported as a JSON-ready dict
+# (the STATS query) or in the Prometheus text format.
+class MetricsRegistry:
+    def __init__(self, prefix="p2p"):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.gauges = {}  # name -> function returning the current value
+        self.help = {}  # name -> description
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def histogram(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+        return histogram
+
+    def observe(self, name, seconds, **labels):
+        self.histogram(name, **labels).observe(seconds)
+
+    def gauge(self, name, read):
+        self.gauges[name] = read
+
+    def read_gauges(self):
+        values = {}
+        for name, read in list(self.gauges.items()):
+            try:
+                values[name] = read()
+            except Exception:
+                values[name] = None  # State changed under the reader, report nothing this time
+        return values
+
+    def snapshot(self):
+        with self.lock:
+            counters = list(self.counters.items())
+            histograms = list(self.histograms.items())
+        result = {"counters": {}, "gauges": self.read_gauges(), "histograms": {}}
+        for (name, labels), value in counters:
+            result["counters"].setdefault(name, {})[",".join(str(value) for _, value in labels) or "total"] = value
+        for (name, labels), histogram in histograms:
+            result["histograms"].setdefault(name, {})[",".join(str(value) for _, value in labels) or "all"] = \
+                histogram.summary()
+        return result
+
+    def prometheus(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda entry: entry[0])
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in self.help:
+                    lines.append(f"# HELP {self.prefix}_{name} {self.help[name]}")
+                lines.append(f"# TYPE {self.prefix}_{name} {kind}")
+
+        for (name, labels), value in counters:
+            header(name, "counter")
+            lines.append(f"{self.prefix}_{name}{_label_text(labels)} {value}")
+        for name, value in sorted(self.read_gauges().items()):
+            if value is None:
+                continue
+            header(name, "gauge")
+            lines.append(f"{self.prefix}_{name} {value}")
+        for (name, labels), histogram in histograms:
+            header(name, "summary")
+            for q, value in zip((0.5, 0.9, 0.99), histogram.quantiles((0.5, 0.9, 0.99))):
+                if value is not None:
+                    lines.append(f"{self.prefix}_{name}{_label_text(labels + (('quantile', q),))} {value}")
+            with histogram.lock:
+                total, count = histogram.total, histogram.count
+            lines.append(f"{self.prefix}_{name}_sum{_label_text(labels)} {total}")
+            lines.append(f"{self.prefix}_{name}_count{_label_text(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    # Write the Prometheus text to a file, replacing it atomically (e.g. for node_exporter's textfile collector).
+    def dump(self, path):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as file:
+            file.write(self.prometheus())
+        os.replace(tmp_path, path)
+
+
+# Send a STATS query to a server's UDP port and return its metrics.
+def query_stats(address, timeout=2, peer_name=None):
+    query = f"STATS {uuid.uuid4().hex[:16]}" + (f" {peer_name}" if peer_name else "")
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        sock.sendto(query.encode(), address)
+        data, _ = sock.recvfrom(STATS_REPLY_BYTES)
+    msg_type, _, payload = data.decode().split(" ", 2)
+    if msg_type != "STATS-REPLY":
+        raise ValueError(f"Unexpected reply to STATS: {msg_type}")
+    return json.loads(payload)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the live metrics of a running server")
+    parser.add_argument("--server-ip", default="127.0.0.1", help="Server IP")
+    parser.add_argument("--server-port", type=int, required=True, help="Server UDP port")
+    parser.add_argument("--peer", help="Also count this peer's requests by status")
+    args = parser.parse_args()
+
+    print(json.dumps(query_stats((args.server_ip, args.server_port), peer_name=args.peer), indent=2))
@@ -0,0 +1,207 @@
+# orderbook.py
+import heapq
+import itertools
+import threading
+
+from catalog_index import normalize_item
+
+
+# Asks and bids of a single item. Both heaps are invalidated lazily: an entry is live only while it
+# is still the current entry of its seller (asks) or request (bids).
+class ItemBook:
+    def __init__(self):
+        self.asks = []  # (price, seq, seller)
+        self.live_asks = {}  # seller -> (price, seq)
+        self.bids = []  # (-max_price, seq, rq_number)
+        self.live_bids = {}  # rq_number -> (max_price, seq, sellers)
+
+    def best_bid(self):
+        while self.bids:
+            neg_price, seq, rq_number = self.bids[0]
+            live = self.live_bids.get(rq_number)
+            if live is not None and live[1] == seq:
+                return rq_number, live
+            heapq.heappop(self.bids)
+        return None
+
+    # Cheapest live ask at or below max_price from one of `sellers`, as (seller, price), or None.
+    def best_ask_for(self, max_price, sellers):
+        skipped = []
+        found = None
+        while self.asks:
+            price, seq, seller = self.asks[0]
+            live = self.live_asks.get(seller)
+            if live is None or live[1] != seq:
+                heapq.heappop(self.asks)  # Stale entry
+                continue
+            if price > max_price:
+                break
+            if seller in sellers:
+                found = (seller, price)
+                break
+            skipped.append(heapq.heappop(self.asks))
+        for entry in skipped:
+            heapq.heappush(self.asks, entry)
+        return found
+
+
+# Per-item order book matching buyers against sellers with price-time priority: the highest bid is
+# served first (earliest first on equal bids) and gets the cheapest ask (earliest first on equal asks).
+# A seller's ask stands for one reservable unit. It is consumed by a match and posted again once the
+# seller reports its new price floor, so two buyers can never reserve the same unit; bids that only
+# that seller could fill wait in the book for the new floor (see is_consumed).
+# A seller that matches searches by description may offer an item it stocks under another name than
+# the buyer's; asks are kept under the buyer's name, and the stocked item's floors apply to them too.
+class OrderBook:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.books = {}  # item -> ItemBook
+        self.items_by_seller = {}  # seller -> items it has a live ask for
+        self.consumed = set()  # (item, seller) of asks taken by a match, until the seller's new floor arrives
+        self.aliases = {}  # (stocked item, seller) -> items of searches the seller offered the stocked item for
+        self.sequence = itertools.count()
+
+    def book(self, item):
+        book = self.books.get(item)
+        if book is None:
+            book = self.books[item] = ItemBook()
+        return book
+
+    # Post or re-price the seller's ask from its current price floor; an unchanged ask keeps its time priority.
+    def post_ask(self, item_name, seller, price):
+        item = normalize_item(item_name)
+        with self.lock:
+            for name in self._with_aliases(item, seller):
+                self.consumed.discard((name, seller))
+                self._post_ask(name, seller, price)
+
+    # Post an ask from an OFFER for the seller's stocked_name item. An OFFER may have been sent before
+    # the seller learned that its unit was reserved, so it does not bring back an ask consumed by a match.
+    def offer_ask(self, item_name, seller, price, stocked_name=None):
+        item = normalize_item(item_name)
+        with self.lock:
+            if stocked_name is not None and normalize_item(stocked_name) != item:
+                self.aliases.setdefault((normalize_item(stocked_name), seller), set()).add(item)
+            if (item, seller) not in self.consumed:
+                self._post_ask(item, seller, price)
+
+    def _post_ask(self, item, seller, price):
+        book = self.book(item)
+        live = book.live_asks.get(seller)
+        if live is not None and live[0] == price:
+            return
+        seq = next(self.sequence)
+        book.live_asks[seller] = (price, seq)
+        heapq.heappush(book.asks, (price, seq, seller))
+        self.items_by_seller.setdefault(seller, set()).add(item)
+        if len(book.asks) > 2 * len(book.live_asks) + 64:
+            # Mostly re-priced entries, drop them
+            book.asks = [entry for entry in book.asks if book.live_asks.get(entry[2], (None, None))[1] == entry[1]]
+            heapq.heapify(book.asks)
+
+    # The seller has no unit of the item left.
+    def remove_ask(self, item_name, seller):
+        item = normalize_item(item_name)
+        with self.lock:
+            for name in self._with_aliases(item, seller):
+                self._remove_ask(name, seller)
+                self.consumed.discard((name, seller))
+            self.aliases.pop((item, seller), None)
+
+    # Take the seller's unit outside of a match (e.g. a negotiated sale) until its new floor arrives.
+    def consume_ask(self, item_name, seller):
+        item = normalize_item(item_name)
+        with self.lock:
+            self._remove_ask(item, seller)
+            self.consumed.add((item, seller))
+
+    def remove_seller(self, seller):
+        with self.lock:
+            for item in list(self.items_by_seller.get(seller, ())):
+                self._remove_ask(item, seller)
+            self.consumed = {(item, name) for item, name in self.consumed if name != seller}
+            self.aliases = {key: items for key, items in self.aliases.items() if key[1] != seller}
+
+    # True while the seller's ask was taken and its new floor has not arrived yet.
+    def is_consumed(self, item_name, seller):
+        with self.lock:
+            return (normalize_item(item_name), seller) in self.consumed
+
+    # Items of searches the seller answered with its item_name (see offer_ask).
+    def aliases_of(self, item_name, seller):
+        with self.lock:
+            return set(self.aliases.get((normalize_item(item_name), seller), ()))
+
+    def ask(self, item_name, seller):
+        with self.lock:
+            book = self.books.get(normalize_item(item_name))
+            live = book.live_asks.get(seller) if book else None
+            return live[0] if live else None
+
+    # Queue a bid for the next match of its item. Only asks of `sellers` (those that answered the
+    # request with an OFFER) can fill it.
+    def add_bid(self, item_name, rq_number, max_price, sellers):
+        with self.lock:
+            book = self.book(normalize_item(item_name))
+            seq = next(self.sequence)
+            book.live_bids[rq_number] = (max_price, seq, frozenset(sellers))
+            heapq.heappush(book.bids, (-max_price, seq, rq_number))
+
+    def remove_bid(self, item_name, rq_number):
+        with self.lock:
+            book = self.books.get(normalize_item(item_name))
+            if book is not None:
+                book.live_bids.pop(rq_number, None)  # Its heap entry is dropped lazily
+
+    def has_bids(self, item_name):
+        with self.lock:
+            book = self.books.get(normalize_item(item_name))
+            return book is not None and bool(book.live_bids)
+
+    # Match every queued bid of the item at once. Returns (matches, unmatched): matches are
+    # (rq_number, seller, price) with the seller's ask consumed, unmatched are the rq_numbers of bids
+    # no live ask could fill. Both leave the book.
+    def match(self, item_name):
+        item = normalize_item(item_name)
+        matches = []
+        unmatched = []
+        with self.lock:
+            book = self.books.get(item)
+            if book is None:
+                return matches, unmatched
+            while True:
+                best = book.best_bid()
+                if best is None:
+                    break
+                rq_number, (max_price, _, sellers) = best
+                heapq.heappop(book.bids)
+                del book.live_bids[rq_number]
+                ask = book.best_ask_for(max_price, sellers)
+                if ask is None:
+                    unmatched.append(rq_number)
+                    continue
+                seller, price = ask
+                self._remove_ask(item, seller)
+                self.consumed.add((item, seller))
+                matches.append((rq_number, seller, price))
+            if not book.live_asks and not book.live_bids:
+                del self.books[item]
+        return matches, unmatched
+
+    def _with_aliases(self, item, seller):
+        return [item, *self.aliases.get((item, seller), ())]
+
+    def _remove_ask(self, item, seller):
+        book = self.books.get(item)
+        if book is not None:
+            book.live_asks.pop(seller, None)
+        items = self.items_by_seller.get(seller)
+        if items is not None:
+            items.discard(item)
+            if not items:
+                del self.items_by_seller[seller]
+
+    # Number of live asks and bids, for monitoring.
+    def depth(self):
+        with self.lock:
+            return {item: (len(book.live_asks), len(book.live_bids)) for item, book in self.books.items()}
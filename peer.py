@@ -7,6 +7,30 @@ import time
 import uuid
 import logging
 import queue
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+from catalog_engine import CatalogEngine
+from catalog_index import normalize_item
+from inventory import InventoryStore
+from logqueue import category, setup_logging
+from policy import load_policy
+from reliable import FEATURE_RELIABLE, REPLY_TO, LossySocket, RetransmitQueue, SeenSet
+from scheduler import TimerScheduler
+from tcp_pool import FRAME_MARKER, FrameWriter, read_frame
+import wire
+
+udp_log = category("udp")
+search_log = category("search")
+catalog_log = category("catalog")
+policy_log = category("policy")
+
+CATALOG_MESSAGE_BYTES = 900  # Keep CATALOG datagrams below the server's 1024 byte receive buffer
+MATCH_LIMIT = 4096  # Requests whose offered item name is remembered, see remember_match
+
+# Server of peers created without a server_address, asked for on the console in __main__
+server_ip = None
+server_udp_port = None
 
 class Peer:
     class Client:
@@ -20,19 +44,56 @@ class Peer:
             self.address = address
             self.credit_card = self.CreditCard()
 
-    def __init__(self, name, udp_port, tcp_port):
+    # address, server_address, timers, policy, background and executor let a PeerHost run many peers
+    # in one process: a fixed bind address, a shared timer thread, a policy answering the prompts, no
+    # per-peer background threads and a shared pool running the message handlers.
+    def __init__(self, name, udp_port, tcp_port, binary=True, reliable=True, loss=0.0, address=None,
+                 server_address=None, timers=None, policy=None, background=True, executor=None,
+                 priced_search=True):
         self.name = name
         self.udp_port = udp_port
         self.tcp_port = tcp_port
-        self.address = get_local_ip()
+        self.address = address or get_local_ip()
+        self.server_address = tuple(server_address) if server_address else None
+        # Called as policy(peer, question, details) before prompting, see ask_user. Defaults to the
+        # rules in <name>_policy.json when that file exists.
+        self.policy_file = f"{self.name}_policy.json"
+        self.policy = policy if policy is not None else load_policy(self.policy_file)
+        if policy is None and self.policy is not None:
+            print(f"Policy loaded: {self.policy_file}")
+        self.executor = executor  # Runs message handlers when set, instead of a thread per message
         self.rq_counter = 0  # Initialize the counter
+        self.catalog_seq = 0  # Orders CATALOG messages, which may arrive out of order after retransmission
+        self.catalog_seq_lock = threading.RLock()  # Held from reading the inventory until the seq is taken
         self.client = self.Client(name, "Address")
         self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.udp_socket.bind((self.address, self.udp_port))  # Bind to listen for messages
-        self.response_event = threading.Event()  # Event to signal when a response is received
-        self.response_message = None  # Placeholder for the server's response
+        self.response_message = None  # Last reply received by a blocking request
+        # Replies the server still owes us, by rq_number. Each request has its own Future, so any number
+        # of requests can be in flight at once and other messages never wake the wrong waiter.
+        self.pending_replies = {}
+        self.pending_replies_lock = threading.Lock()
+        self.binary = binary  # Ask the server for the binary wire encoding at REGISTER time
+        self.wire_binary = False  # Set once the server accepted the binary encoding
+        self.reliable = reliable  # Ask the server for acks and retransmission at REGISTER time
+        self.server_reliable = False  # Set once the server accepted them
+        self.priced_search = priced_search  # Let the server send PRICED_SEARCH, answered only when in budget
+        self.outgoing = LossySocket(self.udp_socket, loss)  # Drops a share of sent datagrams when loss > 0
+        self.owns_timers = timers is None
+        self.timers = timers if timers is not None else TimerScheduler()
+        self.retransmits = RetransmitQueue(self.timers, self.outgoing.sendto)
+        self.seen = SeenSet()  # Server messages already handled, to drop retransmitted duplicates
         self.inventory_file = f"{self.name}_inventory.json"
+        self.background = background
         self.initialize_inventory()
+        # Searches match items by name and description when <name>_catalog.bin exists (built with
+        # catalog_engine.py); otherwise only an item of the exact name is offered.
+        self.catalog_file = f"{self.name}_catalog.bin"
+        self.catalog_engine = CatalogEngine(self.catalog_file) if os.path.exists(self.catalog_file) else None
+        if self.catalog_engine is not None:
+            print(f"Catalog loaded: {self.catalog_file}")
+        self.matched_items = OrderedDict()  # rq_number -> item offered under another name, newest last
+        self.matched_items_lock = threading.Lock()
         self.running = True  # Control flag for threads
         self.threads = []  # To track threads
         self.is_registered = False  # Track registration status
@@ -55,11 +116,7 @@ class Peer:
 
         # Setting up dynamic logging for this peer
         log_filename = f"{self.name}.log"
-        logging.basicConfig(
-            filename=log_filename,
-            level=logging.INFO,
-            format="%(asctime)s - %(levelname)s - %(message)s"
-        )
+        setup_logging(log_filename)  # Written by a background thread; the first peer of a process owns the file
         logging.info(f"Peer {self.name} initialized with UDP port {self.udp_port} and TCP port {self.tcp_port}.")
 
     # Continuously listens for server messages on a dedicated thread.
@@ -68,7 +125,7 @@ class Peer:
         while self.running:
             try:
                 data, addr = self.udp_socket.recvfrom(1024)
-                threading.Thread(target=self.handle_server_message, args=(data, addr), daemon=True).start()
+                self.spawn(self.handle_server_message, data, addr)
                 if not self.running:
                     break
             except socket.error as e:
@@ -79,156 +136,249 @@ class Peer:
                 print(f"Error while listening to server messages: {e}")
                 break
 
-    #Initialize the inventory file for the peer.
+    # Run a message handler on the shared executor, or on a thread of its own.
+    def spawn(self, target, *args):
+        if self.executor is not None:
+            self.executor.submit(target, *args)
+        else:
+            threading.Thread(target=target, args=args, daemon=True).start()
+
+    #Initialize the inventory for the peer. It stays in memory and is written back to the file in the background.
     def initialize_inventory(self):
-        if not os.path.exists(self.inventory_file):
-            # Create an empty inventory or predefined structure
-            inventory = []
-            with open(self.inventory_file, "w") as file:
-                json.dump(inventory, file, indent=4)
+        self.inventory = InventoryStore(self.inventory_file, background=self.background)
+        if self.inventory.created:
             print(f"Inventory file created: {self.inventory_file}")
         else:
-            inventory = self.load_inventory()
-            updated_inventory = [
-                {**item, "reserved": item.get("reserved", False)} for item in inventory
-            ]
-            with open(self.inventory_file, "w") as file:
-                json.dump(updated_inventory, file, indent=4)
             print(f"Inventory file updated: {self.inventory_file}")
 
     # Add an item to the peer's inventory.
     def add_item_to_inventory(self, item_name, item_description, price):
         item = {"item_name": item_name, "item_description": item_description, "price": price, "reserved": False}
-        # Load existing inventory, update, and save back
-        inventory = self.load_inventory()
-        inventory.append(item)
-        with open(self.inventory_file, "w") as file:
-            json.dump(inventory, file, indent=4)
+        self.inventory.add(item)
         print(f"Item added to inventory: {item}")
+        self.send_catalog_update(item_name)
 
-    # Load the inventory from the JSON file.
+    # Copy of the inventory as stored in the JSON file.
     def load_inventory(self):
-        with open(self.inventory_file, "r") as file:
-            return json.load(file)
-
-    # Update the reservation status of an item in the inventory.
-    def update_item_reservation(self, item_name, reserved):
-        inventory = self.load_inventory()
-        updated = False
-        for item in inventory:
-            if item['item_name'].lower() == item_name.lower():
-                item['reserved'] = reserved
-                updated = True
-                break
+        return self.inventory.snapshot()
 
-        if updated:
-            with open(self.inventory_file, "w") as file:
-                json.dump(inventory, file, indent=4)
-            logging.info(f"Updated reservation status for item '{item_name}' to {reserved}.")
+    # Reserve a unit of an item for a request, or release the unit reserved for it.
+    def update_item_reservation(self, item_name, reserved, rq_number):
+        if self.inventory.set_reserved(item_name, reserved, rq_number):
+            logging.info(f"Updated reservation status for item '{item_name}' of {rq_number} to {reserved}.")
+            self.send_catalog_update(item_name)
         else:
             logging.warning(f"Item '{item_name}' not found in inventory.")
 
+    # Price floor (cheapest unreserved unit) of every item in stock, keyed by lowercase item name.
+    def catalog_floors(self):
+        return self.inventory.floors()
+
+    def send_catalog_message(self, mode, entries):
+        with self.catalog_seq_lock:
+            self.catalog_seq += 1
+            seq = self.catalog_seq
+        catalog_msg = " ".join([f"CATALOG {self.generate_rq_number()} {self.name} {mode} {seq}"] + entries)
+        self.send_udp(catalog_msg, self.server())
+        catalog_log.info("Sent catalog %s with %d item(s) to server.", mode, len(entries))
+
+    # Push the whole catalog to the server so it only forwards SEARCHes for items we stock.
+    # Large catalogs are split over several datagrams: the first replaces what the server knows, the rest add to it.
+    def push_catalog(self):
+        with self.catalog_seq_lock:
+            mode = "FULL"
+            chunk = []
+            size = 0
+            for item_name, floor in self.catalog_floors().items():
+                entry = f"{item_name} {floor}"
+                if chunk and size + len(entry) + 1 > CATALOG_MESSAGE_BYTES - 100:  # Leave room for the header
+                    self.send_catalog_message(mode, chunk)
+                    mode, chunk, size = "DELTA", [], 0
+                chunk.append(entry)
+                size += len(entry) + 1
+            self.send_catalog_message(mode, chunk)
+
+    # Tell the server the new price floor of a single item after the inventory changed.
+    def send_catalog_update(self, item_name):
+        if not self.is_registered:
+            return
+        with self.catalog_seq_lock:
+            floor = self.inventory.floor(item_name)
+            self.send_catalog_message("DELTA", [f"{item_name.lower()} {floor if floor is not None else '-'}"])
+
     # Handles different types of server messages.
     def handle_server_message(self, data, addr):
         try:
-            message = data.decode()
-            self.response_message = message  # Set the response message
-            message_parts = message.split()
+            message_parts = wire.parse(data)
             msg_type = message_parts[0]
+            rq_number = message_parts[1]
 
-            if msg_type == "SEARCH":
+            if msg_type == "ACK":
+                self.retransmits.ack((message_parts[2], rq_number))
+                return
+            if msg_type in REPLY_TO:
+                self.retransmits.ack((REPLY_TO[msg_type], rq_number))  # A reply also acknowledges the request
+            if self.server_reliable or (msg_type == "REGISTERED" and FEATURE_RELIABLE in message_parts[2:]):
+                self.send_udp(f"ACK {rq_number} {msg_type}", addr)
+                if self.seen.check_and_add((msg_type, rq_number)):
+                    return  # Retransmission of a message that was already handled
+
+            message = " ".join(message_parts)
+
+            # Negotiated features change with our registration, before anyone waiting on it resumes
+            if msg_type == "REGISTERED":
+                self.wire_binary = wire.FEATURE_BINARY in message_parts[2:]
+                self.server_reliable = FEATURE_RELIABLE in message_parts[2:]
+            elif msg_type == "DE-REGISTERED":
+                self.wire_binary = False
+                self.server_reliable = False
+            if msg_type in REPLY_TO:
+                self.resolve_reply(rq_number, message)
+
+            if msg_type in ("SEARCH", "PRICED_SEARCH"):
                 self.handle_search(message_parts)
             elif msg_type == "NEGOTIATE":
-                self.response_event.set()
                 self.handle_negotiate(message_parts, addr)
             elif msg_type == "FOUND":
-                self.response_event.set()
                 self.handle_found(message_parts, addr)
-            elif msg_type in ["REGISTERED", "DE-REGISTERED", "REGISTER-DENIED", "DE-REGISTER-DENIED", "NOT_AVAILABLE", "NOT_FOUND"]:
-                self.response_event.set()
+            elif msg_type in ["REGISTERED", "DE-REGISTERED", "REGISTER-DENIED", "DE-REGISTER-DENIED",
+                              "NOT_AVAILABLE", "NOT_FOUND"]:
+                pass  # Delivered to the request's Future
             elif msg_type == "RESERVE":
-                self.response_event.set()
                 self.handle_reserved(message_parts)
             elif msg_type == "CANCEL":
-                self.response_event.set()
                 self.handle_cancel(message_parts)
             else:
                 print(f"Unknown message type received: {msg_type}")
         except Exception as e:
             print(f"Error in handle_server_message: {e}")
 
-    # Handles SEARCH message from the server.
+    # Handles SEARCH and PRICED_SEARCH messages from the server. A PRICED_SEARCH carries the buyer's
+    # bid and a tolerance: only a unit priced within bid * (1 + tolerance) is offered, so the server
+    # does not negotiate over prices the buyer would never reach.
     def handle_search(self, parts):
         rq_number = parts[1]
         item_name = parts[2]
-        item_description = " ".join(parts[3:])
+        max_price = None
+        if parts[0] == "PRICED_SEARCH":
+            max_price = float(parts[3]) * (1 + float(parts[4]))
+            item_description = " ".join(parts[5:])
+        else:
+            item_description = " ".join(parts[3:])
 
         # Check if the item exists in the peer's inventory
-        inventory = self.load_inventory()
-        for item in inventory:
-            if item['item_name'].lower() == item_name.lower() and not item.get("reserved", False):
-                # Item found, respond to the server with an OFFER message
-                price = item['price']
-                offer_msg = f"OFFER {rq_number} {self.name} {item_name} {price}"
-                self.udp_socket.sendto(offer_msg.encode(), (server_ip, server_udp_port))
-                # self.update_item_reservation(item_name, True)  # Mark as reserved
-                logging.info(f"Sent OFFER to server: {offer_msg}")
-                return
-
-        # If the item is not found, no response is necessary
-        logging.warning(f"Item '{item_name}' not found in inventory.")
+        item = None
+        if self.catalog_engine is not None:
+            match = self.catalog_engine.best_match(item_name, item_description,
+                                                   lambda name: self.inventory.has_available(name, max_price))
+            if match is not None:
+                item = self.inventory.find_available(match, max_price)
+        if item is None:
+            item = self.inventory.find_available(item_name, max_price)
+        if item is not None:
+            self.remember_match(rq_number, item_name, item['item_name'])
+            # Item found, respond to the server with an OFFER message
+            price = item['price']
+            offer_msg = f"OFFER {rq_number} {self.name} {item_name} {price}"
+            if normalize_item(item['item_name']) != normalize_item(item_name):
+                offer_msg += f" {item['item_name']}"  # The server follows this item's floor for the request
+            self.send_udp(offer_msg, self.server())
+            # self.update_item_reservation(item_name, True)  # Mark as reserved
+            search_log.info("Sent OFFER to server: %s", offer_msg)
+            return
+
+        # Tell the server, so it does not have to wait for us before answering the buyer
+        no_offer_msg = f"NO_OFFER {rq_number} {self.name} {item_name}"
+        self.send_udp(no_offer_msg, self.server())
+        if max_price is None:
+            logging.warning(f"Item '{item_name}' not found in inventory.")
+        else:
+            search_log.info("No unit of '%s' within %s, sent NO_OFFER", item_name, max_price)
+
+    # The server keeps the buyer's item name for the rest of the request, so remember which item was
+    # offered for it when that name is not the buyer's.
+    def remember_match(self, rq_number, item_name, stocked_name):
+        if normalize_item(stocked_name) == normalize_item(item_name):
+            return
+        with self.matched_items_lock:
+            self.matched_items[rq_number] = stocked_name
+            self.matched_items.move_to_end(rq_number)
+            while len(self.matched_items) > MATCH_LIMIT:
+                self.matched_items.popitem(last=False)
+
+    # Inventory name of the item a request is about.
+    def stocked_item(self, rq_number, item_name):
+        with self.matched_items_lock:
+            return self.matched_items.get(rq_number, item_name)
 
     # Handles NEGOTIATE message from the server.
     def handle_negotiate(self, parts, addr):
         rq_number = parts[1]
         item_name = parts[2]
         max_price = float(parts[3])
+        stocked_name = self.stocked_item(rq_number, item_name)
 
         with self.input_lock:
             self.in_negotiation = True
-            self.input_needed = True
-            self.input_prompt = f"\nAccept negotiation for {item_name} at {max_price}? (y/n): "
-            self.input_response = None
-
-        self.input_received_event.clear()  # Clear event before waiting
-        self.input_available_event.set()   # Signal that input is needed
-
-        # Wait for the main thread to handle the input
-        self.input_received_event.wait()
-
-        with self.input_lock:
-            accept_negotiation = self.input_response.strip().lower()
-            self.input_needed = False  # Input has been processed
+        accept_negotiation = self.ask_user(
+            "negotiate", f"\nAccept negotiation for {item_name} at {max_price}? (y/n): ",
+            item_name=item_name, price=max_price).strip().lower()
 
         if accept_negotiation == 'y':
             response = f"ACCEPT {rq_number} {item_name} {max_price}"
-            self.update_item_reservation(item_name, True)
+            self.update_item_reservation(stocked_name, True, rq_number)
         elif accept_negotiation == 'n':
             response = f"REFUSE {rq_number} {item_name} {max_price}"
-            self.update_item_reservation(item_name, False)
+            self.update_item_reservation(stocked_name, False, rq_number)
             with self.lock:
                 self.in_negotiation = False  # Only set to False if refused
         else:
             print("Invalid response received.")
             response = f"REFUSE {rq_number} {item_name} {max_price}"
-            self.update_item_reservation(item_name, False)
+            self.update_item_reservation(stocked_name, False, rq_number)
             with self.lock:
                 self.in_negotiation = False  # Only set to False if refused
 
         # Send the response back to the server
-        self.udp_socket.sendto(response.encode(), addr)
+        self.send_udp(response, addr)
         logging.info(f"Sent response to server: {response}")
 
         with self.input_lock:
             # self.in_negotiation = False
             self.input_available_event.clear()
 
+    # Answer a question from the server side flows: the policy hook answers it if it can, otherwise
+    # the user is prompted on the console. Questions are "negotiate" and "buy" (answered y/n),
+    # "card_number", "card_expiry" and "shipping_address"; details holds item_name and price.
+    def ask_user(self, question, prompt, **details):
+        if self.policy is not None:
+            answer = self.policy(self, question, details)
+            if answer is not None:
+                policy_log.info("Policy answered %s for %s: %s", question, details, answer)
+                return str(answer)
+
+        with self.input_lock:
+            self.input_needed = True
+            self.input_prompt = prompt
+            self.input_response = None
+
+        self.input_received_event.clear()  # Clear event before waiting
+        self.input_available_event.set()   # Signal that input is needed
+
+        # Wait for the main thread to handle the input
+        self.input_received_event.wait()
+
+        with self.input_lock:
+            response = self.input_response or ""
+            self.input_needed = False  # Input has been processed
+        return response
+
     def handle_reserved(self, parts):
-        self.update_item_reservation(parts[2], True)
+        self.update_item_reservation(self.stocked_item(parts[1], parts[2]), True, parts[1])
 
     def handle_cancel(self, parts):
         logging.info(f"Canceled item '{parts[2]}' from server.")
-        self.update_item_reservation(parts[2], False)
+        self.update_item_reservation(self.stocked_item(parts[1], parts[2]), False, parts[1])
         print(f"Canceled item '{parts[2]}' from server.")
         # To make sure options are printed if cancel is received
         with self.input_lock:
@@ -242,19 +392,9 @@ class Peer:
 
         with self.input_lock:
             self.in_found = True
-            self.input_needed = True
-            self.input_prompt = f"\nItem: {item_name} found at price {price}. Do you want to buy it? (y/n): "
-            self.input_response = None
-
-        self.input_received_event.clear()  # Clear event before waiting
-        self.input_available_event.set()   # Signal that input is needed
-
-        # Wait for the main thread to handle the input
-        self.input_received_event.wait()
-
-        with self.input_lock:
-            accept_buy = self.input_response.strip().lower()
-            self.input_needed = False  # Input has been processed
+        accept_buy = self.ask_user(
+            "buy", f"\nItem: {item_name} found at price {price}. Do you want to buy it? (y/n): ",
+            item_name=item_name, price=price).strip().lower()
 
         if accept_buy == 'y':
             response = f"BUY {rq_number} {item_name} {price}"
@@ -262,58 +402,135 @@ class Peer:
             response = f"CANCEL {rq_number} {item_name} {price}"
 
         # Send the response back to the server
-        self.udp_socket.sendto(response.encode(), addr)
+        self.send_udp(response, addr)
         logging.info(f"Sent response to server: {response}")
 
         with self.input_lock:
             self.in_found = False
             self.input_available_event.clear()
 
+    # Address of the server this peer talks to.
+    def server(self):
+        return self.server_address or (server_ip, server_udp_port)
+
     def generate_rq_number(self):
         with threading.Lock():
             self.rq_counter += 1
-            rq_number = f"{self.name}-{str(uuid.uuid4())}-{self.rq_counter}"
+            if self.binary:
+                # Binary frames carry 64-bit request ids, written as 16 hex digits. Used from the REGISTER
+                # on, so acks and replies sent before the encoding is negotiated carry the same rq_number.
+                rq_number = wire.rq_number_from_id(uuid.uuid4().int >> 64)
+            else:
+                rq_number = f"{self.name}-{str(uuid.uuid4())}-{self.rq_counter}"
         return rq_number
 
-    # Send a message to the server and wait for a response via listen_to_server.
+    # Send a text message, as a binary frame once the server negotiated the binary encoding.
+    # Messages to a server that negotiated reliability (and REGISTER itself) are retransmitted until acknowledged.
+    def send_udp(self, message, addr):
+        data = wire.encode_text(message) if self.wire_binary else message.encode()
+        msg_type, rq_number = message.split(maxsplit=2)[:2]
+        if self.reliable and msg_type != "ACK" and (self.server_reliable or msg_type == "REGISTER"):
+            self.retransmits.track((msg_type, rq_number), data, addr)
+        else:
+            self.outgoing.sendto(data, addr)
+
+    # Send a request to the server and return a Future resolved with the reply that carries its
+    # rq_number. Use asyncio.wrap_future() to await it from a coroutine.
+    def request(self, message, server_address=None):
+        rq_number = message.split(maxsplit=2)[1]
+        future = Future()
+        with self.pending_replies_lock:
+            self.pending_replies[rq_number] = future
+        try:
+            self.send_udp(message, server_address or self.server())
+            udp_log.info("Message sent: %s", message)
+        except Exception as e:
+            self.discard_reply(rq_number)
+            future.set_exception(e)
+        return future
+
+    def resolve_reply(self, rq_number, message):
+        with self.pending_replies_lock:
+            future = self.pending_replies.pop(rq_number, None)
+        if future is not None and not future.done():
+            future.set_result(message)
+
+    def discard_reply(self, rq_number):
+        with self.pending_replies_lock:
+            self.pending_replies.pop(rq_number, None)
+
+    # Send a message to the server and wait for its reply.
     def send_and_wait_for_response(self, message, server_address, timeout=10):
-        self.response_event.clear()  # Reset the event before sending a message
         self.response_message = None  # Clear any previous response
+        rq_number = message.split(maxsplit=2)[1]
+        if message.startswith("LOOKING_FOR"):
+            timeout = 150  # Searches may take up to the server's search timeout
         try:
-            self.udp_socket.sendto(message.encode(), server_address)
-            logging.info(f"Message sent: {message}")
-            if message.startswith("LOOKING_FOR"):
-                self.is_waiting = True  # Start waiting
-                if self.response_event.wait(150):  # Wait 150 seconds
-                    message = self.response_message.split()
-                    print(message[0])
-                    logging.info(f"Server response received via listen_to_server: {self.response_message}")
-                    # if "NOT_AVAILABLE" in self.response_message:
-                    #     print(f"Item not available: {self.response_message}")
-                    #     logging.info(f"Item not available: {self.response_message}")
-                else:
-                    print("Timeout LF: No response from the server.")
-                    logging.info("Timeout LF: No response from the server.")
-            elif self.response_event.wait(timeout):  # Wait for the response within the timeout
-                message = self.response_message.split()
-                print(message[0])
-                logging.info(f"Server response received via listen_to_server: {self.response_message}")
-            else:
-                print("\nTimeout: No response from the server.")
-                logging.info("Timeout: No response from the server.")
+            self.is_waiting = True  # Start waiting
+            self.response_message = self.request(message, server_address).result(timeout)
+            print(self.response_message.split()[0])
+            logging.info(f"Server response received via listen_to_server: {self.response_message}")
+        except FutureTimeout:
+            self.discard_reply(rq_number)
+            print("\nTimeout: No response from the server.")
+            logging.info(f"Timeout: No response from the server to {rq_number}.")
         except Exception as e:
             print(f"Error sending message: {e}")
             logging.warning(f"Error sending message: {e}")
         finally:
             self.is_waiting = False  # End waiting
+        return self.response_message
+
+    def register_message(self):
+        register_msg = f"REGISTER {self.generate_rq_number()} {self.client.name} {self.address} {self.udp_port} {self.tcp_port}"
+        if self.binary:
+            register_msg += f" {wire.FEATURE_BINARY}"
+        if self.reliable:
+            register_msg += f" {FEATURE_RELIABLE}"
+        if self.priced_search:
+            register_msg += f" {wire.FEATURE_PRICED_SEARCH}"
+        if self.catalog_engine is not None:
+            register_msg += f" {wire.FEATURE_DESCRIPTION_MATCH}"
+        return register_msg
+
+    # Track our registration from the server's reply to REGISTER or DE-REGISTER.
+    def on_registration_reply(self, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        reply_type = future.result().split()[0]
+        if reply_type == "REGISTERED":
+            self.is_registered = True
+            self.push_catalog()
+        elif reply_type == "DE-REGISTERED":
+            self.is_registered = False
+
+    # Non-blocking versions of the requests below: each returns the Future of the server's reply.
+    def register_async(self):
+        register_msg = self.register_message()
+        logging.info(f"Sending registration message: {register_msg}")
+        future = self.request(register_msg)
+        future.add_done_callback(self.on_registration_reply)
+        return future
+
+    def deregister_async(self):
+        deregister_msg = f"DE-REGISTER {self.generate_rq_number()} {self.client.name}"
+        logging.info(f"Sending deregistration message: {deregister_msg}")
+        future = self.request(deregister_msg)
+        future.add_done_callback(self.on_registration_reply)
+        return future
+
+    def looking_for_async(self, itemName, itemDescription, maxPrice):
+        looking_for_msg = f"LOOKING_FOR {self.generate_rq_number()} {self.name} {itemName} {itemDescription} {maxPrice}"
+        logging.info(f"Sending looking for: {looking_for_msg}")
+        return self.request(looking_for_msg)
 
     def register_with_server(self):
-        rq_number = self.generate_rq_number()
-        register_msg = f"REGISTER {rq_number} {self.client.name} {self.address} {self.udp_port} {self.tcp_port}"
+        register_msg = self.register_message()
         logging.info(f"Sending registration message: {register_msg}")
-        self.send_and_wait_for_response(register_msg, (server_ip, server_udp_port))
-        if self.response_message and "REGISTERED" in self.response_message:
+        reply = self.send_and_wait_for_response(register_msg, self.server())
+        if reply and reply.split()[0] == "REGISTERED":
             self.is_registered = True
+            self.push_catalog()
             # print("Successfully registered.")
         # else:
         #     print("Registration failed.")
@@ -322,8 +539,8 @@ class Peer:
         rq_number = self.generate_rq_number()
         deregister_msg = f"DE-REGISTER {rq_number} {self.client.name}"
         logging.info(f"Sending deregistration message: {deregister_msg}")
-        self.send_and_wait_for_response(deregister_msg, (server_ip, server_udp_port))
-        if self.response_message and "DE-REGISTERED" in self.response_message:
+        reply = self.send_and_wait_for_response(deregister_msg, self.server())
+        if reply and reply.split()[0] == "DE-REGISTERED":
             self.is_registered = False
             # print("Successfully deregistered.")
         # else:
@@ -334,15 +551,20 @@ class Peer:
         self.is_waiting = True  # Start waiting
         looking_for_msg = f"LOOKING_FOR {rq_number} {self.name} {itemName} {itemDescription} {maxPrice}"
         logging.info(f"Sending looking for: {looking_for_msg}")
-        self.send_and_wait_for_response(looking_for_msg, (server_ip, server_udp_port))
+        self.send_and_wait_for_response(looking_for_msg, self.server())
         self.is_waiting = False  # Stop waiting after the response
 
-    # Continuously listen for incoming TCP connections.
-    def tcp_listener(self):
+    def open_tcp_listener(self, backlog=5):
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # Rebind while old connections linger
         server_socket.bind((self.address, self.tcp_port))
-        server_socket.listen(5)
+        server_socket.listen(backlog)
         logging.info(f"{self.name} listening for TCP connections on port {self.tcp_port}.")
+        return server_socket
+
+    # Continuously listen for incoming TCP connections.
+    def tcp_listener(self):
+        server_socket = self.open_tcp_listener()
 
         while self.running:
             try:
@@ -359,26 +581,17 @@ class Peer:
     def handle_tcp_connection(self, conn, addr):
         logging.info(f"Handling TCP connection from {addr}")
         try:
+            if conn.recv(1, socket.MSG_PEEK) == FRAME_MARKER:
+                self.handle_tcp_channel(conn, addr)
+                return
             while self.running:
                 data = conn.recv(1024).decode()
                 if not data:
                     logging.info(f"Connection closed by {addr}")
                     break
 
-                logging.info(f"Received TCP message from {addr}: {data}")
-                parts = data.split()
-                msg_type = parts[0]
-
-                # Spawn a new thread for each message type
-                if msg_type == "INFORM_Req":
-                    threading.Thread(target=self.process_inform_request, args=(conn, addr, parts), daemon=True).start()
-                elif msg_type == "Shipping_Info":
-                    self.process_shipping_info(conn, addr, parts)
+                if self.dispatch_tcp_message(conn, addr, data) == "Shipping_Info":
                     break  # Exit the loop after closing the connection
-                elif msg_type == "CANCEL":
-                    threading.Thread(target=self.process_cancel_transaction, args=(conn, addr, parts), daemon=True).start()
-                else:
-                    logging.warning(f"Unknown TCP message type received: {msg_type}")
 
         except Exception as e:
             logging.error(f"Error handling TCP connection: {e}")
@@ -386,6 +599,34 @@ class Peer:
             conn.close()
             logging.info(f"Connection with {addr} closed.")
 
+    # Handle a persistent framed channel from the server, which carries the messages of many
+    # transactions. Replies are framed too, and the channel is kept open after Shipping_Info.
+    def handle_tcp_channel(self, conn, addr):
+        channel = FrameWriter(conn, threading.Lock())
+        while self.running:
+            payload = read_frame(conn)
+            if payload is None:
+                logging.info(f"Channel closed by {addr}")
+                break
+            self.dispatch_tcp_message(channel, addr, payload.decode())
+
+    # Handle one TCP message from the server; replies go to conn. Returns the message type.
+    def dispatch_tcp_message(self, conn, addr, data):
+        logging.info(f"Received TCP message from {addr}: {data}")
+        parts = data.split()
+        msg_type = parts[0]
+
+        # Prompting handlers run apart from the connection's reader
+        if msg_type == "INFORM_Req":
+            self.spawn(self.process_inform_request, conn, addr, parts)
+        elif msg_type == "Shipping_Info":
+            self.process_shipping_info(conn, addr, parts)
+        elif msg_type == "CANCEL":
+            self.spawn(self.process_cancel_transaction, conn, addr, parts)
+        else:
+            logging.warning(f"Unknown TCP message type received: {msg_type}")
+        return msg_type
+
     # Process an INFORM_Req message.
     def process_inform_request(self, conn, addr, parts):
         rq_number, item_name, price = parts[1], parts[2], parts[3]
@@ -393,45 +634,13 @@ class Peer:
 
         with self.input_lock:
             self.in_tcp = True
-            self.input_needed = True
-            self.input_prompt = "Credit Card number: "
-            self.input_response = None
-
-        self.input_received_event.clear()
-        self.input_available_event.set()
-        self.input_received_event.wait()
-
-        with self.input_lock:
-            cc_number = self.input_response
-            self.input_needed = False
+        cc_number = self.ask_user("card_number", "Credit Card number: ", item_name=item_name, price=price)
 
         # Collect expiry date
-        with self.input_lock:
-            self.input_needed = True
-            self.input_prompt = "Expiry date (MM/YY): "
-            self.input_response = None
-
-        self.input_received_event.clear()
-        self.input_available_event.set()
-        self.input_received_event.wait()
-
-        with self.input_lock:
-            cc_expiry = self.input_response
-            self.input_needed = False
+        cc_expiry = self.ask_user("card_expiry", "Expiry date (MM/YY): ", item_name=item_name, price=price)
 
         # Collect address
-        with self.input_lock:
-            self.input_needed = True
-            self.input_prompt = "Address: "
-            self.input_response = None
-
-        self.input_received_event.clear()
-        self.input_available_event.set()
-        self.input_received_event.wait()
-
-        with self.input_lock:
-            address = self.input_response
-            self.input_needed = False
+        address = self.ask_user("shipping_address", "Address: ", item_name=item_name, price=price)
 
         # Send INFORM_Res response
         response = f"INFORM_Res {rq_number} {self.name} {cc_number} {cc_expiry} {address}"
@@ -602,6 +811,12 @@ class Peer:
         except Exception as e:
             print(f"Error closing UDP socket: {e}")
 
+        self.inventory.close()  # Write back any inventory changes still pending
+        if self.catalog_engine is not None:
+            self.catalog_engine.close()
+        if self.owns_timers:
+            self.timers.stop()
+
         for thread in self.threads:
             if thread is threading.current_thread():
                 continue  # Skip joining current thread
@@ -0,0 +1,217 @@
+# peer_host.py
+import argparse
+import logging
+import selectors
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from logqueue import setup_logging
+from peer import Peer
+from policy import load_policy
+from scheduler import TimerScheduler
+from tcp_pool import FRAME_HEADER, FRAME_MARKER, MAX_FRAME, FrameWriter
+
+SELECT_TIMEOUT = 0.5  # Longest the host's loop waits before checking whether it should stop
+TCP_TIMEOUT = 5  # Longest a hosted peer waits to send a TCP reply
+
+
+# Answers the questions of headless peers that have no policy of their own: negotiations and
+# purchases are declined, and the peer's stored client details are used for payment and shipping.
+def headless_policy(peer, question, details):
+    if question in ("negotiate", "buy"):
+        return "n"
+    if question == "card_number":
+        return peer.client.credit_card.number
+    if question == "card_expiry":
+        return peer.client.credit_card.expiry_date
+    if question == "shipping_address":
+        return peer.client.address
+    return None
+
+
+# Read a roster of "<name> <udp port> <tcp port>" lines, like test_peers.txt.
+def read_roster(path):
+    roster = []
+    with open(path, "r") as file:
+        for line in file:
+            fields = line.split()
+            if len(fields) >= 3:
+                roster.append((fields[0], int(fields[1]), int(fields[2])))
+    return roster
+
+
+# A TCP connection from the server to a hosted peer, read without blocking the host's loop.
+class HostedConnection:
+    def __init__(self, peer, conn, addr):
+        self.peer = peer
+        self.conn = conn
+        self.addr = addr
+        self.buffer = b""
+        self.framed = None  # Decided by the first byte, like Peer.handle_tcp_connection
+        self.writer = None
+
+
+# Runs many Peer instances in one process, without consoles. A single selector loop multiplexes the
+# UDP sockets, TCP listeners and TCP connections of every peer; message handlers run on a small
+# thread pool and every prompt is answered by the peers' policy hook.
+class PeerHost:
+    def __init__(self, roster, server_address, bind_ip="127.0.0.1", workers=8, policy=headless_policy,
+                 binary=True, reliable=True):
+        self.server_address = tuple(server_address)
+        self.selector = selectors.DefaultSelector()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="peer-host")
+        self.timers = TimerScheduler()
+        self.running = False
+        self.thread = None
+        self.peers = []
+        for name, udp_port, tcp_port in roster:
+            # A peer's own policy file comes first, the host's policy answers what it leaves open
+            peer_policy = load_policy(f"{name}_policy.json", fallback=policy) or policy
+            peer = Peer(name, udp_port, tcp_port, binary=binary, reliable=reliable, address=bind_ip,
+                        server_address=self.server_address, timers=self.timers, policy=peer_policy,
+                        background=False, executor=self.executor)
+            self.peers.append(peer)
+            self.selector.register(peer.udp_socket, selectors.EVENT_READ, ("udp", peer))
+            listener = peer.open_tcp_listener(backlog=64)
+            listener.setblocking(False)
+            self.selector.register(listener, selectors.EVENT_READ, ("listen", peer))
+        logging.info(f"Hosting {len(self.peers)} peers, server at {self.server_address}")
+
+    def start(self):
+        self.running = True
+        for peer in self.peers:
+            self.schedule_flush(peer)
+        self.thread = threading.Thread(target=self.run, name="peer-host-loop", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            for key, _ in self.selector.select(timeout=SELECT_TIMEOUT):
+                kind, target = key.data
+                try:
+                    if kind == "udp":
+                        self.read_udp(target)
+                    elif kind == "listen":
+                        self.accept(key.fileobj, target)
+                    else:
+                        self.read_tcp(target)
+                except Exception as e:
+                    logging.error(f"Error in peer host loop ({kind}): {e}")
+
+    # Write the peer's inventory back every flush interval of its store, on the handler pool.
+    def schedule_flush(self, peer):
+        def flush():
+            if not self.running:
+                return
+            self.executor.submit(peer.inventory.flush_if_dirty)
+            self.schedule_flush(peer)
+
+        self.timers.schedule(peer.inventory.flush_interval, flush, key=("inventory-flush", peer.name))
+
+    def read_udp(self, peer):
+        try:
+            data, addr = peer.udp_socket.recvfrom(1024)
+        except BlockingIOError:
+            return
+        self.executor.submit(peer.handle_server_message, data, addr)
+
+    def accept(self, listener, peer):
+        try:
+            conn, addr = listener.accept()
+        except BlockingIOError:
+            return
+        logging.info(f"{peer.name} accepted TCP connection from {addr}")
+        conn.settimeout(TCP_TIMEOUT)
+        self.selector.register(conn, selectors.EVENT_READ, ("tcp", HostedConnection(peer, conn, addr)))
+
+    def read_tcp(self, connection):
+        try:
+            chunk = connection.conn.recv(65536)
+        except OSError:
+            chunk = b""
+        if not chunk:
+            self.close_connection(connection)
+            return
+        peer = connection.peer
+        if connection.framed is None:
+            connection.framed = chunk[:1] == FRAME_MARKER
+            if connection.framed:
+                connection.writer = FrameWriter(connection.conn, threading.Lock())
+        if not connection.framed:
+            # One message per read, as Peer.handle_tcp_connection does
+            if peer.dispatch_tcp_message(connection.conn, connection.addr, chunk.decode()) == "Shipping_Info":
+                self.close_connection(connection)
+            return
+        connection.buffer += chunk
+        while len(connection.buffer) >= FRAME_HEADER.size:
+            marker, length = FRAME_HEADER.unpack_from(connection.buffer)
+            if marker != FRAME_MARKER or length > MAX_FRAME:
+                logging.error(f"Malformed frame from {connection.addr}, closing the channel")
+                self.close_connection(connection)
+                return
+            end = FRAME_HEADER.size + length
+            if len(connection.buffer) < end:
+                break
+            payload, connection.buffer = connection.buffer[FRAME_HEADER.size:end], connection.buffer[end:]
+            peer.dispatch_tcp_message(connection.writer, connection.addr, payload.decode())
+
+    def close_connection(self, connection):
+        try:
+            self.selector.unregister(connection.conn)
+        except (KeyError, ValueError):
+            pass
+        connection.conn.close()
+        logging.info(f"Connection with {connection.addr} closed.")
+
+    # Register every hosted peer at once, without waiting for one reply before the next REGISTER.
+    # Returns the number of peers the server registered.
+    def register_all(self, timeout=30):
+        futures = [peer.register_async() for peer in self.peers]
+        wait(futures, timeout=timeout)
+        registered = sum(1 for peer in self.peers if peer.is_registered)
+        print(f"{registered} of {len(self.peers)} peers registered.")
+        return registered
+
+    def deregister_all(self, timeout=30):
+        futures = [peer.deregister_async() for peer in self.peers if peer.is_registered]
+        wait(futures, timeout=timeout)
+
+    def shutdown(self):
+        self.running = False
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout=2)
+        for key in list(self.selector.get_map().values()):
+            if key.data[0] != "udp":
+                key.fileobj.close()  # Peer.shutdown closes the UDP sockets
+        self.selector.close()
+        for peer in self.peers:
+            peer.shutdown()
+        self.executor.shutdown(wait=False)
+        self.timers.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run many headless peers in one process")
+    parser.add_argument("--roster", default="test_peers.txt", help="File of '<name> <udp port> <tcp port>' lines")
+    parser.add_argument("--server-ip", default="127.0.0.1", help="Server IP")
+    parser.add_argument("--server-port", type=int, default=3000, help="Server UDP port")
+    parser.add_argument("--bind-ip", default="127.0.0.1", help="IP the hosted peers bind to and register with")
+    parser.add_argument("--workers", type=int, default=8, help="Threads running the peers' message handlers")
+    parser.add_argument("--no-register", action="store_true", help="Do not register the peers on startup")
+    args = parser.parse_args()
+
+    setup_logging("peer_host.log")
+    host = PeerHost(read_roster(args.roster), (args.server_ip, args.server_port), bind_ip=args.bind_ip,
+                    workers=args.workers)
+    host.start()
+    if not args.no_register:
+        host.register_all()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        print("\nShutting down peer host...")
+    finally:
+        if not args.no_register:
+            host.deregister_all()
+        host.shutdown()
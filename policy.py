@@ -0,0 +1,71 @@
+# policy.py
+import json
+import os
+
+from catalog_index import normalize_item
+
+PROFILE_QUESTIONS = ("card_number", "card_expiry", "shipping_address")
+
+
+# Declarative answers to the questions a peer is asked during a transaction, so that NEGOTIATE,
+# FOUND and INFORM_Req are answered without waiting for someone at the console. Loaded from a JSON
+# file such as <peer_name>_policy.json:
+#   {
+#       "sell": {"lamp": {"min_price": 35}},      # Accept a negotiation at min_price or above
+#       "buy": {"lamp": {"max_price": 50}},       # Buy a found item at max_price or below
+#       "profile": {"card_number": "4111-1111-1111-1111", "card_expiry": "12/30",
+#                   "shipping_address": "Montreal"}
+#   }
+# A "*" item applies to every item without a rule of its own. Questions about items without a rule
+# return None, so the peer falls back to `fallback` (the console prompt when there is none).
+class PeerPolicy:
+    def __init__(self, sell=None, buy=None, profile=None, fallback=None):
+        self.sell = {item if item == "*" else normalize_item(item): rule for item, rule in (sell or {}).items()}
+        self.buy = {item if item == "*" else normalize_item(item): rule for item, rule in (buy or {}).items()}
+        self.profile = dict(profile or {})
+        self.fallback = fallback
+
+    # Called as policy(peer, question, details) by Peer.ask_user.
+    def __call__(self, peer, question, details):
+        answer = self.answer(question, details)
+        if answer is None and self.fallback is not None:
+            return self.fallback(peer, question, details)
+        return answer
+
+    def answer(self, question, details):
+        if question == "negotiate":
+            rule = self.rule(self.sell, details['item_name'])
+            if rule is not None:
+                return "y" if float(details['price']) >= float(rule['min_price']) else "n"
+        elif question == "buy":
+            rule = self.rule(self.buy, details['item_name'])
+            if rule is not None:
+                return "y" if float(details['price']) <= float(rule['max_price']) else "n"
+        elif question in PROFILE_QUESTIONS:
+            # Payment and shipping details are only given for transactions the policy decided on
+            if self.rule(self.sell, details['item_name']) is not None or \
+                    self.rule(self.buy, details['item_name']) is not None:
+                return self.profile.get(question)
+        return None
+
+    @staticmethod
+    def rule(rules, item_name):
+        rule = rules.get(normalize_item(item_name))
+        return rule if rule is not None else rules.get("*")
+
+    def to_dict(self):
+        return {"sell": self.sell, "buy": self.buy, "profile": self.profile}
+
+
+# Policy stored in a JSON file, or None if the file does not exist.
+def load_policy(path, fallback=None):
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as file:
+        data = json.load(file)
+    return PeerPolicy(data.get("sell"), data.get("buy"), data.get("profile"), fallback=fallback)
+
+
+def save_policy(path, policy):
+    with open(path, "w") as file:
+        json.dump(policy.to_dict(), file, indent=4)
@@ -0,0 +1,203 @@
+# reliable.py
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+
+# Thin reliability layer over the UDP protocol, enabled for peers that advertise FEATURE_RELIABLE at
+# REGISTER time. Every message except ACK is acknowledged with "ACK <rq_number> <msg_type>", senders
+# retransmit unacknowledged messages with exponential backoff based on the measured round-trip time,
+# and receivers drop duplicates (the server replays its earlier reply from a ResponseCache).
+FEATURE_RELIABLE = "REL1"
+MAX_ATTEMPTS = 6
+
+# Replies that answer a request, by the request type they answer. A reply also acknowledges the request.
+REPLY_TO = {
+    "REGISTERED": "REGISTER",
+    "REGISTER-DENIED": "REGISTER",
+    "DE-REGISTERED": "DE-REGISTER",
+    "DE-REGISTER-DENIED": "DE-REGISTER",
+    "FOUND": "LOOKING_FOR",
+    "NOT_AVAILABLE": "LOOKING_FOR",
+    "NOT_FOUND": "LOOKING_FOR",
+}
+
+
+# Retransmission timeout from smoothed RTT samples (RFC 6298).
+class RttEstimator:
+    def __init__(self, initial_rto=0.3, min_rto=0.05, max_rto=5.0):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(self.max_rto, max(self.min_rto, self.srtt + 4 * self.rttvar))
+
+
+class PendingMessage:
+    __slots__ = ("key", "data", "addr", "attempts", "first_sent", "last_sent")
+
+    def __init__(self, key, data, addr):
+        self.key = key
+        self.data = data
+        self.addr = addr
+        self.attempts = 0
+        self.first_sent = None
+        self.last_sent = None
+
+
+# Tracks sent messages until they are acknowledged and retransmits them on a TimerScheduler.
+# `send` is the raw send function, called as send(data, addr).
+class RetransmitQueue:
+    def __init__(self, scheduler, send, max_attempts=MAX_ATTEMPTS):
+        self.scheduler = scheduler
+        self.send = send
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.pending = {}  # key -> PendingMessage
+        self.estimators = {}  # addr -> RttEstimator
+        self.retransmissions = 0
+        self.failures = 0
+
+    def estimator(self, addr):
+        estimator = self.estimators.get(addr)
+        if estimator is None:
+            estimator = self.estimators.setdefault(addr, RttEstimator())
+        return estimator
+
+    # Send data and keep retransmitting it until ack(key) is called.
+    def track(self, key, data, addr):
+        message = PendingMessage(key, data, addr)
+        with self.lock:
+            self.pending[key] = message
+        self.transmit(message)
+
+    def transmit(self, message):
+        with self.lock:
+            if self.pending.get(message.key) is not message:
+                return  # Acknowledged meanwhile
+            if message.attempts >= self.max_attempts:
+                del self.pending[message.key]
+                self.failures += 1
+                logging.warning(f"Giving up on {message.key} to {message.addr} after {message.attempts} attempts")
+                return
+            if message.attempts:
+                self.retransmissions += 1
+            message.attempts += 1
+            message.last_sent = time.monotonic()
+            if message.first_sent is None:
+                message.first_sent = message.last_sent
+            # Exponential backoff on top of the current timeout for this destination
+            delay = self.estimator(message.addr).rto * (2 ** (message.attempts - 1))
+        self.send(message.data, message.addr)
+        self.scheduler.schedule(delay, lambda: self.transmit(message), key=self.timer_key(message.key))
+
+    # Time it takes a message to addr to get through even if its first attempts are lost: the backoff
+    # delays transmit waits after each attempt, rto * (1 + 2 + ... + 2**(max_attempts - 1)). A reply
+    # awaited for less than this is given up on while the message may still be on its way.
+    def recovery_time(self, addr):
+        with self.lock:
+            return self.estimator(addr).rto * (2 ** self.max_attempts - 1)
+
+    # Returns True if key was pending.
+    def ack(self, key):
+        with self.lock:
+            message = self.pending.pop(key, None)
+            if message is None:
+                return False
+            if message.attempts == 1:
+                # Karn's rule: only unambiguous samples update the estimate
+                self.estimator(message.addr).sample(time.monotonic() - message.last_sent)
+        self.scheduler.cancel(self.timer_key(key))
+        return True
+
+    # Queues may share a scheduler (e.g. the peers of a PeerHost), so their timer keys name the queue.
+    def timer_key(self, key):
+        return ("retransmit", id(self), key)
+
+    def __len__(self):
+        return len(self.pending)
+
+
+# Bounded LRU of requests already handled, keyed by (msg_type, rq_number, addr), with the replies
+# that were sent for them, so duplicates are answered by replaying instead of re-executing.
+class ResponseCache:
+    def __init__(self, capacity=8192):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+
+    # Record a newly seen request. Returns the replies recorded so far if it is a duplicate, else None.
+    def check_and_add(self, key):
+        with self.lock:
+            replies = self.entries.get(key)
+            if replies is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return list(replies)
+            self.entries[key] = []
+            if len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+            return None
+
+    def record(self, key, reply):
+        with self.lock:
+            replies = self.entries.get(key)
+            if replies is not None:
+                replies.append(reply)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# Small LRU set of (msg_type, rq_number) pairs a peer has already processed.
+class SeenSet:
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    # Returns True if key was seen before.
+    def check_and_add(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return True
+            self.entries[key] = None
+            if len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+            return False
+
+
+# Socket wrapper that drops outgoing datagrams with probability `loss`, to exercise the
+# reliability layer on a local machine. Everything except sendto is passed to the real socket.
+class LossySocket:
+    def __init__(self, sock, loss=0.0, seed=None):
+        self.sock = sock
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.dropped = 0
+
+    def should_drop(self):
+        if self.loss > 0 and self.random.random() < self.loss:
+            self.dropped += 1
+            return True
+        return False
+
+    def sendto(self, data, addr):
+        if self.should_drop():
+            return len(data)
+        return self.sock.sendto(data, addr)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
@@ -0,0 +1,155 @@
+# replay.py
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from archive import read_archive
+from capture import read_trace
+from journal import Journal
+from reliable import LossySocket
+from server import ROUTING_MODES, STATE_BACKENDS, Server
+from sqlite_store import SqliteStore
+from tcp_pool import ChannelClosed
+import wire
+
+# Request fields that depend on when the server handled a message rather than on what it received
+VOLATILE_FIELDS = {"searched_at", "finished_at", "archived_at"}
+EXAMPLES = 10  # Diverging keys listed in the report, per kind
+
+
+# Stands in for the server's TCP pool during a replay: the peers of the trace are not there to answer.
+class OfflineChannelPool:
+    def get(self, address):
+        raise ChannelClosed(f"No TCP channel to {tuple(address)} during a replay")
+
+    def close(self, address):
+        pass
+
+    def close_all(self):
+        pass
+
+
+# Peers and requests of a stopped server: its snapshot, journal (or SQLite database) and archive together.
+def load_state(server_file):
+    base = os.path.splitext(server_file)[0]
+    registered_peers, requests = {}, {}
+    if os.path.exists(f"{base}.sqlite"):
+        store = SqliteStore(f"{base}.sqlite")
+        store.replay(registered_peers, requests)
+        store.close()
+    else:
+        if os.path.exists(server_file):
+            with open(server_file, "r") as file:
+                data = json.load(file)
+            registered_peers = data.get("registered_peers", {})
+            requests = data.get("active_requests", {})
+        Journal(f"{base}.journal").replay(registered_peers, requests)
+    for record in read_archive(f"{base}.archive.jsonl"):
+        rq_number = record.pop('rq_number')
+        requests.setdefault(rq_number, record)
+    return registered_peers, requests
+
+
+# Compare two {key: value} maps, ignoring volatile fields and the order of lists.
+def diverging(expected, actual):
+    def normalize(value):
+        if isinstance(value, dict):
+            return {key: normalize(item) for key, item in value.items() if key not in VOLATILE_FIELDS}
+        if isinstance(value, (list, tuple)):
+            return sorted((normalize(item) for item in value), key=lambda item: json.dumps(item, sort_keys=True))
+        return value
+
+    missing = [key for key in expected if key not in actual]
+    extra = [key for key in actual if key not in expected]
+    changed = [key for key in expected if key in actual and normalize(expected[key]) != normalize(actual[key])]
+    return {
+        "expected": len(expected), "actual": len(actual),
+        "missing": len(missing), "extra": len(extra), "changed": len(changed),
+        "examples": {"missing": missing[:EXAMPLES], "extra": extra[:EXAMPLES], "changed": changed[:EXAMPLES]},
+    }
+
+
+# Feed a trace into a fresh Server through handle_udp_message. speed is a multiple of the recorded
+# pace (1 replays in real time), None replays as fast as possible. Replies are dropped instead of
+# sent and BUY transactions fail at once, so the peers of the trace are never contacted.
+def replay(trace_path, state_dir, speed=None, routing="catalog", settle=1.0, reference=None, state_backend="journal"):
+    server_file = os.path.join(state_dir, "server.json")
+    if any(os.path.exists(os.path.join(state_dir, name)) for name in ("server.json", "server.journal", "server.sqlite")):
+        raise ValueError(f"{state_dir} already holds server state, replay needs a fresh directory")
+    server = Server(server_file=server_file, fsync_policy="never", routing=routing, archive_ttl=None,
+                    state_backend=state_backend)
+    server.outgoing = LossySocket(server.server_socket, loss=1.0)
+    server.tcp_pool = OfflineChannelPool()
+
+    counts = {}
+    handled = 0
+    lag = 0.0  # Furthest behind the recorded pace, in seconds
+    first = None
+    started = time.perf_counter()
+    busy = 0.0
+    for timestamp, addr, data in read_trace(trace_path):
+        if speed is not None:
+            if first is None:
+                first = timestamp
+            due = started + (timestamp - first) / speed
+            now = time.perf_counter()
+            if due > now:
+                time.sleep(due - now)
+            else:
+                lag = max(lag, now - due)
+        msg_type = wire.message_type(data) or "?"
+        counts[msg_type] = counts.get(msg_type, 0) + 1
+        handle_started = time.perf_counter()
+        server.handle_udp_message(data, addr)
+        busy += time.perf_counter() - handle_started
+        handled += 1
+    elapsed = time.perf_counter() - started
+    time.sleep(settle)  # Let search timeouts and offer windows that are due close
+
+    report = {
+        "datagrams": handled,
+        "seconds": elapsed,
+        "datagrams_per_sec": handled / elapsed if elapsed else None,
+        # Rate the handlers alone sustain, without the waits of a paced replay
+        "handler_datagrams_per_sec": handled / busy if busy else None,
+        "max_lag": lag,
+        "types": counts,
+        "state_dir": state_dir,
+    }
+    if reference is not None:
+        expected_peers, expected_requests = load_state(reference)
+        report["divergence"] = {
+            "registered_peers": diverging(expected_peers, server.registered_peers),
+            "requests": diverging(expected_requests, dict(server.active_requests)),
+        }
+    server.timers.stop()
+    server.store.close()  # Leaves the replayed state in state_dir
+    return report
+
+
+def parse_speed(text):
+    return None if text == "max" else float(text.rstrip("x"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a recorded server trace against a fresh server")
+    parser.add_argument("trace", help="Trace file recorded with server.py --trace")
+    parser.add_argument("--speed", default="max", help="1x, Nx (e.g. 10x) or max (default: max)")
+    parser.add_argument("--state-dir", help="Fresh directory for the replayed state (default: a new temporary one)")
+    parser.add_argument("--reference", help="State file of the recorded server (e.g. server.json), to report divergence")
+    parser.add_argument("--routing", choices=ROUTING_MODES, default="catalog", help="Routing mode of the replayed server")
+    parser.add_argument("--state-backend", choices=STATE_BACKENDS, default="journal",
+                        help="State backend of the replayed server")
+    parser.add_argument("--settle", type=float, default=1.0, help="Seconds to let timers run after the last datagram")
+    args = parser.parse_args()
+
+    state_dir = args.state_dir or tempfile.mkdtemp(prefix="p2p-replay-")
+    os.makedirs(state_dir, exist_ok=True)
+    stdout, sys.stdout = sys.stdout, open(os.devnull, "w")  # The server prints every event
+    report = replay(args.trace, state_dir, speed=parse_speed(args.speed), routing=args.routing,
+                    settle=args.settle, state_backend=args.state_backend, reference=os.path.abspath(args.reference) if args.reference else None)
+    sys.stdout = stdout
+    print(json.dumps(report, indent=2))
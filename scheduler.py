@@ -0,0 +1,131 @@
+# scheduler.py
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+
+# A pending callback owned by a TimerScheduler.
+class Timer:
+    __slots__ = ("deadline", "key", "callback", "lock", "cancelled")
+
+    def __init__(self, deadline, key, callback, lock):
+        self.deadline = deadline
+        self.key = key
+        self.callback = callback
+        self.lock = lock
+        self.cancelled = False
+
+    def remaining(self):
+        return max(0.0, self.deadline - time.monotonic())
+
+
+# Single-threaded, heap-based scheduler that owns every request deadline on the server.
+# Callbacks fire on the scheduler thread while holding the lock given for the timer (the lock of the
+# request it belongs to), so a timer cancelled under that lock is guaranteed not to fire afterwards.
+# A callback may return a function, which is run after the lock is released (e.g. to send replies).
+# Timers are identified by a key such as (rq_number, "search"), which makes them easy to cancel and inspect.
+class TimerScheduler:
+    def __init__(self, lock=None):
+        self.lock = lock if lock is not None else threading.RLock()  # Used for timers scheduled without a lock
+        self.heap = []  # (deadline, sequence, timer)
+        self.timers = {}  # key -> live timer
+        self.cancelled_in_heap = 0
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="timer-scheduler", daemon=True)
+        self.thread.start()
+
+    # Run `callback` after `delay` seconds. A live timer with the same key is replaced.
+    def schedule(self, delay, callback, key, lock=None):
+        timer = Timer(time.monotonic() + delay, key, callback, lock if lock is not None else self.lock)
+        with self.condition:
+            previous = self.timers.get(key)
+            if previous is not None:
+                previous.cancelled = True
+                self.cancelled_in_heap += 1
+            self.timers[key] = timer
+            heapq.heappush(self.heap, (timer.deadline, next(self.sequence), timer))
+            if self.heap[0][2] is timer:
+                self.condition.notify()  # New earliest deadline, wake the scheduler thread up
+        return timer
+
+    # Move the live timer with the given key to fire after `delay` seconds instead. Returns False if
+    # there is no such timer (it already fired or was cancelled).
+    def reschedule(self, key, delay):
+        with self.condition:
+            previous = self.timers.get(key)
+            if previous is None:
+                return False
+            previous.cancelled = True
+            self.cancelled_in_heap += 1
+            timer = Timer(time.monotonic() + delay, key, previous.callback, previous.lock)
+            self.timers[key] = timer
+            heapq.heappush(self.heap, (timer.deadline, next(self.sequence), timer))
+            if self.heap[0][2] is timer:
+                self.condition.notify()
+            return True
+
+    # Cancel the timer with the given key. Returns True if a live timer was cancelled.
+    def cancel(self, key):
+        with self.condition:
+            timer = self.timers.pop(key, None)
+            if timer is None:
+                return False
+            timer.cancelled = True
+            self.cancelled_in_heap += 1
+            # Cancelled entries are skipped lazily; rebuild the heap once they dominate it
+            if self.cancelled_in_heap > 64 and self.cancelled_in_heap * 2 > len(self.heap):
+                self.heap = [entry for entry in self.heap if not entry[2].cancelled]
+                heapq.heapify(self.heap)
+                self.cancelled_in_heap = 0
+            return True
+
+    # Snapshot of live timers as {key: seconds until it fires}.
+    def pending(self):
+        with self.condition:
+            return {key: timer.remaining() for key, timer in self.timers.items()}
+
+    def __len__(self):
+        return len(self.timers)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running:
+                    if self.heap and self.heap[0][2].cancelled:
+                        heapq.heappop(self.heap)
+                        self.cancelled_in_heap = max(0, self.cancelled_in_heap - 1)
+                        continue
+                    timeout = self.heap[0][0] - time.monotonic() if self.heap else None
+                    if timeout is not None and timeout <= 0:
+                        break
+                    self.condition.wait(timeout)
+                if not self.running:
+                    return
+                _, _, timer = heapq.heappop(self.heap)
+            after = None
+            with timer.lock:
+                with self.condition:
+                    if timer.cancelled:
+                        self.cancelled_in_heap = max(0, self.cancelled_in_heap - 1)
+                        continue
+                    timer.cancelled = True  # Fired timers cannot be cancelled any more
+                    if self.timers.get(timer.key) is timer:
+                        del self.timers[timer.key]
+                try:
+                    after = timer.callback()
+                except Exception as e:
+                    logging.error(f"Error in timer {timer.key}: {e}")
+            if after is not None:
+                try:
+                    after()
+                except Exception as e:
+                    logging.error(f"Error after timer {timer.key}: {e}")
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
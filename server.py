@@ -1,4 +1,7 @@
 # server.py
+import argparse
+import asyncio
+import ipaddress
 import socket
 import threading
 import logging
@@ -8,63 +11,506 @@ import signal
 import sys
 import time
 import uuid
-
-logging.basicConfig(
-    filename="server.log",  # Log to file
-    level=logging.INFO,     # Log messages of level INFO and above
-    format="%(asctime)s - %(levelname)s - %(message)s"  # Include timestamp and level
-)
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from archive import FINISHED_STATUSES, RequestArchive
+from capture import TraceWriter
+from catalog_index import CatalogIndex, parse_catalog_entries
+from cluster import WorkerRouter, start_workers, worker_file
+from federation import FEDERATION_MESSAGES, Federation, parse_siblings
+from journal import FSYNC_POLICIES, Journal, PUT_PEER, DEL_PEER, PUT_REQUEST, DEL_REQUEST
+from locks import ContendedLock, LockStripes
+from logqueue import category, configure_sampling, parse_category_values, setup_logging
+from metrics import LatencyRecorder, MetricsRegistry
+from orderbook import OrderBook
+from sqlite_store import SqliteStore
+from reliable import FEATURE_RELIABLE, REPLY_TO, LossySocket, ResponseCache, RetransmitQueue, RttEstimator
+from scheduler import TimerScheduler
+from tcp_pool import ChannelClosed, ChannelPool
+import wire
+
+SERVER_MODES = ("threaded", "asyncio")
+ROUTING_MODES = ("catalog", "broadcast")
+# journal: JSON snapshot plus append-only journal, sqlite: SQLite database with indexed queries
+STATE_BACKENDS = ("journal", "sqlite")
+# Message types whose handlers block on the network and run on an executor in asyncio mode
+BLOCKING_MESSAGES = {"BUY", "FED_TCP"}
+SEARCH_TIMEOUT = 120  # Seconds to wait for a first OFFER before answering NOT_AVAILABLE
+OFFER_WINDOW = 10  # Seconds to collect further offers after the first one arrives
+# Both deadlines shrink to the expected answer time of the sellers a SEARCH went to, once their
+# answer latency is known, but never below this many seconds, nor below the time the reliability
+# layer needs to retransmit a lost SEARCH or OFFER to a seller that uses it
+MIN_ANSWER_WINDOW = 0.5
+TRANSACTION_TIMEOUT = 300  # Seconds buyer and seller get to answer INFORM_Req (they type in their details)
+SUPPORTED_FEATURES = {wire.FEATURE_BINARY, FEATURE_RELIABLE, wire.FEATURE_PRICED_SEARCH, wire.FEATURE_DESCRIPTION_MATCH}  # Optional protocol features a peer may ask for at REGISTER
+RQ_ALIAS_LIMIT = 65536  # Text rq_numbers remembered for binary peers that refer to them by request id
+ARCHIVE_TTL = 300  # Seconds a finished request stays in active_requests before it is moved to the archive
+METRICS_INTERVAL = 10  # Seconds between two dumps of the metrics file
+
+# Log to server.log through a background writer thread, INFO and above
+setup_logging("server.log")
+udp_log = category("udp")
+search_log = category("search")
+catalog_log = category("catalog")
 
 class Server:
-    def __init__(self):
+    def __init__(self, server_file="server.json", fsync_policy="interval", compact_every=5000, mode="threaded",
+                 address=None, routing="catalog", loss=0.0, archive_ttl=ARCHIVE_TTL, trace_file=None,
+                 metrics_file=None, metrics_interval=METRICS_INTERVAL, state_backend="journal", router=None,
+                 federation=None, price_tolerance=None):
+        if mode not in SERVER_MODES:
+            raise ValueError(f"Unknown server mode '{mode}', expected one of {SERVER_MODES}")
+        if routing not in ROUTING_MODES:
+            raise ValueError(f"Unknown routing mode '{routing}', expected one of {ROUTING_MODES}")
+        if state_backend not in STATE_BACKENDS:
+            raise ValueError(f"Unknown state backend '{state_backend}', expected one of {STATE_BACKENDS}")
+        self.routing = routing  # catalog: SEARCH only sellers that stock the item, broadcast: SEARCH every peer
+        self.mode = mode
+        self.address = address  # (ip, udp_port) to bind, prompted for when not given
+        self.trace = TraceWriter(trace_file) if trace_file else None  # Records every received datagram
+        # WorkerRouter of a multi-worker server: the UDP port is shared with the other workers, and
+        # datagrams owned by another worker are forwarded to it (see cluster.py)
+        self.router = router
+        # Federation with sibling servers, each owning its own peers: searches also go to the
+        # siblings' sellers, and messages for those sellers go through their server (see federation.py)
+        self.federation = federation
+        # When set, sellers that registered with FEATURE_PRICED_SEARCH get the buyer's bid with the
+        # SEARCH and only offer units priced within bid * (1 + price_tolerance)
+        self.price_tolerance = price_tolerance
+        # Only used in asyncio mode
+        self.loop = None
+        self.loop_thread_id = None
+        self.transport = None
+        self.serving = None  # asyncio.Event set to stop serving
+        self.stopped = threading.Event()  # Set by stop()
+        self.executor = None
         self.registered_peers = {}
         self.rq_counter = 0
-        self.peer_lock = threading.RLock() # Use a reentrant lock
+        self.peer_lock = ContendedLock(timed=True)  # Serializes writers of registered_peers; readers never take it
+        self.request_locks = LockStripes()  # Per-request locks, sharded by rq_number
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # Single socket for both send and receive
-        self.server_file = "server.json"
+        self.outgoing = LossySocket(self.server_socket, loss)  # Drops a share of sent datagrams when loss > 0
+        self.server_file = server_file  # Snapshot of the server state
+        # Durable copy of the state, kept in step with every change by persist_peer and persist_request.
+        # Both backends only queue changes on the handlers' threads and write them in the background.
+        self.state_backend = state_backend
+        if state_backend == "sqlite":
+            self.store = SqliteStore(f"{os.path.splitext(server_file)[0]}.sqlite", fsync_policy=fsync_policy,
+                                     on_failure=self.store_failed)
+        else:
+            self.store = Journal(f"{os.path.splitext(server_file)[0]}.journal", fsync_policy=fsync_policy,
+                                 compact_every=compact_every, on_compact=self.save_server_state)
         self.active_requests = {}
-        # Load server state from the file, if it is not empty
+        # Secondary indexes, changed together with active_requests under the request lock:
+        #   requests_by_peer: peer name -> rq_numbers of that peer's requests (guarded by index_lock too,
+        #                     since requests of one peer are spread over several request locks)
+        #   offers_by_address: rq_number -> {seller address: offer}
+        self.requests_by_peer = {}
+        self.offers_by_address = {}
+        self.index_lock = threading.Lock()  # Only ever taken last, for a single index update
+        self.timers = TimerScheduler()  # Owns the search timeouts, offer windows and archive deadlines
+        # Finished requests are moved out of active_requests after archive_ttl seconds (None keeps them)
+        self.archive_ttl = archive_ttl
+        self.archive = RequestArchive(f"{os.path.splitext(server_file)[0]}.archive.jsonl")
+        # Load server state from the snapshot and journal, if there is one
         self.load_server_state()
+        self.store.open()
+        for rq_number, details in list(self.active_requests.items()):
+            if details.get('status') in FINISHED_STATUSES:
+                self.schedule_archive(rq_number, details)
+        self.catalog = CatalogIndex()
+        self.order_book = OrderBook()  # Standing asks of sellers and queued bids of buyers, per item
+        self.answer_times = {}  # seller name -> RttEstimator of the time it takes to answer a SEARCH
+        self.answer_times_lock = threading.Lock()
+        self.time_to_found = LatencyRecorder()  # From LOOKING_FOR to FOUND
+        self.tcp_pool = ChannelPool()  # Persistent TCP channels to the peers, for BUY transactions
+        # Peers that have not pushed a catalog yet (e.g. older clients) still receive every SEARCH
+        # Replaced as a whole under peer_lock, like registered_peers, so readers never take the lock
+        self.uncatalogued_peers = frozenset(self.registered_peers)
+        # Peers that match searches by description: their catalog does not tell which searches they can answer
+        self.matching_peers = frozenset(
+            name for name, info in self.registered_peers.items()
+            if wire.FEATURE_DESCRIPTION_MATCH in info.get('features', ()))
+        # Addresses of peers that negotiated the binary wire encoding
+        self.binary_peers = frozenset(
+            tuple(info['address']) for info in self.registered_peers.values()
+            if wire.FEATURE_BINARY in info.get('features', ()))
+        # Addresses of peers that negotiated acks and retransmission
+        self.reliable_peers = frozenset(
+            tuple(info['address']) for info in self.registered_peers.values()
+            if FEATURE_RELIABLE in info.get('features', ()))
+        self.retransmits = RetransmitQueue(self.timers, self.send_raw)
+        self.response_cache = ResponseCache()  # Replies to already handled requests, replayed for duplicates
+        self.rq_aliases = OrderedDict()  # request id -> text rq_number, for text requests seen by binary peers
+        self.rq_alias_lock = threading.Lock()
+        self.metrics = MetricsRegistry(prefix="p2p_server")
+        self.metrics_file = metrics_file  # Prometheus text dumped here every metrics_interval seconds
+        self.metrics_interval = metrics_interval
+        self.register_metrics()
 
     def load_server_state(self):
-        if os.path.exists(self.server_file):
+        self.registered_peers = {}
+        self.active_requests = {}
+        if self.state_backend == "journal" and os.path.exists(self.server_file):
             try:
                 with open(self.server_file, "r") as file:
                     data = json.load(file)
                     self.registered_peers = data.get("registered_peers", {})
                     self.active_requests = data.get("active_requests", {})
-                    print(
-                        f"Loaded {len(self.registered_peers)} registered peers and {len(self.active_requests)} active requests.")
             except json.JSONDecodeError as e:
                 print(f"Error loading server state: {e}. Starting fresh.")
                 self.registered_peers = {}
                 self.active_requests = {}
+        replayed = self.store.replay(self.registered_peers, self.active_requests)
+        self.requests_by_peer = {}
+        self.offers_by_address = {}
+        for rq_number, details in self.active_requests.items():
+            self.index_request(rq_number, details)
+        if self.registered_peers or self.active_requests or replayed:
+            print(
+                f"Loaded {len(self.registered_peers)} registered peers and {len(self.active_requests)} active requests "
+                f"({replayed} {self.state_backend} records loaded).")
         else:
-            self.registered_peers = {}
-            self.active_requests = {}
             print("No previous state found. Starting fresh.")
 
-    # Save registered peers and active requests to server.json.
+    # Write a full snapshot of the state to server.json and truncate the journal.
+    # Runs in the background whenever the journal has grown past `compact_every` records.
+    # Each request is copied under its own lock after the journal is rotated, so anything missing
+    # from the snapshot is in the new journal segment.
     def save_server_state(self):
-        with open(self.server_file, "w") as file:
-            json.dump({"registered_peers": self.registered_peers, "active_requests": self.active_requests}, file, indent=4)
+        with self.peer_lock:
+            self.store.rotate()
+            peers = json.dumps(self.registered_peers)
+        requests = []
+        for rq_number in list(self.active_requests):
+            with self.request_lock(rq_number):
+                details = self.active_requests.get(rq_number)
+                if details is not None:
+                    requests.append(f"{json.dumps(rq_number)}: {json.dumps(details)}")
+        data = f'{{"registered_peers": {peers}, "active_requests": {{{", ".join(requests)}}}}}'
+        self.store.write_snapshot(self.server_file, data)
+        logging.info("Server state compacted into a new snapshot.")
+
+    def request_lock(self, rq_number):
+        return self.request_locks.for_key(rq_number)
+
+    # Add or remove a request in active_requests together with its index entries; call with its lock held.
+    def put_request(self, rq_number, details):
+        self.active_requests[rq_number] = details
+        self.index_request(rq_number, details)
+
+    def pop_request(self, rq_number):
+        details = self.active_requests.pop(rq_number, None)
+        if details is not None:
+            with self.index_lock:
+                rq_numbers = self.requests_by_peer.get(details['name'])
+                if rq_numbers is not None:
+                    rq_numbers.discard(rq_number)
+                    if not rq_numbers:
+                        del self.requests_by_peer[details['name']]
+            self.offers_by_address.pop(rq_number, None)
+        return details
+
+    def index_request(self, rq_number, details):
+        with self.index_lock:
+            self.requests_by_peer.setdefault(details['name'], set()).add(rq_number)
+        offers = {}
+        for offer in details.get('offers', ()):
+            offers.setdefault(tuple(offer['address']), offer)
+        self.offers_by_address[rq_number] = offers
+
+    def add_offer(self, rq_number, offer):
+        self.active_requests[rq_number].setdefault('offers', []).append(offer)
+        self.offers_by_address.setdefault(rq_number, {}).setdefault(tuple(offer['address']), offer)
+
+    # Acquisition and contention counts of the server locks.
+    def lock_stats(self):
+        return {"peer_lock": self.peer_lock.stats(), "request_locks": self.request_locks.stats()}
+
+    # Gauges read from the live state whenever the metrics are collected, and the histograms kept elsewhere.
+    def register_metrics(self):
+        metrics = self.metrics
+        metrics.describe("messages_total", "Datagrams received, by message type")
+        metrics.describe("duplicates_total", "Retransmitted requests answered from the reply cache, by message type")
+        metrics.describe("replies_total", "Messages sent to peers over UDP, by message type")
+        metrics.describe("forwarded_total", "Datagrams forwarded to the worker owning them, by message type")
+        metrics.describe("ipc_dropped_total", "Packets to other workers dropped because the send queue was full")
+        metrics.describe("state_store_failures_total", "Write errors that stopped the state store")
+        metrics.describe("handler_seconds", "Time spent handling a received datagram, by message type")
+        metrics.describe("peer_lock_hold_seconds", "Time peer_lock was held per acquisition")
+        metrics.describe("peer_lock_wait_seconds", "Time spent waiting for a contended peer_lock")
+        metrics.gauge("registered_peers", lambda: len(self.registered_peers))
+        metrics.gauge("active_requests", lambda: len(self.active_requests))
+        metrics.gauge("in_flight_requests", lambda: sum(
+            1 for details in list(self.active_requests.values()) if details.get('status') == 'Processing'))
+        metrics.gauge("live_threads", threading.active_count)
+        metrics.gauge("pending_timers", lambda: len(self.timers))
+        metrics.gauge("pending_retransmits", lambda: len(self.retransmits))
+        metrics.gauge("retransmissions", lambda: self.retransmits.retransmissions)
+        metrics.gauge("tcp_channels", lambda: len(self.tcp_pool.channels))
+        if self.state_backend == "sqlite":
+            metrics.gauge("state_changes_lost", lambda: self.store.lost_changes)
+        metrics.gauge("order_book_asks", lambda: sum(asks for asks, _ in self.order_book.depth().values()))
+        metrics.gauge("order_book_bids", lambda: sum(bids for _, bids in self.order_book.depth().values()))
+        metrics.gauge("peer_lock_contentions", lambda: self.peer_lock.contentions)
+        metrics.gauge("request_lock_contentions", lambda: self.request_locks.stats()["contentions"])
+        metrics.histograms[("peer_lock_hold_seconds", ())] = self.peer_lock.hold_times
+        metrics.histograms[("peer_lock_wait_seconds", ())] = self.peer_lock.wait_times
+
+    # Everything a STATS query returns; with a peer name, also the number of its requests by status.
+    def stats(self, peer_name=None):
+        stats = {"metrics": self.metrics.snapshot(), "time_to_found": self.time_to_found.summary(),
+                 "requests_by_status": self.count_requests_by_status(), "locks": self.lock_stats()}
+        if peer_name is not None:
+            counts = {}
+            for details in self.find_requests(name=peer_name).values():
+                counts[details.get('status')] = counts.get(details.get('status'), 0) + 1
+            stats["peer_requests_by_status"] = counts
+        return stats
+
+    # Requests matching every filter that is given, as {rq_number: details}. The SQLite backend
+    # answers from its indexes; otherwise the in-memory state is scanned (only the peer's own
+    # requests when a name is given).
+    def find_requests(self, name=None, status=None, item_name=None):
+        if self.state_backend == "sqlite":
+            return self.store.find_requests(name, status, item_name)
+        if name is not None:
+            with self.index_lock:
+                rq_numbers = list(self.requests_by_peer.get(name, ()))
+        else:
+            rq_numbers = list(self.active_requests)
+        found = {}
+        for rq_number in rq_numbers:
+            details = self.active_requests.get(rq_number)
+            if details is None:
+                continue
+            if name is not None and details.get('name') != name:
+                continue
+            if status is not None and details.get('status') != status:
+                continue
+            if item_name is not None and details.get('item_name', '').lower() != item_name.lower():
+                continue
+            found[rq_number] = dict(details)
+        return found
+
+    def count_requests_by_status(self):
+        if self.state_backend == "sqlite":
+            return self.store.count_by_status()
+        counts = {}
+        for details in list(self.active_requests.values()):
+            status = details.get('status')
+            counts[status] = counts.get(status, 0) + 1
+        return counts
+
+    # Answer a STATS query from this host with one STATS-REPLY datagram holding the metrics as JSON.
+    # The SQLite backend answers from its last committed state, so changes from the last few
+    # milliseconds may be missing; the query never waits for the disk.
+    def handle_stats(self, rq_number, addr, peer_name=None):
+        if not (ipaddress.ip_address(addr[0]).is_loopback or addr[0] == self.server_socket.getsockname()[0]):
+            logging.warning(f"Ignored STATS query from {addr}, only local queries are answered")
+            return
+        self.send_raw(f"STATS-REPLY {rq_number} {json.dumps(self.stats(peer_name))}".encode(), addr)
 
-    def udp_listener(self):
-        server_ip = get_server_ip()
-        print(f"Server is running on {server_ip}")
-        server_udp_port = get_server_udp_port()
-        print(f"listening on UDP port {server_udp_port}.")
+    # Write the metrics file and schedule the next dump.
+    def dump_metrics(self):
+        try:
+            self.metrics.dump(self.metrics_file)
+        except OSError as e:
+            logging.error(f"Could not write metrics to {self.metrics_file}: {e}")
+        self.timers.schedule(self.metrics_interval, self.metrics_dump_due, ("metrics", "dump"))
+
+    def metrics_dump_due(self):
+        return lambda: threading.Thread(target=self.dump_metrics, daemon=True).start()
+
+    # Time-to-FOUND percentiles and the expected SEARCH answer time of every seller.
+    def latency_stats(self):
+        with self.answer_times_lock:
+            answer_times = {seller: estimator.rto for seller, estimator in self.answer_times.items()}
+        return {"time_to_found": self.time_to_found.summary(), "answer_times": answer_times}
+
+    # Seconds to wait for the given sellers to answer a SEARCH: the slowest expected answer time,
+    # `cap` for sellers that never answered before, 0 if there is no one to wait for.
+    def expected_answer_time(self, sellers, cap):
+        if not sellers:
+            return 0
+        with self.answer_times_lock:
+            expected = max(self.answer_times[seller].rto if seller in self.answer_times else cap
+                           for seller in sellers)
+        floor = MIN_ANSWER_WINDOW
+        peers = self.registered_peers
+        for seller in sellers:
+            address = tuple(peers[seller]['address']) if seller in peers else None
+            if address in self.reliable_peers:
+                floor = max(floor, self.retransmits.recovery_time(address))
+        return min(cap, max(floor, expected))
+
+    # Record that a seller answered a SEARCH (OFFER or NO_OFFER). Returns the targets still to answer.
+    def note_answer(self, buyer_request, seller_name):
+        answered = buyer_request.setdefault('answered', [])
+        if seller_name not in answered:
+            answered.append(seller_name)
+            if 'searched_at' in buyer_request:
+                with self.answer_times_lock:
+                    estimator = self.answer_times.get(seller_name)
+                    if estimator is None:
+                        estimator = self.answer_times[seller_name] = RttEstimator(
+                            initial_rto=OFFER_WINDOW, min_rto=MIN_ANSWER_WINDOW, max_rto=SEARCH_TIMEOUT)
+                    estimator.sample(time.time() - buyer_request['searched_at'])
+        return set(buyer_request.get('targets', ())) - set(answered)
+
+    def record_found(self, buyer_request):
+        if 'searched_at' in buyer_request:
+            self.time_to_found.observe(time.time() - buyer_request['searched_at'])
+
+    # Journal the current value of a single request (or its removal).
+    # A request that reached a finished status is (re)scheduled to be archived; call with its lock held.
+    def persist_request(self, rq_number):
+        details = self.active_requests.get(rq_number)
+        if details is None:
+            self.store.append(DEL_REQUEST, rq_number)
+        else:
+            if details.get('status') in FINISHED_STATUSES:
+                details['finished_at'] = time.time()
+                self.schedule_archive(rq_number, details)
+            self.store.append(PUT_REQUEST, rq_number, details)
+
+    def schedule_archive(self, rq_number, details):
+        if self.archive_ttl is None:
+            return
+        delay = max(0, details.get('finished_at', time.time()) + self.archive_ttl - time.time())
+        self.timers.schedule(delay, lambda: self.archive_request(rq_number), key=(rq_number, "archive"),
+                             lock=self.request_lock(rq_number))
+
+    # Move a finished request from active_requests to the archive file.
+    # Fires on the scheduler thread under the request lock; the archive is written after it is released.
+    def archive_request(self, rq_number):
+        details = self.active_requests.get(rq_number)
+        if details is None or details.get('status') not in FINISHED_STATUSES:
+            return None
+        self.pop_request(rq_number)
+        self.persist_request(rq_number)
+        return lambda: self.archive.append(rq_number, details)
+
+    # Journal the current value of a single registered peer (or its removal).
+    def persist_peer(self, name):
+        peer_info = self.registered_peers.get(name)
+        if peer_info is None:
+            self.store.append(DEL_PEER, name)
+        else:
+            self.store.append(PUT_PEER, name, peer_info)
+
+    def bind_udp_socket(self):
+        if self.address is not None:
+            server_ip, server_udp_port = self.address
+        else:
+            server_ip = get_server_ip()
+            print(f"Server is running on {server_ip}")
+            server_udp_port = get_server_udp_port()
+            print(f"listening on UDP port {server_udp_port}.")
+        if self.router is not None:
+            # Every worker binds the same port; the kernel spreads the peers over them
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server_socket.bind((server_ip, server_udp_port))
-        logging.info("Server started, listening on UDP port {server_udp_port}...")
+        logging.info(f"Server started in {self.mode} mode, listening on UDP port {server_udp_port}...")
+
+    # Threaded mode: one thread per received datagram.
+    def udp_listener(self):
+        self.bind_udp_socket()
 
         while True:
             data, addr = self.server_socket.recvfrom(1024)
+            if self.stopped.is_set():
+                break
+            if self.trace is not None:
+                self.trace.record(data, addr)
+            if self.router is None or self.router.route(data, addr):
+                threading.Thread(target=self.handle_udp_message, args=(data, addr)).start()
+        self.shutdown()
+
+    # Handle a datagram another worker forwarded: on a new thread, or on the event loop in asyncio mode.
+    def dispatch(self, data, addr):
+        if self.loop is None:
             threading.Thread(target=self.handle_udp_message, args=(data, addr)).start()
+        else:
+            self.loop.call_soon_threadsafe(lambda: self.loop.create_task(self.dispatch_udp_message(data, addr)))
+
+    # Asyncio mode: every datagram is dispatched as a coroutine on a single event loop.
+    def async_listener(self):
+        self.bind_udp_socket()
+        self.server_socket.setblocking(False)
+        asyncio.run(self.serve_async())
+        self.shutdown()
+
+    async def serve_async(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.executor = ThreadPoolExecutor(thread_name_prefix="server-blocking")
+        self.loop.set_default_executor(self.executor)
+        self.transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: ServerProtocol(self), sock=self.server_socket)
+        self.serving = asyncio.Event()
+        try:
+            await self.serving.wait()  # Serve until stop()
+        finally:
+            self.transport.close()
+
+    async def dispatch_udp_message(self, data, addr):
+        msg_type = wire.message_type(data)
+        try:
+            if msg_type in BLOCKING_MESSAGES:
+                # BUY opens TCP connections and waits on both peers, keep it off the event loop
+                await self.loop.run_in_executor(self.executor, self.handle_udp_message, data, addr)
+            else:
+                self.handle_udp_message(data, addr)
+        except Exception as e:
+            logging.error(f"Error handling {msg_type} from {addr}: {e}")
 
+    # Handle one received datagram and record how long it took, per message type.
     def handle_udp_message(self, data, addr):
-        message = data.decode()
-        message_parts = message.split()
+        started = time.perf_counter()
+        msg_type = self.process_udp_message(data, addr)
+        self.metrics.inc("messages_total", type=msg_type)
+        self.metrics.observe("handler_seconds", time.perf_counter() - started, type=msg_type)
+
+    # Returns the message type, "malformed" if the datagram could not be parsed.
+    def process_udp_message(self, data, addr):
+        try:
+            message_parts = wire.parse(data, self.resolve_rq_id)
+        except (wire.WireError, UnicodeDecodeError) as e:
+            logging.warning(f"Malformed datagram from {addr}: {e}")
+            return "malformed"
+        if len(message_parts) < 2:
+            return "malformed"
         msg_type = message_parts[0]
+        rq_number = message_parts[1]
+        addr = tuple(addr)
+
+        if msg_type == "STATS":
+            self.handle_stats(rq_number, addr, message_parts[2] if len(message_parts) > 2 else None)
+            return msg_type
+        if msg_type == "ACK":
+            self.retransmits.ack((message_parts[2], rq_number, addr))
+            return msg_type
+        if msg_type in FEDERATION_MESSAGES:
+            if self.federation is None:
+                logging.warning(f"Ignored {msg_type} from {addr}, this server is not federated")
+                return "unknown"
+            self.federation.handle(message_parts, addr)
+            return msg_type
+        if addr in self.reliable_peers or (msg_type == "REGISTER" and FEATURE_RELIABLE in message_parts[6:]):
+            self.send_raw(self.encode_for(f"ACK {rq_number} {msg_type}", addr), addr)
+        # A retransmitted request is answered with the replies already sent for it instead of running again
+        replies = self.response_cache.check_and_add((msg_type, rq_number, addr))
+        if replies is not None:
+            udp_log.info("Duplicate %s %s from %s, replaying %d reply(s)", msg_type, rq_number, addr, len(replies))
+            for reply in replies:
+                self.send_raw(self.encode_for(reply, addr), addr)
+            self.metrics.inc("duplicates_total", type=msg_type)
+            return msg_type
+        # Answers of our sellers to a search a sibling server forwarded go back to that server
+        if self.federation is not None and self.federation.relay_from_seller(message_parts, addr):
+            return msg_type
 
         if msg_type == "REGISTER":
             self.handle_register(message_parts, addr)
@@ -74,60 +520,132 @@ class Server:
             self.handle_search(message_parts, addr)
         elif msg_type == "OFFER":
             self.handle_offer(message_parts, addr)
+        elif msg_type == "NO_OFFER":
+            self.handle_no_offer(message_parts, addr)
         elif msg_type == "ACCEPT" or msg_type == "REFUSE":
             self.handle_seller_response(message_parts, addr)
         elif msg_type == "CANCEL":
             self.handle_cancel(message_parts, addr)
         elif msg_type == "BUY":
             self.handle_tcp(message_parts, addr)
+        elif msg_type == "CATALOG":
+            self.handle_catalog(message_parts, addr)
+            if self.router is not None and message_parts[2] in self.registered_peers:
+                self.router.replicate("catalog", message_parts, addr)
         else:
             logging.warning(f"Unknown message type from {addr}: {data.decode()}")
+            return "unknown"
+        return msg_type
 
     def handle_register(self, message_parts, addr):
         rq_number = message_parts[1]
         name = message_parts[2]
         udp_socket = message_parts[4]
         tcp_socket = message_parts[5]
+        # Optional features requested by the peer, e.g. the binary wire encoding
+        features = [feature for feature in message_parts[6:] if feature in SUPPORTED_FEATURES]
 
-        with self.peer_lock:
+        with self.request_lock(rq_number):
             # Add the request to active_requests
-            self.active_requests[rq_number] = {'name': name, 'operation': 'REGISTER', 'status': 'Processing'}
-            self.save_server_state()  # Save the new request to requests.json
+            self.put_request(rq_number, {'name': name, 'operation': 'REGISTER', 'status': 'Processing'})
 
-            if name in self.registered_peers:
-                response = f"REGISTER-DENIED {rq_number} Name already in use"
-                self.active_requests[rq_number]['status'] = 'Failed'
-            else:
-                self.registered_peers[name] = {"rq_number": rq_number, 'udp_socket': udp_socket, 'tcp_socket': tcp_socket,"address": tuple(addr),}
-                response = f"REGISTERED {rq_number}"
-                self.active_requests[rq_number]['status'] = 'Completed'
-            self.save_server_state()  # Update the request status in requests.json
+            with self.peer_lock:
+                if name in self.registered_peers:
+                    response = f"REGISTER-DENIED {rq_number} Name already in use"
+                    self.active_requests[rq_number]['status'] = 'Failed'
+                else:
+                    peer_info = {"rq_number": rq_number, 'udp_socket': udp_socket, 'tcp_socket': tcp_socket,"address": tuple(addr),}
+                    if features:
+                        peer_info['features'] = features
+                    self.install_peer(name, peer_info)
+                    if self.router is not None:
+                        # Sent under peer_lock, so the other workers see REGISTER and DE-REGISTER in order
+                        self.router.replicate("register", name, peer_info)
+                    response = " ".join([f"REGISTERED {rq_number}"] + features)
+                    self.active_requests[rq_number]['status'] = 'Completed'
+            self.persist_request(rq_number)  # Journal the request with its final status
 
         self.send_udp_response(response, addr)
 
+    # Add a peer to the registry; call with peer_lock held. Copy-on-write so readers never need peer_lock.
+    def install_peer(self, name, peer_info):
+        features = peer_info.get('features', ())
+        address = tuple(peer_info['address'])
+        self.registered_peers = {**self.registered_peers, name: peer_info}
+        self.uncatalogued_peers = self.uncatalogued_peers | {name}
+        if wire.FEATURE_DESCRIPTION_MATCH in features:
+            self.matching_peers = self.matching_peers | {name}
+        if wire.FEATURE_BINARY in features:
+            self.binary_peers = self.binary_peers | {address}
+        if FEATURE_RELIABLE in features:
+            self.reliable_peers = self.reliable_peers | {address}
+        self.persist_peer(name)
+
     def handle_deregister(self, message_parts, addr):
         rq_number = message_parts[1]
         name = message_parts[2]
 
-        with self.peer_lock:
+        with self.request_lock(rq_number):
             # Add the request to active_requests
-            self.active_requests[rq_number] = {'name': name, 'operation': 'DE-REGISTER', 'status': 'Processing'}
-            self.save_server_state()
-
-            if name in self.registered_peers:
-                del self.registered_peers[name]
-                # Remove all requests ever made by this peer
-                self.active_requests = {
-                    rq: details for rq, details in self.active_requests.items() if details['name'] != name
-                }
-                response = f"DE-REGISTERED {rq_number}"
-            else:
+            self.put_request(rq_number, {'name': name, 'operation': 'DE-REGISTER', 'status': 'Processing'})
+
+        if self.remove_peer(name) is not None:
+            if self.router is not None:
+                self.router.replicate("deregister", name)
+            response = f"DE-REGISTERED {rq_number}"
+        else:
+            with self.request_lock(rq_number):
                 response = f"DE-REGISTER-DENIED {rq_number} Name not found"
                 self.active_requests[rq_number]['status'] = 'Failed'
-            self.save_server_state()  # Update the request status in requests.json
+                self.persist_request(rq_number)  # Journal the request with its final status
 
         self.send_udp_response(response, addr)
 
+    # Remove a peer from the registry, the catalog and the order book, then every request it made.
+    # Returns its registry entry, None if it was not registered.
+    def remove_peer(self, name):
+        with self.peer_lock:
+            peer_info = self.registered_peers.get(name)
+            if peer_info is None:
+                return None
+            self.binary_peers = self.binary_peers - {tuple(peer_info['address'])}
+            self.reliable_peers = self.reliable_peers - {tuple(peer_info['address'])}
+            self.registered_peers = {peer: info for peer, info in self.registered_peers.items() if peer != name}
+            self.persist_peer(name)
+            self.uncatalogued_peers = self.uncatalogued_peers - {name}
+            self.matching_peers = self.matching_peers - {name}
+            self.catalog.remove_seller(name)
+            self.order_book.remove_seller(name)
+
+        self.tcp_pool.close((peer_info['address'][0], int(peer_info['tcp_socket'])))
+        # Remove all requests ever made by this peer, one request lock at a time
+        with self.index_lock:
+            removed = list(self.requests_by_peer.get(name, ()))
+        for rq in removed:
+            with self.request_lock(rq):
+                if self.pop_request(rq) is not None:
+                    self.timers.cancel((rq, "search"))
+                    self.timers.cancel((rq, "offers"))
+                    self.timers.cancel((rq, "floors"))
+                    self.timers.cancel((rq, "archive"))
+                    self.persist_request(rq)
+        return peer_info
+
+    # Apply a registry change another worker made (see cluster.py): a REGISTER, a DE-REGISTER or a CATALOG.
+    def apply_replicated(self, change, args):
+        if change == "register":
+            name, peer_info = args
+            peer_info['address'] = tuple(peer_info['address'])
+            with self.peer_lock:
+                self.install_peer(name, peer_info)
+        elif change == "deregister":
+            self.remove_peer(args[0])
+        elif change == "catalog":
+            message_parts, addr = args
+            self.handle_catalog(message_parts, tuple(addr))
+        else:
+            logging.warning(f"Unknown replicated change '{change}'")
+
     def handle_search(self, message_parts, addr):
         rq_number = message_parts[1]
         name = message_parts[2]
@@ -136,102 +654,287 @@ class Server:
         max_price = message_parts[-1]
 
         # print(f"In Handle Search for {name}")
+        targets = self.search_targets(name, item_name)
+        # Every sibling server answers for its own sellers, as "@<server name>"
+        siblings = self.federation.search_names() if self.federation is not None else []
 
-        with self.peer_lock:
-            self.active_requests[rq_number] = {
+        with self.request_lock(rq_number):
+            self.put_request(rq_number, {
                 'name': name,
                 'operation': 'LOOKING_FOR',
                 'item_name': item_name,
                 'item_description': item_description,
                 'max_price': max_price,
                 'status': 'Processing',
-                'offers': []
-            }
-            self.save_server_state()
-
-            for peer_name, peer_info in self.registered_peers.items():
-                if peer_name != name:
-                    search_msg = f"SEARCH {rq_number} {item_name} {item_description}"
-                    self.send_udp_response(search_msg, tuple(peer_info['address']))
-                    logging.info(f"SEARCH request from {name} forwarded to {peer_name} for item '{item_name}'")
-
-            # Start a timeout thread to handle the case when no offers are received
+                'offers': [],
+                'targets': [peer_name for peer_name, _ in targets] + siblings,  # Sellers the SEARCH went to
+                'answered': [],  # Sellers that sent an OFFER or NO_OFFER
+                'searched_at': time.time()
+            })
+            self.persist_request(rq_number)
+
+            # Handle the case when no offers are received; fires on the scheduler thread under the request lock
             def handle_timeout():
-                time.sleep(120)  # Wait for 2 min to see if any offers are there
-                with self.peer_lock:  # Ensure thread safety
-                    buyer_request = self.active_requests.get(rq_number, {})
-                    if buyer_request and not buyer_request['offers']:  # No offers received
-                        buyer_address = self.registered_peers[name]['address']
-                        response_to_buyer = f"NOT_AVAILABLE {rq_number} {item_name} {max_price}"
-                        self.send_udp_response(response_to_buyer, buyer_address)
-                        logging.info(f"NOT_AVAILABLE sent to {name} for item '{item_name}' with RQ# {rq_number}")
-
-                        # Mark the request as completed without offers
-                        buyer_request['status'] = 'No Offers'
-                        self.save_server_state()
-
-            threading.Thread(target=handle_timeout, daemon=True).start()
+                outbox = []
+                buyer_request = self.active_requests.get(rq_number, {})
+                if buyer_request and not buyer_request['offers']:  # No offers received
+                    buyer_address = self.registered_peers[name]['address']
+                    response_to_buyer = f"NOT_AVAILABLE {rq_number} {item_name} {max_price}"
+                    outbox.append((response_to_buyer, buyer_address))
+                    logging.info(f"NOT_AVAILABLE sent to {name} for item '{item_name}' with RQ# {rq_number}")
+
+                    # Mark the request as completed without offers
+                    buyer_request['status'] = 'No Offers'
+                    self.persist_request(rq_number)
+                return lambda: self.send_all(outbox)
+
+            # Answered right away when no seller has the item
+            search_timeout = self.expected_answer_time([peer_name for peer_name, _ in targets] + siblings,
+                                                       SEARCH_TIMEOUT)
+            self.timers.schedule(search_timeout, handle_timeout, key=(rq_number, "search"),
+                                 lock=self.request_lock(rq_number))
+
+        # Fan the search out without holding any lock
+        for peer_name, peer_info in targets:
+            search_msg = self.search_message(rq_number, item_name, item_description, max_price, peer_info)
+            self.send_udp_response(search_msg, tuple(peer_info['address']))
+            search_log.info("SEARCH request from %s forwarded to %s for item '%s'", name, peer_name, item_name)
+        if self.federation is not None:
+            self.federation.forward_search(rq_number, item_name, item_description, max_price)
+
+    # SEARCH for one seller: a PRICED_SEARCH with the buyer's bid if priced searches are enabled and
+    # the seller asked for them at REGISTER, a plain SEARCH otherwise.
+    def search_message(self, rq_number, item_name, item_description, max_price, peer_info):
+        if self.price_tolerance is not None and wire.FEATURE_PRICED_SEARCH in peer_info.get('features', ()):
+            return f"PRICED_SEARCH {rq_number} {item_name} {max_price} {self.price_tolerance} {item_description}"
+        return f"SEARCH {rq_number} {item_name} {item_description}"
+
+    # Peers a SEARCH for item_name is sent to, excluding the buyer.
+    def search_targets(self, buyer_name, item_name):
+        peers = self.registered_peers
+        if self.routing == "broadcast":
+            return [(peer_name, peer_info) for peer_name, peer_info in peers.items() if peer_name != buyer_name]
+        candidates = set(self.catalog.sellers_for(item_name)) | self.uncatalogued_peers | self.matching_peers
+        candidates.discard(buyer_name)
+        return [(peer_name, peers[peer_name]) for peer_name in candidates if peer_name in peers]
+
+    # Handles a CATALOG push from a peer: CATALOG <rq_number> <name> FULL|DELTA [<item_name> <price_floor>]...
+    # FULL replaces the peer's catalog, DELTA updates single items ("-" as floor means out of stock).
+    def handle_catalog(self, message_parts, addr):
+        name = message_parts[2]
+        mode = message_parts[3]
+        seq = int(message_parts[4])
+        entries = parse_catalog_entries(message_parts[5:])
 
+        if name not in self.registered_peers:
+            logging.warning(f"CATALOG from unregistered peer {name} at {addr}")
+            return
+        if mode == "FULL":
+            self.catalog.replace(name, entries, seq)
+            floors = self.catalog.floors_of(name)
+            changed = set(floors) | {item_name for item_name, _ in entries}
+            changed |= {alias for item_name in changed for alias in self.order_book.aliases_of(item_name, name)}
+            self.order_book.remove_seller(name)
+            for item, floor in floors.items():
+                self.order_book.post_ask(item, name, floor)
+        else:
+            self.catalog.update(name, entries, seq)
+            changed = {item_name for item_name, _ in entries}
+            # Asks under the names of searches answered with these items follow their floors
+            changed |= {alias for item_name in changed for alias in self.order_book.aliases_of(item_name, name)}
+            # The catalog has the newest floor of each item, even if this delta arrived late
+            for item_name, _ in entries:
+                floor = self.catalog.sellers_for(item_name).get(name)
+                if floor is None:
+                    self.order_book.remove_ask(item_name, name)
+                else:
+                    self.order_book.post_ask(item_name, name, floor)
+        if name in self.uncatalogued_peers:
+            with self.peer_lock:
+                self.uncatalogued_peers = self.uncatalogued_peers - {name}
+        catalog_log.info("Catalog %s from %s: %d item(s)", mode, name, len(entries))
+        # Bids waiting for this seller's new floor (see negotiate_unmatched)
+        for item_name in changed:
+            if self.order_book.has_bids(item_name):
+                self.run_matching(item_name)
 
     def handle_offer(self, message_parts, addr):
         rq_number = message_parts[1]
         seller_name = message_parts[2]
         item_name = message_parts[3]
         price = float(message_parts[4])
+        stocked_name = message_parts[5] if len(message_parts) > 5 else item_name  # Item the seller offers
 
-        logging.info(f"Offer received from {seller_name} for item '{item_name}' at price {price}")
+        search_log.info("Offer received from %s for item '%s' at price %s", seller_name, item_name, price)
 
-        with self.peer_lock:
+        with self.request_lock(rq_number):
             if rq_number not in self.active_requests:
                 logging.warning(f"Invalid RQ number in offer: {rq_number}")
                 return
 
             buyer_request = self.active_requests[rq_number]
+            if buyer_request['status'] != 'Processing':
+                logging.warning(f"Late offer from {seller_name} for finished request {rq_number}")
+                return
             max_price = float(buyer_request.get('max_price', 0))
+            self.add_offer(rq_number, {'seller_name': seller_name, 'price': price, 'address': tuple(addr)})
+            # The seller has a unit at this price. Sellers that keep us posted on their catalog also
+            # report when a unit is reserved; for the others the offer itself is the only news.
+            if self.catalog.has_catalog(seller_name):
+                self.order_book.offer_ask(item_name, seller_name, price, stocked_name)
+            else:
+                self.order_book.post_ask(item_name, seller_name, price)
+            unanswered = self.note_answer(buyer_request, seller_name)
+
+            # Close the offer window as soon as this offer can be taken or nobody else is going to answer.
+            # An offer whose ask another buyer just took cannot be taken: keep waiting for the others.
+            takeable = price <= max_price and self.order_book.ask(item_name, seller_name) is not None
+            if takeable or not unanswered:
+                offer_window = 0
+            else:
+                offer_window = self.expected_answer_time(unanswered, OFFER_WINDOW)
+
+            # Open the offer window if not already started
+            start_timeout_thread = 'timeout_thread_started' not in buyer_request
+            buyer_request['timeout_thread_started'] = True
+            self.persist_request(rq_number)
+            if not start_timeout_thread and offer_window == 0:
+                self.timers.reschedule((rq_number, "offers"), 0)
+            if start_timeout_thread:
+                # An offer arrived, so the request can no longer end as NOT_AVAILABLE
+                self.timers.cancel((rq_number, "search"))
+
+                # Fires on the scheduler thread under the request lock once the offer window closes.
+                # The request joins the item's order book and is matched, together with any other
+                # bids queued meanwhile, once the request lock is released.
+                def process_offers_after_timeout():
+                    logging.info(f"Processing offers for request {rq_number} after timeout.")
+                    sellers = {offer['seller_name'] for offer in buyer_request['offers']}
+                    self.order_book.add_bid(item_name, rq_number, max_price, sellers)
+                    return lambda: self.run_matching(item_name)
+
+                self.timers.schedule(offer_window, process_offers_after_timeout, key=(rq_number, "offers"),
+                                     lock=self.request_lock(rq_number))
+
+    # Handles NO_OFFER <rq_number> <name> <item_name>: the seller does not have the item. Once every
+    # seller the SEARCH went to has answered, the request is settled without waiting for its deadline.
+    def handle_no_offer(self, message_parts, addr):
+        rq_number = message_parts[1]
+        seller_name = message_parts[2]
+
+        with self.request_lock(rq_number):
+            buyer_request = self.active_requests.get(rq_number)
+            if buyer_request is None or buyer_request['status'] != 'Processing':
+                return
+            unanswered = self.note_answer(buyer_request, seller_name)
+            self.persist_request(rq_number)
+            if not unanswered and buyer_request.get('targets'):
+                if buyer_request['offers']:
+                    self.timers.reschedule((rq_number, "offers"), 0)
+                else:
+                    self.timers.reschedule((rq_number, "search"), 0)
+
+    # Match the queued bids of an item against the standing asks and answer every bid it settles.
+    def run_matching(self, item_name):
+        matches, unmatched = self.order_book.match(item_name)
+        for rq_number, seller_name, price in matches:
+            self.complete_match(rq_number, item_name, seller_name, price)
+        for rq_number in unmatched:
+            self.negotiate_unmatched(rq_number, item_name)
+
+    # FOUND to the buyer and RESERVE to the seller of a matched bid.
+    def complete_match(self, rq_number, item_name, seller_name, price):
+        outbox = []
+        with self.request_lock(rq_number):
+            buyer_request = self.active_requests.get(rq_number)
+            if buyer_request is None or buyer_request['status'] != 'Processing':
+                # The buyer went away while the bid was queued, give the unit back
+                self.order_book.post_ask(item_name, seller_name, price)
+                return
             buyer_name = buyer_request['name']
-            buyer_address = self.registered_peers[buyer_name]['address']
-            buyer_request.setdefault('offers', []).append({'seller_name': seller_name, 'price': price, 'address': tuple(addr)})
+            offer = next(offer for offer in buyer_request['offers'] if offer['seller_name'] == seller_name)
+            reserved_seller = {**offer, 'price': price}
 
-            # Initialize a timeout thread if not already started
-            if 'timeout_thread_started' not in buyer_request:
-                buyer_request['timeout_thread_started'] = True
+            # Notify the requester about the matched offer
+            response_to_buyer = f"FOUND {rq_number} {item_name} {price} from {seller_name}"
+            outbox.append((response_to_buyer, self.registered_peers[buyer_name]['address']))
 
-                def process_offers_after_timeout():
-                    time.sleep(10)  # Wait for 10 seconds
-                    with self.peer_lock:  # Ensure thread safety when accessing shared data
-                        logging.info(f"Processing offers for request {rq_number} after timeout.")
-                        valid_offers = [offer for offer in buyer_request['offers'] if offer['price'] <= max_price]
-
-                        if valid_offers:
-                            # Find the cheapest valid offer
-                            cheapest_offer = min(valid_offers, key=lambda x: x['price'])
-                            # Notify the requester about the cheapest valid offer
-                            response_to_buyer = f"FOUND {rq_number} {item_name} {cheapest_offer['price']} from {cheapest_offer['seller_name']}"
-                            self.send_udp_response(response_to_buyer, buyer_address)
-
-                            # Send a RESERVE message to the seller
-                            reserve_message = f"RESERVE {rq_number} {item_name} {cheapest_offer['price']}"
-                            self.send_udp_response(reserve_message, cheapest_offer['address'])
-                            logging.info(f"RESERVE message sent to {cheapest_offer['seller_name']} for item '{item_name}' at price {cheapest_offer['price']}")
-
-                            # Update the request status
-                            buyer_request['status'] = 'Found'
-                            buyer_request['reserved_seller'] = cheapest_offer
-                            self.save_server_state()
-                            logging.info(f"Item '{item_name}' reserved for {buyer_name} from {cheapest_offer['seller_name']} at price {cheapest_offer['price']}")
-                        else:
-                            # All offers exceed max price, initiate negotiation with the cheapest offer
-                            cheapest_offer = min(buyer_request['offers'], key=lambda x: x['price'])
-
-                            negotiate_message = f"NEGOTIATE {rq_number} {item_name} {max_price}"
-                            self.send_udp_response(negotiate_message, cheapest_offer['address'])
-                            logging.info(f"Negotiation initiated with {cheapest_offer['seller_name']} for item '{item_name}' at max price {max_price}")
-
-                            # Update the status to indicate negotiation is in progress
-                            buyer_request['status'] = 'Negotiating'
-                            self.save_server_state()
-
-                threading.Thread(target=process_offers_after_timeout, daemon=True).start()
+            # Send a RESERVE message to the seller
+            reserve_message = f"RESERVE {rq_number} {item_name} {price}"
+            outbox.append((reserve_message, reserved_seller['address']))
+            logging.info(f"RESERVE message sent to {seller_name} for item '{item_name}' at price {price}")
+
+            # Update the request status
+            buyer_request['status'] = 'Found'
+            buyer_request['reserved_seller'] = reserved_seller
+            self.persist_request(rq_number)
+            self.record_found(buyer_request)
+            logging.info(f"Item '{item_name}' reserved for {buyer_name} from {seller_name} at price {price}")
+        self.send_all(outbox)
+
+    # No ask at or below the bid: negotiate with the cheapest seller that offered and still has the
+    # item unreserved, or tell the buyer nothing is available. A seller whose ask another buyer just
+    # took may well have more units: until its new floor arrives, the bid waits in the book rather
+    # than giving up on the seller's offer.
+    def negotiate_unmatched(self, rq_number, item_name):
+        outbox = []
+        retry = False
+        with self.request_lock(rq_number):
+            buyer_request = self.active_requests.get(rq_number)
+            if buyer_request is None or buyer_request['status'] != 'Processing':
+                return
+            buyer_name = buyer_request['name']
+            max_price = float(buyer_request['max_price'])
+            offers = [offer for offer in buyer_request['offers']
+                      if self.order_book.ask(item_name, offer['seller_name']) is not None]
+            awaited = [offer for offer in buyer_request['offers']
+                       if self.order_book.is_consumed(item_name, offer['seller_name'])]
+
+            if awaited and not buyer_request.get('floors_overdue') and \
+                    (not offers or any(offer['price'] <= max_price for offer in awaited)):
+                self.wait_for_floors(rq_number, item_name, buyer_request, max_price)
+                # A floor that arrived before the bid was queued did not run the matching
+                retry = not any(self.order_book.is_consumed(item_name, offer['seller_name']) for offer in awaited)
+            elif offers:
+                # All remaining offers exceed max price, initiate negotiation with the cheapest offer
+                cheapest_offer = min(offers, key=lambda x: x['price'])
+
+                negotiate_message = f"NEGOTIATE {rq_number} {item_name} {max_price}"
+                outbox.append((negotiate_message, cheapest_offer['address']))
+                logging.info(f"Negotiation initiated with {cheapest_offer['seller_name']} for item '{item_name}' at max price {max_price}")
+
+                # Update the status to indicate negotiation is in progress
+                buyer_request['status'] = 'Negotiating'
+            else:
+                # Every seller that offered has been reserved by other buyers
+                response_to_buyer = f"NOT_AVAILABLE {rq_number} {item_name} {buyer_request['max_price']}"
+                outbox.append((response_to_buyer, self.registered_peers[buyer_name]['address']))
+                logging.info(f"NOT_AVAILABLE sent to {buyer_name} for item '{item_name}' with RQ# {rq_number}")
+                buyer_request['status'] = 'No Offers'
+            self.persist_request(rq_number)
+        self.send_all(outbox)
+        if retry:
+            self.run_matching(item_name)
+
+    # Queue the bid again until the sellers whose asks were taken report their new floor, which
+    # runs the matching again (see handle_catalog), or until OFFER_WINDOW seconds have passed.
+    # Call with the request lock held.
+    def wait_for_floors(self, rq_number, item_name, buyer_request, max_price):
+        sellers = {offer['seller_name'] for offer in buyer_request['offers']}
+        self.order_book.add_bid(item_name, rq_number, max_price, sellers)
+        if buyer_request.get('waiting_for_floors'):
+            return
+        buyer_request['waiting_for_floors'] = True
+        logging.info(f"RQ# {rq_number} waits for the new floor of sellers whose '{item_name}' was just reserved")
+
+        # Fires on the scheduler thread under the request lock
+        def floors_overdue():
+            buyer_request['floors_overdue'] = True
+            self.order_book.remove_bid(item_name, rq_number)
+            return lambda: self.negotiate_unmatched(rq_number, item_name)
+
+        self.timers.schedule(OFFER_WINDOW, floors_overdue, key=(rq_number, "floors"),
+                             lock=self.request_lock(rq_number))
 
     def handle_seller_response(self, message_parts, addr):
         rq_number = message_parts[1]
@@ -239,40 +942,44 @@ class Server:
         item_name = message_parts[2]
         max_price = float(message_parts[3])
 
-        if rq_number not in self.active_requests:
-            logging.warning(f"Invalid RQ number in seller response: {rq_number}")
-            return
+        with self.request_lock(rq_number):
+            if rq_number not in self.active_requests:
+                logging.warning(f"Invalid RQ number in seller response: {rq_number}")
+                return
 
-        buyer_request = self.active_requests[rq_number]
-        buyer_name = buyer_request['name']
-        buyer_address = self.registered_peers[buyer_name]['address']
+            buyer_request = self.active_requests[rq_number]
+            buyer_name = buyer_request['name']
+            buyer_address = self.registered_peers[buyer_name]['address']
 
-        if response_type == "ACCEPT":
+            if response_type == "ACCEPT":
 
-            # Determine the seller from the address
-            offers = buyer_request.get('offers', [])
-            reserved_seller = next((offer for offer in offers if offer['address'] == tuple(addr)), None)
+                # Determine the seller from the address
+                reserved_seller = self.offers_by_address.get(rq_number, {}).get(tuple(addr))
+
+                if not reserved_seller:
+                    logging.warning(f"No matching offer found for seller at {addr} in request {rq_number}")
+                    return
 
-            if reserved_seller:
                 # Update the offer price to the max_price
                 reserved_seller['price'] = max_price
+                self.order_book.consume_ask(item_name, reserved_seller['seller_name'])  # Until its new floor arrives
 
                 # Update the request with reserved seller information
                 buyer_request['reserved_seller'] = reserved_seller
 
                 response_to_buyer = f"FOUND {rq_number} {item_name} {reserved_seller['price']} from {reserved_seller['seller_name']}"
-                self.send_udp_response(response_to_buyer, buyer_address)
 
-                buyer_request['status'] = 'Completed'
-                self.save_server_state()  # Save the updated state with reserved seller
+                buyer_request['status'] = 'Found'  # Until the buyer's BUY or CANCEL
+                self.persist_request(rq_number)  # Journal the updated state with reserved seller
+                self.record_found(buyer_request)
                 logging.info(f"Negotiation successful: {item_name} sold to {buyer_name} by {reserved_seller['seller_name']} at price {reserved_seller['price']}")
-            else:
-                logging.warning(f"No matching offer found for seller at {addr} in request {rq_number}")
-        elif response_type == "REFUSE":
-            response_to_buyer = f"NOT_FOUND {rq_number} {item_name} {max_price}"
-            self.send_udp_response(response_to_buyer, buyer_address)
-            buyer_request['status'] = 'Not Found'
-            logging.info(f"Negotiation failed: {item_name} not sold to {buyer_name}")
+            elif response_type == "REFUSE":
+                response_to_buyer = f"NOT_FOUND {rq_number} {item_name} {max_price}"
+                buyer_request['status'] = 'Not Found'
+                self.persist_request(rq_number)
+                logging.info(f"Negotiation failed: {item_name} not sold to {buyer_name}")
+
+        self.send_udp_response(response_to_buyer, buyer_address)
 
     # Handles a CANCEL message from the buyer and notifies the seller to cancel the reservation.
     def handle_cancel(self, message_parts, addr):
@@ -282,14 +989,12 @@ class Server:
 
         logging.info(f"CANCEL received from buyer for RQ# {rq_number}, item '{item_name}', price {price}")
 
-        with self.peer_lock:
+        with self.request_lock(rq_number):
             if rq_number not in self.active_requests:
                 logging.warning(f"Invalid RQ number in CANCEL message: {rq_number}")
                 return
 
             buyer_request = self.active_requests[rq_number]
-            buyer_name = buyer_request['name']
-            buyer_address = self.registered_peers[buyer_name]['address']
 
             # Check if there is a reserved seller for this request
             reserved_seller = buyer_request.get('reserved_seller')
@@ -302,17 +1007,19 @@ class Server:
             seller_name = reserved_seller['seller_name']
             seller_address = reserved_seller['address']
 
-            # Send CANCEL message to the seller
-            cancel_message = f"CANCEL {rq_number} {item_name} {price}"
-            self.send_udp_response(cancel_message, seller_address)
-            logging.info(f"CANCEL message sent to seller {seller_name} for item '{item_name}' at {price}")
-
             # Update the request status
             buyer_request['status'] = 'Cancelled'
             del buyer_request['reserved_seller']  # Remove the reserved seller entry
-            self.save_server_state()
+            self.persist_request(rq_number)
+
+        # Send CANCEL message to the seller
+        cancel_message = f"CANCEL {rq_number} {item_name} {price}"
+        self.send_udp_response(cancel_message, seller_address)
+        logging.info(f"CANCEL message sent to seller {seller_name} for item '{item_name}' at {price}")
 
     # Handles the TCP transaction between buyer and seller.
+    # Both legs run over the persistent channels of the TCP pool: INFORM_Req goes to buyer and seller
+    # at once and their INFORM_Res replies are awaited together, matched by the transaction's RQ#.
     def handle_tcp(self, message_parts, addr):
         rq_number_buy_msg = message_parts[1]
         rq_number = self.generate_rq_number()
@@ -321,11 +1028,8 @@ class Server:
 
         logging.info(f"Initiating TCP transaction for RQ# {rq_number_buy_msg}, item '{item_name}', price {price}")
 
-        buyer_conn = None
-        seller_conn = None
-
         # Retrieve buyer and seller info
-        with self.peer_lock:
+        with self.request_lock(rq_number_buy_msg):
             buyer_request = self.active_requests.get(rq_number_buy_msg)
             if not buyer_request or 'reserved_seller' not in buyer_request:
                 logging.warning(f"No reserved seller found for RQ# {rq_number_buy_msg}")
@@ -333,67 +1037,68 @@ class Server:
 
             buyer_name = buyer_request['name']
             seller_name = buyer_request['reserved_seller']['seller_name']
+            seller_udp_address = tuple(buyer_request['reserved_seller']['address'])
             buyer_info = self.registered_peers[buyer_name]
-            seller_info = self.registered_peers[seller_name]
+            seller_info = self.registered_peers.get(seller_name)
 
+        buyer_channel = seller_channel = None
         try:
-            # Establish TCP connections
             buyer_address = (buyer_info['address'][0], int(buyer_info['tcp_socket']))
-            seller_address = (seller_info['address'][0], int(seller_info['tcp_socket']))
-
-            buyer_conn = socket.create_connection(buyer_address)
-            seller_conn = socket.create_connection(seller_address)    # Creating TCP Connection to Buyer and Seller
-
-            logging.info(f"TCP connections established with buyer {buyer_name} and seller {seller_name}")
-
-
-            try:
-                # Send INFORM_Req to buyer and seller
-                inform_message = f"INFORM_Req {rq_number} {item_name} {price}"
-                buyer_conn.sendall(inform_message.encode())
-                seller_conn.sendall(inform_message.encode())
-
-                # Receive INFORM_Res from buyer and seller
-                buyer_response = buyer_conn.recv(1024).decode()
-                seller_response = seller_conn.recv(1024).decode()
-                logging.info(f"Buyer response: {buyer_response}")
-                logging.info(f"Seller response: {seller_response}")
-
-                # Process the transaction
-                if self.process_transaction(buyer_response, seller_response, price):
-                    # Transaction successful: Send Shipping_Info to seller
-                    buyer_details = buyer_response.split()
-                    shipping_info = f"Shipping_Info {rq_number} {buyer_details[2]} {buyer_details[-1]}"
-                    seller_conn.sendall(shipping_info.encode())
-                    logging.info(f"Transaction successful. Shipping_Info sent to seller {seller_name} at address {buyer_details[-1]}")
-
-                    # Close buyer connection after sending Shipping_Info to the seller
-                    logging.info(f"Closing TCP connection to buyer {buyer_name}")
-                    buyer_conn.close()
-
-                else:
-                    # Transaction failed: Notify buyer and seller
-                    cancel_message = f"CANCEL {rq_number} Transaction failed"
-                    buyer_conn.sendall(cancel_message.encode())
-                    seller_conn.sendall(cancel_message.encode())
-                    logging.warning(f"Transaction failed for RQ# {rq_number}")
-
-                    # Close both connections after sending CANCEL
-                    logging.info(f"Closing TCP connections to buyer {buyer_name} and seller {seller_name}")
-                    buyer_conn.close()
-                    seller_conn.close()
-            finally:
-                # Ensure the seller connection is closed
-                if not seller_conn.close():
-                    seller_conn.close()
-                    logging.info(f"TCP connection to seller {seller_name} closed.")
+            buyer_channel = self.tcp_pool.get(buyer_address)
+            seller_channel = self.seller_channel(seller_name, seller_info, seller_udp_address)
+
+            # Send INFORM_Req to buyer and seller
+            inform_message = f"INFORM_Req {rq_number} {item_name} {price}"
+            buyer_reply = buyer_channel.request(inform_message, rq_number)
+            seller_reply = seller_channel.request(inform_message, rq_number)
+
+            # Receive INFORM_Res from buyer and seller
+            buyer_response = buyer_reply.result(timeout=TRANSACTION_TIMEOUT)
+            seller_response = seller_reply.result(timeout=TRANSACTION_TIMEOUT)
+            logging.info(f"Buyer response: {buyer_response}")
+            logging.info(f"Seller response: {seller_response}")
+
+            # Process the transaction
+            if self.process_transaction(buyer_response, seller_response, price):
+                # Transaction successful: Send Shipping_Info to seller
+                buyer_details = buyer_response.split()
+                shipping_info = f"Shipping_Info {rq_number} {buyer_details[2]} {buyer_details[-1]}"
+                seller_channel.send(shipping_info)
+                self.finish_transaction(rq_number_buy_msg, 'Completed')
+                logging.info(f"Transaction successful. Shipping_Info sent to seller {seller_name} at address {buyer_details[-1]}")
+            else:
+                # Transaction failed: Notify buyer and seller
+                cancel_message = f"CANCEL {rq_number} Transaction failed"
+                buyer_channel.send(cancel_message)
+                seller_channel.send(cancel_message)
+                self.finish_transaction(rq_number_buy_msg, 'Failed')
+                logging.warning(f"Transaction failed for RQ# {rq_number}")
         except Exception as e:
+            # A reply that did not come in time no longer has anyone waiting for it
+            for channel in (buyer_channel, seller_channel):
+                if channel is not None:
+                    channel.forget(rq_number)
+            self.finish_transaction(rq_number_buy_msg, 'Failed')
             logging.error(f"Error during TCP transaction for RQ# {rq_number}: {e}")
-        finally:
-            # Ensure the buyer connection is closed in case of errors
-            if buyer_conn and not buyer_conn.close:
-                buyer_conn.close()
-                logging.info(f"TCP connection to buyer {buyer_name} closed.")
+
+    # Record how the BUY transaction of a request ended; nothing more happens to the request after it.
+    def finish_transaction(self, rq_number, status):
+        with self.request_lock(rq_number):
+            buyer_request = self.active_requests.get(rq_number)
+            if buyer_request is not None:
+                buyer_request['status'] = status
+                self.persist_request(rq_number)
+
+    # TCP channel to the seller of a transaction. A seller registered on a sibling server is reached
+    # through that server.
+    def seller_channel(self, seller_name, seller_info, seller_udp_address):
+        if seller_info is None and self.federation is not None:
+            channel = self.federation.channel(seller_udp_address)
+            if channel is not None:
+                return channel
+        if seller_info is None:
+            raise ChannelClosed(f"Seller {seller_name} is no longer registered")
+        return self.tcp_pool.get((seller_info['address'][0], int(seller_info['tcp_socket'])))
 
     # Simulates the transaction process.
     def process_transaction(self, buyer_response, seller_response, price):
@@ -426,12 +1131,111 @@ class Server:
 
 
     def send_udp_response(self, message, addr):
-        with self.peer_lock:
-            self.server_socket.sendto(message.encode(), addr)
-        logging.info(f"Sent UDP response to {addr}: {message}")
+        addr = tuple(addr)
+        if self.federation is not None and self.federation.relay(message, addr):
+            return  # A seller registered on a sibling server, which delivers it
+        data = self.encode_for(message, addr)
+        msg_type, rq_number = message.split(maxsplit=2)[:2]
+        self.metrics.inc("replies_total", type=msg_type)
+        if msg_type in REPLY_TO:
+            self.response_cache.record((REPLY_TO[msg_type], rq_number, addr), message)
+        if addr in self.reliable_peers:
+            self.retransmits.track((msg_type, rq_number, addr), data, addr)  # Resent until the peer ACKs it
+        else:
+            self.send_raw(data, addr)
+        udp_log.info("Sent UDP response to %s: %s", addr, message)
+
+    def send_raw(self, data, addr):
+        if self.transport is not None:
+            if self.outgoing.should_drop():
+                return
+            # Asyncio mode: the transport buffers sends, but may only be used from the event loop thread
+            if threading.get_ident() == self.loop_thread_id:
+                self.transport.sendto(data, addr)
+            else:
+                self.loop.call_soon_threadsafe(self.transport.sendto, data, addr)
+        else:
+            self.outgoing.sendto(data, addr)
+
+    # Encode a text message for the peer at addr: binary frames for peers that negotiated them.
+    def encode_for(self, message, addr):
+        if addr not in self.binary_peers:
+            return message.encode()
+        rq_number = message.split(maxsplit=2)[1]
+        rq_id = wire.rq_id_from_number(rq_number)
+        if wire.rq_number_from_id(rq_id) != rq_number:
+            self.remember_rq_alias(rq_id, rq_number)
+        return wire.encode_text(message, rq_id)
+
+    def remember_rq_alias(self, rq_id, rq_number):
+        with self.rq_alias_lock:
+            self.rq_aliases[rq_id] = rq_number
+            self.rq_aliases.move_to_end(rq_id)
+            if len(self.rq_aliases) > RQ_ALIAS_LIMIT:
+                self.rq_aliases.popitem(last=False)
+
+    # rq_number of a request id received in a binary frame.
+    def resolve_rq_id(self, rq_id):
+        with self.rq_alias_lock:
+            rq_number = self.rq_aliases.get(rq_id)
+        return rq_number if rq_number is not None else wire.rq_number_from_id(rq_id)
+
+    # Send a batch of (message, addr) pairs collected while a lock was held.
+    def send_all(self, outbox):
+        for message, addr in outbox:
+            self.send_udp_response(message, addr)
 
     def start(self):
-        threading.Thread(target=self.udp_listener).start()
+        if self.router is not None:
+            self.router.attach(self)
+        if self.federation is not None:
+            self.federation.attach(self)
+        if self.metrics_file:
+            self.timers.schedule(self.metrics_interval, self.metrics_dump_due, ("metrics", "dump"))
+        if self.mode == "asyncio":
+            threading.Thread(target=self.async_listener).start()
+        else:
+            threading.Thread(target=self.udp_listener).start()
+
+    # Stop serving: the listener returns and shuts the server down. The main thread of a worker waits
+    # on `stopped` instead, since the port is shared and a wake-up datagram may reach another worker.
+    def stop(self):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.serving.set)
+        elif self.router is None:
+            # Wake the listener from recvfrom so it sees `stopped`
+            self.server_socket.sendto(b"", self.server_socket.getsockname())
+
+    # Called once the listener has returned, outside of worker processes (see run_worker).
+    def shutdown(self):
+        if self.router is not None:
+            return
+        self.timers.stop()
+        self.store.close()
+
+    # The SQLite writer stopped on a write error: later changes are not stored, so stop taking requests
+    # instead of answering peers with state a restart would lose. Runs on the writer thread.
+    def store_failed(self, error):
+        self.metrics.inc("state_store_failures_total")
+        logging.error(f"Stopping the server, the state store failed: {error}")
+        self.stop()
+
+
+class ServerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, addr):
+        if self.server.trace is not None:
+            self.server.trace.record(data, addr)
+        if self.server.router is None or self.server.router.route(data, addr):
+            self.server.loop.create_task(self.server.dispatch_udp_message(data, addr))
+
+    def error_received(self, exc):
+        logging.warning(f"UDP error in asyncio server: {exc}")
 
 # Determine the server's network IP.
 def get_server_ip():
@@ -443,9 +1247,88 @@ def get_server_udp_port():
     return int(input("Enter the UDP port for Server: "))
 
 
+# Entry point of one worker process of a multi-worker server, started by cluster.start_workers.
+# Each worker keeps its own state, trace and metrics files (server.json -> server.w0.json).
+def run_worker(index, workers, socket_dir, server_file="server.json", trace_file=None, metrics_file=None, **options):
+    router = WorkerRouter(index, workers, socket_dir)
+    server = Server(server_file=worker_file(server_file, index),
+                    trace_file=worker_file(trace_file, index) if trace_file else None,
+                    metrics_file=worker_file(metrics_file, index) if metrics_file else None,
+                    router=router, **options)
+    stopped = server.stopped  # Also set when the server stops itself, see Server.store_failed
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stopped.set())
+    server.start()
+    # Signal handlers run on the main thread between bytecodes, but a signal delivered to another
+    # thread does not interrupt a wait without timeout: wake up regularly so the handler gets to run
+    while not stopped.wait(0.5):
+        pass
+    server.store.close()
+    router.close()
+    os._exit(0)  # The listener thread never returns
+
 
 
 if __name__ == "__main__":
-    server = Server()
-    server.start()
+    parser = argparse.ArgumentParser(description="Peer-to-Peer Shopping System server")
+    parser.add_argument("--state-file", default="server.json", help="Snapshot file for the server state")
+    parser.add_argument("--state-backend", choices=STATE_BACKENDS, default="journal",
+                        help="journal: JSON snapshot and journal, sqlite: SQLite database (default: journal)")
+    parser.add_argument("--fsync", choices=FSYNC_POLICIES, default="interval",
+                        help="When the state journal is fsynced (default: interval)")
+    parser.add_argument("--compact-every", type=int, default=5000,
+                        help="Journal records written before the state is compacted into a new snapshot")
+    parser.add_argument("--mode", choices=SERVER_MODES, default="threaded",
+                        help="threaded: one thread per datagram, asyncio: single event loop (default: threaded)")
+    parser.add_argument("--routing", choices=ROUTING_MODES, default="catalog",
+                        help="catalog: SEARCH only peers whose catalog has the item, broadcast: SEARCH every peer")
+    parser.add_argument("--loss", type=float, default=0.0,
+                        help="Drop this fraction of outgoing datagrams, for testing the reliability layer")
+    parser.add_argument("--archive-ttl", type=float, default=ARCHIVE_TTL,
+                        help="Seconds before a finished request is moved to the archive file, 0 keeps them forever")
+    parser.add_argument("--trace", help="Record every received datagram to this file, for replay.py")
+    parser.add_argument("--log-sample", default="",
+                        help="Keep one in N lines of a log category, e.g. udp=10,search=5 (categories: udp, search, catalog)")
+    parser.add_argument("--log-limit", default="",
+                        help="Lines per second written for a log category, e.g. udp=100 (default 200, 0 for no limit)")
+    parser.add_argument("--metrics-file", help="Dump the metrics in the Prometheus text format to this file")
+    parser.add_argument("--metrics-interval", type=float, default=METRICS_INTERVAL,
+                        help="Seconds between two dumps of the metrics file")
+    parser.add_argument("--price-tolerance", type=float,
+                        help="Send sellers the buyer's bid with each SEARCH; they only offer units priced within "
+                             "bid * (1 + tolerance), e.g. 0.2 (default: off)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes sharing the UDP port with SO_REUSEPORT (default: 1, no workers)")
+    parser.add_argument("--ip", help="IP address to listen on (default: prompted for)")
+    parser.add_argument("--port", type=int, help="UDP port to listen on (default: prompted for)")
+    parser.add_argument("--federation-name", default="server", help="Name of this server among its siblings")
+    parser.add_argument("--siblings", default="",
+                        help="Sibling servers of a federation, e.g. east=127.0.0.1:3001,west=127.0.0.1:3002")
+    args = parser.parse_args()
+    siblings = parse_siblings(args.siblings)
+    if siblings and args.workers > 1:
+        parser.error("--siblings cannot be combined with --workers")
+    configure_sampling(parse_category_values(args.log_sample), parse_category_values(args.log_limit))
+
+    options = dict(server_file=args.state_file, fsync_policy=args.fsync, compact_every=args.compact_every,
+                   mode=args.mode, routing=args.routing, loss=args.loss,
+                   archive_ttl=args.archive_ttl if args.archive_ttl > 0 else None, trace_file=args.trace,
+                   metrics_file=args.metrics_file, metrics_interval=args.metrics_interval,
+                   state_backend=args.state_backend, price_tolerance=args.price_tolerance)
+    address = None
+    if args.ip or args.port:
+        address = (args.ip or get_server_ip(), args.port or get_server_udp_port())
+    if args.workers > 1:
+        if address is None:
+            # Ask for the address once, the workers cannot prompt
+            server_ip = get_server_ip()
+            print(f"Server is running on {server_ip}")
+            address = (server_ip, get_server_udp_port())
+        pool = start_workers(run_worker, args.workers, address=address, **options)
+        print(f"{args.workers} workers listening on UDP port {address[1]}.")
+        pool.wait()
+    else:
+        federation = Federation(args.federation_name, siblings) if siblings else None
+        server = Server(address=address, federation=federation, **options)
+        server.start()
 
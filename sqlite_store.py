@@ -0,0 +1,191 @@
+# sqlite_store.py
+import argparse
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from journal import FSYNC_POLICIES, PUT_PEER, DEL_PEER, PUT_REQUEST, DEL_REQUEST
+
+# How much SQLite syncs for each fsync policy. In WAL mode NORMAL survives a crash of the process
+# and only loses the last transactions on power loss, which matches the journal's "interval" policy.
+SYNCHRONOUS = {"always": "FULL", "interval": "NORMAL", "never": "OFF"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS peers (name TEXT PRIMARY KEY, info TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS requests (
+    rq_number TEXT PRIMARY KEY,
+    name TEXT,
+    status TEXT,
+    item_name TEXT,
+    details TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS requests_by_name ON requests (name);
+CREATE INDEX IF NOT EXISTS requests_by_status ON requests (status);
+CREATE INDEX IF NOT EXISTS requests_by_item ON requests (item_name);
+"""
+
+# Statements are constant strings, so sqlite3 prepares each one once and reuses it from its cache
+PUT_PEER_SQL = "INSERT OR REPLACE INTO peers (name, info) VALUES (?, ?)"
+DEL_PEER_SQL = "DELETE FROM peers WHERE name = ?"
+PUT_REQUEST_SQL = "INSERT OR REPLACE INTO requests (rq_number, name, status, item_name, details) VALUES (?, ?, ?, ?, ?)"
+DEL_REQUEST_SQL = "DELETE FROM requests WHERE rq_number = ?"
+
+
+# Server state in an SQLite database (WAL mode), a drop-in replacement for the Journal with its
+# snapshot: the same replay/open/append/close operations, and indexed queries by peer name, status
+# and item. Like the journal, append() only queues the change; a writer thread applies the queued
+# changes in one transaction per batch (group commit), so handlers never wait on the disk. Queries
+# read the last committed state through a connection of their own, which WAL mode lets them do
+# without waiting for the writer; changes still queued are not seen yet.
+# If a transaction fails the writer stops and `on_failure` is called with the error on the writer
+# thread; later changes are dropped and counted in `lost_changes`, append() never raises.
+class SqliteStore:
+    def __init__(self, path, fsync_policy="interval", fsync_interval=0.05, on_failure=None):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy '{fsync_policy}', expected one of {FSYNC_POLICIES}")
+        self.path = path
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self.on_failure = on_failure
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(f"PRAGMA synchronous={SYNCHRONOUS[fsync_policy]}")
+        self.connection.executescript(SCHEMA)
+        self.io_lock = threading.Lock()  # Serializes use of the connection
+        self.read_connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.read_lock = threading.Lock()  # Serializes use of the read connection
+        self.pending_lock = threading.Condition()
+        self.pending = []  # Queued (sql, parameters)
+        self.running = False
+        self.writer_thread = None
+        self.failure = None  # Error that stopped the writer thread; no change is accepted after it
+        self.lost_changes = 0  # Changes dropped because the writer had stopped
+
+    # Load every stored peer and request into the given dicts. Returns the number of rows loaded.
+    def replay(self, registered_peers, active_requests):
+        loaded = 0
+        with self.io_lock:
+            for name, info in self.connection.execute("SELECT name, info FROM peers"):
+                registered_peers[name] = json.loads(info)
+                loaded += 1
+            for rq_number, details in self.connection.execute("SELECT rq_number, details FROM requests"):
+                active_requests[rq_number] = json.loads(details)
+                loaded += 1
+        return loaded
+
+    def open(self):
+        self.running = True
+        self.writer_thread = threading.Thread(target=self.writer_loop, daemon=True)
+        self.writer_thread.start()
+
+    # Queue one change. Never touches the disk, so it is safe to call while holding state locks.
+    def append(self, op, key, value=None):
+        if self.failure is not None:
+            self.lost_changes += 1
+            return
+        if op == PUT_PEER:
+            change = (PUT_PEER_SQL, (key, json.dumps(value)))
+        elif op == DEL_PEER:
+            change = (DEL_PEER_SQL, (key,))
+        elif op == PUT_REQUEST:
+            change = (PUT_REQUEST_SQL, (key, value.get('name'), value.get('status'),
+                                        (value.get('item_name') or "").lower() or None, json.dumps(value)))
+        elif op == DEL_REQUEST:
+            change = (DEL_REQUEST_SQL, (key,))
+        else:
+            raise ValueError(f"Unknown state operation '{op}'")
+        with self.pending_lock:
+            self.pending.append(change)
+            self.pending_lock.notify()
+
+    def writer_loop(self):
+        while True:
+            with self.pending_lock:
+                if not self.pending and self.running:
+                    self.pending_lock.wait()
+                running = self.running
+            if self.fsync_policy == "interval" and running:
+                time.sleep(self.fsync_interval)  # Let more changes join this transaction
+            try:
+                self.flush()
+            except Exception as e:
+                self.failure = e
+                logging.error(f"SQLite state writer stopped, changes are no longer stored: {e}")
+                if self.on_failure is not None:
+                    self.on_failure(e)
+                break
+            if not running:
+                break
+
+    def check_writable(self):
+        if self.failure is not None:
+            raise RuntimeError(f"SQLite state store stopped after a write error: {self.failure}") from self.failure
+
+    # Apply every queued change in a single transaction.
+    def flush(self):
+        self.check_writable()
+        with self.io_lock:
+            with self.pending_lock:
+                batch = self.pending
+                self.pending = []
+            if not batch:
+                return
+            self.connection.execute("BEGIN")
+            try:
+                for sql, parameters in batch:
+                    self.connection.execute(sql, parameters)
+                self.connection.execute("COMMIT")
+            except sqlite3.Error:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    # Stored requests matching every filter that is given, as {rq_number: details}.
+    def find_requests(self, name=None, status=None, item_name=None):
+        clauses, parameters = [], []
+        for column, value in (("name", name), ("status", status), ("item_name", item_name)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                parameters.append(value.lower() if column == "item_name" else value)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self.read_lock:
+            rows = self.read_connection.execute(f"SELECT rq_number, details FROM requests{where}", parameters).fetchall()
+        return {rq_number: json.loads(details) for rq_number, details in rows}
+
+    # {status: number of stored requests}.
+    def count_by_status(self):
+        with self.read_lock:
+            return dict(self.read_connection.execute("SELECT status, COUNT(*) FROM requests GROUP BY status"))
+
+    # Flush everything still queued, stop the writer thread and close the database.
+    def close(self):
+        if self.running:
+            with self.pending_lock:
+                self.running = False
+                self.pending_lock.notify()
+            self.writer_thread.join()
+        if self.failure is None:
+            self.flush()
+        with self.read_lock:
+            self.read_connection.close()
+        with self.io_lock:
+            self.connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the requests stored in a server's SQLite state")
+    parser.add_argument("path", nargs="?", default="server.sqlite", help="Database of the server state")
+    parser.add_argument("--name", help="Only requests made by this peer")
+    parser.add_argument("--status", help="Only requests with this status")
+    parser.add_argument("--item", help="Only requests for this item")
+    parser.add_argument("--count", action="store_true", help="Print the number of requests per status instead")
+    args = parser.parse_args()
+
+    store = SqliteStore(args.path)
+    if args.count:
+        print(json.dumps(store.count_by_status()))
+    else:
+        for rq_number, details in store.find_requests(args.name, args.status, args.item).items():
+            print(json.dumps({"rq_number": rq_number, **details}))
+    store.close()
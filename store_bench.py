@@ -0,0 +1,123 @@
+# store_bench.py
+import argparse
+import itertools
+import json
+import os
+import random
+import tempfile
+import time
+
+from journal import FSYNC_POLICIES, Journal, PUT_PEER, PUT_REQUEST
+from sqlite_store import SqliteStore
+
+BACKENDS = ("journal", "sqlite")
+STATUSES = ("Processing", "Negotiating", "Found", "Not Found", "No Offers", "Cancelled", "Completed", "Failed")
+
+
+def open_store(backend, workdir, fsync_policy):
+    if backend == "sqlite":
+        return SqliteStore(os.path.join(workdir, "server.sqlite"), fsync_policy=fsync_policy)
+    return Journal(os.path.join(workdir, "server.journal"), fsync_policy=fsync_policy)
+
+
+# Requests written the way the server does: one PUT per state change, the full details every time.
+def make_changes(peers, requests, updates, seed):
+    rng = random.Random(seed)
+    names = [f"Peer{i}" for i in range(peers)]
+    changes = [(PUT_PEER, name, {"address": ["127.0.0.1", 5000 + i], "tcp_port": 6000 + i})
+               for i, name in enumerate(names)]
+    for k in range(requests):
+        details = {"name": rng.choice(names), "item_name": f"item{rng.randrange(requests // 10 + 1)}",
+                   "item_description": "bench", "max_price": 50.0, "status": "Searching", "offers": []}
+        changes.append((PUT_REQUEST, f"RQ{k}", details))
+        for _ in range(updates):
+            details = dict(details, status=rng.choice(STATUSES))
+            changes.append((PUT_REQUEST, f"RQ{k}", details))
+    return names, changes
+
+
+# What the server does without an index: scan every request.
+def scan(requests, name=None, status=None):
+    return {rq_number: details for rq_number, details in requests.items()
+            if (name is None or details['name'] == name) and (status is None or details['status'] == status)}
+
+
+def count_by_status(requests):
+    counts = {}
+    for details in requests.values():
+        counts[details['status']] = counts.get(details['status'], 0) + 1
+    return counts
+
+
+def timed(function, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - started) / repeat
+
+
+# Write the same changes to each backend, reload them as a restarting server does, and time the
+# status and per-peer queries: a scan of the reloaded dicts for the journal, the indexes for SQLite.
+def run(backend, changes, names, fsync_policy, queries, seed):
+    workdir = tempfile.mkdtemp(prefix=f"p2p-store-{backend}-")
+    store = open_store(backend, workdir, fsync_policy)
+    store.open()
+    started = time.perf_counter()
+    for op, key, value in changes:
+        store.append(op, key, value)
+    queued = time.perf_counter() - started
+    store.close()  # Waits until everything is on disk
+    written = time.perf_counter() - started
+
+    registered_peers, requests = {}, {}
+    store = open_store(backend, workdir, fsync_policy)
+    started = time.perf_counter()
+    loaded = store.replay(registered_peers, requests)
+    reload_seconds = time.perf_counter() - started
+
+    rng = random.Random(seed)
+    peer_names = itertools.cycle([rng.choice(names) for _ in range(queries)])
+    statuses = itertools.cycle([rng.choice(STATUSES) for _ in range(queries)])
+    if backend == "sqlite":
+        by_status = lambda: store.count_by_status()
+        by_peer = lambda: store.find_requests(name=next(peer_names))
+        by_peer_status = lambda: store.find_requests(name=next(peer_names), status=next(statuses))
+    else:
+        by_status = lambda: count_by_status(requests)
+        by_peer = lambda: scan(requests, name=next(peer_names))
+        by_peer_status = lambda: scan(requests, name=next(peer_names), status=next(statuses))
+    report = {
+        "changes": len(changes),
+        "queue_seconds": queued,
+        "write_seconds": written,
+        "changes_per_sec": len(changes) / written if written else None,
+        "records_loaded": loaded,
+        "reload_seconds": reload_seconds,
+        "requests": len(requests),
+        "count_by_status_ms": 1000 * timed(by_status, queries),
+        "requests_of_peer_ms": 1000 * timed(by_peer, queries),
+        "requests_of_peer_with_status_ms": 1000 * timed(by_peer_status, queries),
+        "disk_bytes": sum(os.path.getsize(os.path.join(workdir, name)) for name in os.listdir(workdir)),
+        "workdir": workdir,
+    }
+    if backend == "sqlite":
+        store.close()
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the journal and SQLite server state backends")
+    parser.add_argument("--peers", type=int, default=200, help="Registered peers")
+    parser.add_argument("--requests", type=int, default=20000, help="Requests written")
+    parser.add_argument("--updates", type=int, default=3, help="Status changes written per request")
+    parser.add_argument("--queries", type=int, default=200, help="Queries timed per kind")
+    parser.add_argument("--fsync", choices=FSYNC_POLICIES, default="interval", help="fsync policy of both backends")
+    parser.add_argument("--backend", choices=BACKENDS, action="append", help="Only this backend (repeatable)")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the generated requests and queries")
+    args = parser.parse_args()
+
+    names, changes = make_changes(args.peers, args.requests, args.updates, args.seed)
+    results = {backend: run(backend, changes, names, args.fsync, args.queries, args.seed)
+               for backend in args.backend or BACKENDS}
+    results["config"] = vars(args)
+    print(json.dumps(results, indent=2))
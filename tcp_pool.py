@@ -0,0 +1,174 @@
+# tcp_pool.py
+import logging
+import socket
+import struct
+import threading
+from concurrent.futures import Future
+
+# Length-framed TCP channels between the server and the peers' TCP ports. A channel stays open for
+# many BUY transactions and carries several of them at once: every message still starts with
+# "<type> <rq_number>", and replies are matched to their request by rq_number.
+# Every frame starts with a zero byte, which a text message never does, so a peer can tell a framed
+# channel from a plain one-transaction connection by the first byte it receives:
+#   \x00 | payload length (I) | payload
+FRAME_MARKER = b"\x00"
+FRAME_HEADER = struct.Struct("!cI")
+MAX_FRAME = 1 << 20
+CONNECT_TIMEOUT = 5
+
+
+class ChannelClosed(ConnectionError):
+    pass
+
+
+def encode_frame(payload):
+    return FRAME_HEADER.pack(FRAME_MARKER, len(payload)) + payload
+
+
+def recv_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+# Next frame payload from the socket, or None once the other side closed the connection.
+def read_frame(sock):
+    header = recv_exactly(sock, FRAME_HEADER.size)
+    if header is None:
+        return None
+    marker, length = FRAME_HEADER.unpack(header)
+    if marker != FRAME_MARKER or length > MAX_FRAME:
+        raise ValueError("Malformed frame header")
+    return recv_exactly(sock, length)
+
+
+# Write side of a framed connection that can stand in for the socket in code that calls sendall()
+# and close(): messages are sent as frames and close() leaves the shared connection open.
+class FrameWriter:
+    def __init__(self, sock, lock):
+        self.sock = sock
+        self.lock = lock
+
+    def sendall(self, data):
+        with self.lock:
+            self.sock.sendall(encode_frame(data))
+
+    def close(self):
+        pass
+
+
+# One persistent framed connection to a peer. A reader thread hands every incoming message to the
+# future of the request with the same rq_number.
+class Channel:
+    def __init__(self, address):
+        self.address = address
+        self.sock = socket.create_connection(address, timeout=CONNECT_TIMEOUT)
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.send_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.waiters = {}  # rq_number -> Future of the reply
+        self.closed = False
+        self.reader = threading.Thread(target=self.read_loop, daemon=True)
+        self.reader.start()
+
+    def send(self, message):
+        if self.closed:
+            raise ChannelClosed(f"Channel to {self.address} is closed")
+        with self.send_lock:
+            self.sock.sendall(encode_frame(message.encode()))
+
+    # Send a message and return a Future resolved with the reply carrying the same rq_number.
+    def request(self, message, rq_number):
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise ChannelClosed(f"Channel to {self.address} is closed")
+            self.waiters[rq_number] = future
+        try:
+            self.send(message)
+        except OSError as e:
+            self.fail(e)
+        return future
+
+    # Stop waiting for the reply to rq_number, once the caller gave up on it.
+    def forget(self, rq_number):
+        with self.lock:
+            self.waiters.pop(rq_number, None)
+
+    def read_loop(self):
+        error = ChannelClosed(f"Channel to {self.address} closed by the peer")
+        try:
+            while True:
+                payload = read_frame(self.sock)
+                if payload is None:
+                    break
+                message = payload.decode()
+                parts = message.split(maxsplit=2)
+                with self.lock:
+                    future = self.waiters.pop(parts[1], None) if len(parts) > 1 else None
+                if future is None:
+                    logging.warning(f"Unexpected TCP message from {self.address}: {message}")
+                else:
+                    future.set_result(message)
+        except (OSError, ValueError) as e:
+            error = e
+        self.fail(error)
+
+    # Close the channel and fail every request still waiting on it.
+    def fail(self, error):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            waiters, self.waiters = self.waiters, {}
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        for future in waiters.values():
+            future.set_exception(error)
+
+    def close(self):
+        self.fail(ChannelClosed(f"Channel to {self.address} closed"))
+
+
+# Persistent channels to peers, by (ip, tcp_port), opened on first use and replaced once closed.
+class ChannelPool:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.channels = {}
+        self.connect_locks = {}  # address -> lock, so only one thread connects to a peer at a time
+
+    def get(self, address):
+        address = tuple(address)
+        channel = self.channels.get(address)
+        if channel is not None and not channel.closed:
+            return channel
+        with self.lock:
+            connect_lock = self.connect_locks.setdefault(address, threading.Lock())
+        with connect_lock:
+            channel = self.channels.get(address)
+            if channel is None or channel.closed:
+                channel = Channel(address)
+                with self.lock:
+                    self.channels[address] = channel
+                logging.info(f"Opened TCP channel to {address}")
+            return channel
+
+    def close(self, address):
+        with self.lock:
+            channel = self.channels.pop(tuple(address), None)
+            self.connect_locks.pop(tuple(address), None)
+        if channel is not None:
+            channel.close()
+
+    def close_all(self):
+        with self.lock:
+            channels, self.channels = list(self.channels.values()), {}
+        for channel in channels:
+            channel.close()
@@ -0,0 +1,47 @@
+# tests/test_catalog_index.py
+from catalog_index import CatalogIndex, parse_catalog_entries
+
+
+def test_full_push_replaces_the_sellers_catalog():
+    index = CatalogIndex()
+    index.replace("A", [("Lamp", 40.0), ("chair", 60.0)], seq=1)
+    index.replace("A", [("lamp", 35.0)], seq=2)
+    assert index.floors_of("A") == {"lamp": 35.0}
+    assert index.sellers_for("chair") == {}
+    assert index.has_catalog("A")
+
+
+def test_delta_older_than_the_full_push_is_ignored():
+    index = CatalogIndex()
+    index.replace("A", [("lamp", 40.0)], seq=5)
+    index.update("A", [("lamp", None)], seq=4)
+    assert index.sellers_for("lamp") == {"A": 40.0}
+
+
+def test_late_delta_does_not_overwrite_a_newer_one():
+    index = CatalogIndex()
+    index.replace("A", [("lamp", 40.0)], seq=1)
+    index.update("A", [("lamp", 45.0)], seq=3)
+    index.update("A", [("lamp", None)], seq=2)  # Retransmitted, arrives last
+    assert index.sellers_for("lamp") == {"A": 45.0}
+
+
+def test_full_push_keeps_items_of_newer_deltas():
+    index = CatalogIndex()
+    index.update("A", [("chair", 60.0)], seq=3)
+    # A full push taken before the delta, delivered after it
+    index.replace("A", [("lamp", 40.0)], seq=2)
+    assert index.floors_of("A") == {"chair": 60.0, "lamp": 40.0}
+
+
+def test_remove_seller():
+    index = CatalogIndex()
+    index.replace("A", [("lamp", 40.0)], seq=1)
+    index.replace("B", [("lamp", 30.0)], seq=1)
+    index.remove_seller("A")
+    assert index.sellers_for("lamp") == {"B": 30.0}
+    assert not index.has_catalog("A")
+
+
+def test_parse_catalog_entries():
+    assert parse_catalog_entries(["lamp", "40", "chair", "-"]) == [("lamp", 40.0), ("chair", None)]
@@ -0,0 +1,24 @@
+# tests/test_cluster.py
+import wire
+from cluster import owner_of
+
+
+def test_every_message_of_a_request_is_owned_by_the_worker_of_its_item():
+    for item in ("lamp", "chair", "desk-lamp", "sofa", "table"):
+        owners = {
+            owner_of(f"LOOKING_FOR rq1 Buyer {item} a nice one 50".encode(), 4, 0),
+            owner_of(f"LOOKING_FOR rq2 Buyer2 {item.upper()} x 40".encode(), 4, 1),
+            owner_of(wire.encode_text(f"OFFER 00000000000000aa Seller {item} 40"), 4, 2),
+            owner_of(f"NO_OFFER rq1 Seller {item}".encode(), 4, 3),
+            owner_of(f"ACCEPT rq1 {item} 40".encode(), 4, 0),
+            owner_of(wire.encode_text(f"BUY 00000000000000ab {item} 40"), 4, 1),
+            owner_of(f"CANCEL rq1 {item} 40".encode(), 4, 2),
+        }
+        assert len(owners) == 1
+
+
+def test_acks_go_to_every_worker_and_stats_stay_local():
+    assert owner_of(b"ACK rq1 FOUND", 4, 2) is None
+    assert owner_of(b"ACK rq1 REGISTERED", 4, 2) is None
+    assert owner_of(b"STATS rq1", 4, 3) == 3
+    assert owner_of(b"\xff\x00", 4, 1) == 1
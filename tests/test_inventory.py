@@ -0,0 +1,26 @@
+# tests/test_inventory.py
+from inventory import InventoryStore
+
+
+def lamp(price):
+    return {"item_name": "Lamp", "item_description": "desk lamp", "price": price, "reserved": False}
+
+
+def test_releasing_a_request_keeps_the_units_of_other_requests(tmp_path):
+    path = str(tmp_path / "Peer1_inventory.json")
+    store = InventoryStore(path, background=False)
+    store.add(lamp(10))
+    store.add(lamp(20))
+    store.set_reserved("lamp", True, "rq1")  # Cheapest unit
+    store.set_reserved("lamp", False, "rq2")  # Refused without holding a unit: nothing to release
+    assert store.floor("lamp") == 20.0
+    store.set_reserved("lamp", True, "rq2")
+    store.set_reserved("lamp", False, "rq1")
+    assert store.floor("lamp") == 10.0
+    store.close()
+    # Reservations survive a restart with the request that holds them
+    reloaded = InventoryStore(path, background=False)
+    reloaded.set_reserved("lamp", False, "rq2")
+    assert reloaded.floors() == {"lamp": 10.0}
+    assert not any(item['reserved'] for item in reloaded.snapshot())
+    reloaded.close()
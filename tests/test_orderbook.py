@@ -0,0 +1,87 @@
+# tests/test_orderbook.py
+from orderbook import OrderBook
+
+
+def test_cheapest_ask_fills_highest_bid():
+    book = OrderBook()
+    book.post_ask("Lamp", "A", 40.0)
+    book.post_ask("lamp", "B", 35.0)
+    book.add_bid("lamp", "rq1", 50.0, {"A", "B"})
+    book.add_bid("lamp", "rq2", 45.0, {"A", "B"})
+    matches, unmatched = book.match("lamp")
+    assert matches == [("rq1", "B", 35.0), ("rq2", "A", 40.0)]
+    assert unmatched == []
+
+
+def test_match_consumes_the_ask_until_the_new_floor_arrives():
+    book = OrderBook()
+    book.post_ask("lamp", "A", 40.0)
+    book.add_bid("lamp", "rq1", 50.0, {"A"})
+    book.add_bid("lamp", "rq2", 50.0, {"A"})
+    matches, unmatched = book.match("lamp")
+    assert matches == [("rq1", "A", 40.0)]
+    assert unmatched == ["rq2"]
+    assert book.ask("lamp", "A") is None
+    assert book.is_consumed("lamp", "A")
+
+    # An OFFER sent before the seller processed its RESERVE does not bring the unit back
+    book.offer_ask("lamp", "A", 40.0)
+    assert book.ask("lamp", "A") is None
+
+    # The bid waits in the book; the seller's new floor re-posts the ask and fills it
+    book.add_bid("lamp", "rq2", 50.0, {"A"})
+    assert book.has_bids("lamp")
+    book.post_ask("lamp", "A", 40.0)
+    assert not book.is_consumed("lamp", "A")
+    matches, unmatched = book.match("lamp")
+    assert matches == [("rq2", "A", 40.0)]
+    assert unmatched == []
+
+
+def test_out_of_stock_clears_the_consumed_ask():
+    book = OrderBook()
+    book.post_ask("lamp", "A", 40.0)
+    book.consume_ask("lamp", "A")
+    assert book.is_consumed("lamp", "A")
+    book.remove_ask("lamp", "A")
+    assert not book.is_consumed("lamp", "A")
+    assert book.ask("lamp", "A") is None
+
+
+def test_bid_only_takes_asks_of_sellers_that_offered():
+    book = OrderBook()
+    book.post_ask("lamp", "A", 30.0)
+    book.post_ask("lamp", "B", 40.0)
+    book.add_bid("lamp", "rq1", 50.0, {"B"})
+    matches, _ = book.match("lamp")
+    assert matches == [("rq1", "B", 40.0)]
+    assert book.ask("lamp", "A") == 30.0
+
+
+def test_removed_bid_is_not_matched():
+    book = OrderBook()
+    book.post_ask("lamp", "A", 40.0)
+    book.add_bid("lamp", "rq1", 50.0, {"A"})
+    book.remove_bid("lamp", "rq1")
+    assert not book.has_bids("lamp")
+    assert book.match("lamp") == ([], [])
+    assert book.ask("lamp", "A") == 40.0
+
+
+def test_floor_of_the_stocked_item_reposts_the_ask_under_the_buyers_name():
+    book = OrderBook()
+    # The seller answered a search for "lamp" with its "desk-lamp"
+    book.offer_ask("lamp", "A", 40.0, "desk-lamp")
+    book.add_bid("lamp", "rq1", 50.0, {"A"})
+    assert book.match("lamp") == ([("rq1", "A", 40.0)], [])
+    assert book.is_consumed("lamp", "A")
+
+    # The unit is released: the seller reports the floor of "desk-lamp" only
+    book.post_ask("desk-lamp", "A", 40.0)
+    assert not book.is_consumed("lamp", "A")
+    assert book.ask("lamp", "A") == 40.0
+
+    # Out of stock: the ask under the buyer's name goes too
+    book.remove_ask("desk-lamp", "A")
+    assert book.ask("lamp", "A") is None
+    assert book.aliases_of("desk-lamp", "A") == set()
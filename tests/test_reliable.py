@@ -0,0 +1,92 @@
+# tests/test_reliable.py
+import time
+
+from reliable import RetransmitQueue
+from scheduler import TimerScheduler
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_unacknowledged_message_is_retransmitted_until_the_ack():
+    scheduler = TimerScheduler()
+    sent = []
+    queue = RetransmitQueue(scheduler, lambda data, addr: sent.append(data))
+    queue.estimator(("127.0.0.1", 1)).rto = 0.05
+    try:
+        queue.track(("SEARCH", "rq1"), b"SEARCH rq1 lamp", ("127.0.0.1", 1))
+        assert wait_until(lambda: len(sent) >= 2)
+        assert queue.ack(("SEARCH", "rq1"))
+        count = len(sent)
+        time.sleep(0.3)
+        assert len(sent) == count
+        assert len(queue) == 0
+        assert queue.retransmissions >= 1
+    finally:
+        scheduler.stop()
+
+
+def test_queues_sharing_a_scheduler_keep_their_own_retransmissions():
+    scheduler = TimerScheduler()
+    sent = []
+    first = RetransmitQueue(scheduler, lambda data, addr: sent.append(("first", data)))
+    second = RetransmitQueue(scheduler, lambda data, addr: sent.append(("second", data)))
+    for queue in (first, second):
+        queue.estimator(("127.0.0.1", 1)).rto = 0.05
+    try:
+        # Two peers of one host may use the same message key
+        first.track(("REGISTER", "rq1"), b"a", ("127.0.0.1", 1))
+        second.track(("REGISTER", "rq1"), b"b", ("127.0.0.1", 1))
+        assert first.ack(("REGISTER", "rq1"))
+        # The ack of the first queue does not cancel the second queue's retransmission
+        assert wait_until(lambda: sent.count(("second", b"b")) >= 2)
+        assert sent.count(("first", b"a")) == 1
+    finally:
+        scheduler.stop()
+
+
+def test_gives_up_after_max_attempts():
+    scheduler = TimerScheduler()
+    sent = []
+    queue = RetransmitQueue(scheduler, lambda data, addr: sent.append(data), max_attempts=3)
+    queue.estimator(("127.0.0.1", 1)).rto = 0.01
+    try:
+        queue.track(("OFFER", "rq1"), b"OFFER", ("127.0.0.1", 1))
+        assert wait_until(lambda: queue.failures == 1)
+        assert len(sent) == 3
+        assert not queue.ack(("OFFER", "rq1"))
+    finally:
+        scheduler.stop()
+
+
+class RecordingScheduler:
+    def __init__(self):
+        self.delays = []
+        self.due = []
+
+    def schedule(self, delay, callback, key=None, lock=None):
+        self.delays.append(delay)
+        self.due.append(callback)
+
+    def cancel(self, key):
+        pass
+
+    def run(self):
+        while self.due:
+            self.due.pop(0)()
+
+
+def test_recovery_time_covers_every_backoff_delay():
+    scheduler = RecordingScheduler()
+    addr = ("127.0.0.1", 1)
+    queue = RetransmitQueue(scheduler, lambda data, addr: None, max_attempts=4)
+    queue.estimator(addr).rto = 0.1
+    queue.track(("OFFER", "rq1"), b"OFFER", addr)
+    scheduler.run()
+    assert queue.failures == 1
+    assert len(scheduler.delays) == 4
+    assert abs(queue.recovery_time(addr) - sum(scheduler.delays)) < 1e-9
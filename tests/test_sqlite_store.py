@@ -0,0 +1,34 @@
+# tests/test_sqlite_store.py
+import sqlite3
+
+import pytest
+
+from journal import PUT_REQUEST
+from sqlite_store import SqliteStore
+
+
+def test_queries_read_the_committed_state(tmp_path):
+    store = SqliteStore(str(tmp_path / "server.sqlite"), fsync_policy="never")
+    store.append(PUT_REQUEST, "rq1", {"name": "Peer1", "status": "Found", "item_name": "Lamp"})
+    assert store.count_by_status() == {}  # Still queued
+    store.flush()
+    assert store.count_by_status() == {"Found": 1}
+    assert list(store.find_requests(name="Peer1", item_name="lamp")) == ["rq1"]
+    store.close()
+
+
+def test_writer_failure_stops_accepting_changes(tmp_path):
+    failures = []
+    store = SqliteStore(str(tmp_path / "server.sqlite"), fsync_policy="never", on_failure=failures.append)
+    store.open()
+    store.pending.append(("INSERT INTO missing_table VALUES (?)", (1,)))
+    store.append(PUT_REQUEST, "rq1", {"name": "Peer1", "status": "Found"})
+    store.writer_thread.join(timeout=2)
+    assert isinstance(store.failure, sqlite3.Error)
+    assert failures == [store.failure]
+    # Handlers append while holding request locks: the change is dropped, not raised
+    store.append(PUT_REQUEST, "rq2", {"name": "Peer1", "status": "Found"})
+    assert store.lost_changes == 1
+    with pytest.raises(RuntimeError):
+        store.flush()
+    store.close()
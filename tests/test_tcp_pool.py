@@ -0,0 +1,26 @@
+# tests/test_tcp_pool.py
+import socket
+
+from tcp_pool import Channel, encode_frame, read_frame
+
+
+def test_reply_resolves_the_request_and_forget_drops_the_waiter():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    channel = Channel(listener.getsockname())
+    conn, _ = listener.accept()
+    try:
+        reply = channel.request("INFORM_Req rq1 lamp 40", "rq1")
+        assert read_frame(conn) == b"INFORM_Req rq1 lamp 40"
+        conn.sendall(encode_frame(b"INFORM_Res rq1 Buyer"))
+        assert reply.result(timeout=2) == "INFORM_Res rq1 Buyer"
+
+        # A request the caller gave up on does not stay on the channel
+        channel.request("INFORM_Req rq2 lamp 40", "rq2")
+        channel.forget("rq2")
+        assert channel.waiters == {}
+    finally:
+        channel.close()
+        conn.close()
+        listener.close()
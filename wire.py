@@ -0,0 +1,178 @@
+# wire.py
+import hashlib
+import struct
+
+# Compact binary encoding of the UDP protocol, used between peers and the server once both sides
+# advertised FEATURE_BINARY at REGISTER time. Every frame is a fixed header followed by the
+# message fields, each prefixed with its length, so fields may contain spaces:
+#   version (B) | message type code (B) | payload length (H) | request id (Q) | fields...
+# Text messages start with an ASCII letter, so the first byte tells both encodings apart.
+VERSION = 0xB1
+HEADER = struct.Struct("!BBHQ")
+FIELD_LENGTH = struct.Struct("!H")
+FEATURE_BINARY = "BIN1"
+FEATURE_PRICED_SEARCH = "PRICE1"  # The peer understands PRICED_SEARCH
+FEATURE_DESCRIPTION_MATCH = "MATCH1"  # The peer may offer an item of another name that matches the description
+
+MESSAGE_TYPES = {
+    "REGISTER": 1,
+    "REGISTERED": 2,
+    "REGISTER-DENIED": 3,
+    "DE-REGISTER": 4,
+    "DE-REGISTERED": 5,
+    "DE-REGISTER-DENIED": 6,
+    "LOOKING_FOR": 7,
+    "SEARCH": 8,
+    "OFFER": 9,
+    "NEGOTIATE": 10,
+    "ACCEPT": 11,
+    "REFUSE": 12,
+    "FOUND": 13,
+    "NOT_AVAILABLE": 14,
+    "NOT_FOUND": 15,
+    "RESERVE": 16,
+    "CANCEL": 17,
+    "BUY": 18,
+    "CATALOG": 19,
+    "ACK": 20,
+    "NO_OFFER": 21,
+    "PRICED_SEARCH": 22,
+}
+MESSAGE_NAMES = {code: name for name, code in MESSAGE_TYPES.items()}
+
+# Fields after the rq_number of each message, in text order. At most one field is variable length:
+# "*" marks free text (kept as one field, may contain spaces), "+" a list of tokens.
+SCHEMAS = {
+    "REGISTER": ("name", "ip", "udp_port", "tcp_port", "features+"),
+    "REGISTERED": ("features+",),
+    "REGISTER-DENIED": ("reason*",),
+    "DE-REGISTER": ("name",),
+    "DE-REGISTERED": (),
+    "DE-REGISTER-DENIED": ("reason*",),
+    "LOOKING_FOR": ("name", "item_name", "item_description*", "max_price"),
+    "SEARCH": ("item_name", "item_description*"),
+    # stocked_name is only sent when the seller offers an item stocked under another name than item_name
+    "OFFER": ("name", "item_name", "price", "stocked_name+"),
+    "NEGOTIATE": ("item_name", "max_price"),
+    "ACCEPT": ("item_name", "price"),
+    "REFUSE": ("item_name", "price"),
+    "FOUND": ("item_name", "price", "seller*"),
+    "NOT_AVAILABLE": ("item_name", "max_price"),
+    "NOT_FOUND": ("item_name", "max_price"),
+    "RESERVE": ("item_name", "price"),
+    "CANCEL": ("item_name", "price"),
+    "BUY": ("item_name", "price"),
+    "CATALOG": ("name", "mode", "seq", "entries+"),
+    "ACK": ("acked_type",),
+    "NO_OFFER": ("name", "item_name"),
+    # A SEARCH with the buyer's bid: the seller only offers a unit priced within max_price * (1 + tolerance)
+    "PRICED_SEARCH": ("item_name", "max_price", "tolerance", "item_description*"),
+}
+
+
+class WireError(ValueError):
+    pass
+
+
+def is_binary(data):
+    return len(data) > 0 and data[0] == VERSION
+
+
+# Message type of a datagram in either encoding, without decoding the rest of it.
+def message_type(data):
+    if is_binary(data):
+        return MESSAGE_NAMES.get(data[1], "") if len(data) > 1 else ""
+    head = data.split(maxsplit=1)
+    return head[0].decode(errors="replace") if head else ""
+
+
+# 64-bit request id of an rq_number. Binary clients use 16 hex digit rq_numbers, which map to
+# themselves; longer text rq_numbers are hashed and need an alias to be mapped back.
+def rq_id_from_number(rq_number):
+    if len(rq_number) == 16:
+        try:
+            return int(rq_number, 16)
+        except ValueError:
+            pass
+    return int.from_bytes(hashlib.blake2b(rq_number.encode(), digest_size=8).digest(), "big")
+
+
+def rq_number_from_id(rq_id):
+    return f"{rq_id:016x}"
+
+
+def encode(msg_type, rq_id, fields):
+    code = MESSAGE_TYPES.get(msg_type)
+    if code is None:
+        raise WireError(f"No binary encoding for message type {msg_type}")
+    payload = b"".join(FIELD_LENGTH.pack(len(raw)) + raw for raw in (field.encode() for field in fields))
+    return HEADER.pack(VERSION, code, len(payload), rq_id) + payload
+
+
+# Returns (msg_type, rq_id, fields).
+def decode(data):
+    if len(data) < HEADER.size:
+        raise WireError("Truncated frame header")
+    version, code, length, rq_id = HEADER.unpack_from(data)
+    if version != VERSION:
+        raise WireError(f"Unsupported wire version {version:#x}")
+    msg_type = MESSAGE_NAMES.get(code)
+    if msg_type is None:
+        raise WireError(f"Unknown message type code {code}")
+    end = HEADER.size + length
+    if len(data) < end:
+        raise WireError("Truncated frame payload")
+    fields = []
+    offset = HEADER.size
+    while offset < end:
+        (size,) = FIELD_LENGTH.unpack_from(data, offset)
+        offset += FIELD_LENGTH.size
+        fields.append(data[offset:offset + size].decode())
+        offset += size
+    return msg_type, rq_id, fields
+
+
+# Split the fields of a text message (everything after the rq_number) according to its schema.
+def fields_from_text(msg_type, tokens):
+    schema = SCHEMAS[msg_type]
+    variable = next((i for i, field in enumerate(schema) if field[-1] in "*+"), None)
+    if variable is None:
+        return list(tokens[:len(schema)])
+    tail = len(schema) - variable - 1
+    head_fields = list(tokens[:variable])
+    middle = tokens[variable:len(tokens) - tail]
+    tail_fields = list(tokens[len(tokens) - tail:]) if tail else []
+    if schema[variable][-1] == "*":
+        middle = [" ".join(middle)]
+    return head_fields + list(middle) + tail_fields
+
+
+# Encode a space separated text message as a binary frame.
+def encode_text(message, rq_id=None):
+    tokens = message.split()
+    msg_type, rq_number = tokens[0], tokens[1]
+    if rq_id is None:
+        rq_id = rq_id_from_number(rq_number)
+    return encode(msg_type, rq_id, fields_from_text(msg_type, tokens[2:]))
+
+
+# Decode a datagram in either encoding into the positional message parts the handlers expect:
+# [msg_type, rq_number, field, ...]. `resolve` maps a binary request id back to its rq_number.
+def parse(data, resolve=rq_number_from_id):
+    if not is_binary(data):
+        return data.decode().split()
+    msg_type, rq_id, fields = decode(data)
+    parts = [msg_type, resolve(rq_id)]
+    for field, name in zip(fields, _expanded_schema(msg_type, len(fields))):
+        parts.extend(field.split() if name.endswith("+") else [field])
+    return parts
+
+
+def _expanded_schema(msg_type, count):
+    schema = SCHEMAS[msg_type]
+    variable = next((i for i, field in enumerate(schema) if field[-1] in "*+"), None)
+    if variable is None or schema[variable][-1] == "*":
+        return schema
+    # Token lists are sent as one field per token
+    extra = count - len(schema)
+    return schema[:variable] + (schema[variable],) * (extra + 1) + schema[variable + 1:]